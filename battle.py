@@ -6,6 +6,8 @@ import random
 from collections import defaultdict
 from typing import List, Dict, DefaultDict
 
+from helpers.state_store import register_state_type
+
 CURRENT_YEAR = 2024
 
 RARITY_MULTIPLIER = {
@@ -109,6 +111,7 @@ DIR_GOALIE = {
 DIR_BLOCK = {"left": "левый фланг", "center": "центр", "right": "правый фланг"}
 
 
+@register_state_type
 class BattleSession:
     def __init__(self, team1: List[Dict], team2: List[Dict], tactic1: str = "balanced", tactic2: str = "balanced", name1: str = "team1", name2: str = "team2"):
         self.team1 = [p.copy() for p in team1]
@@ -131,6 +134,11 @@ class BattleSession:
         # optional direction chosen by the user for the next attack
         self.user_attack_dir: str | None = None
 
+    def __setstate__(self, state: Dict) -> None:
+        # restored from shared duel state, which stores plain dicts
+        self.__dict__.update(state)
+        self.contribution = defaultdict(int, self.contribution)
+
     @staticmethod
     def _age(player: Dict) -> int:
         try:
@@ -516,6 +524,7 @@ class BattleSession:
 
 
 
+@register_state_type
 class BattleController:
     """Controller that manages battle phases for step-by-step matches."""
 
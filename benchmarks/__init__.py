@@ -0,0 +1,7 @@
+"""Micro benchmarks for hot paths with stored JSON baselines.
+
+``python -m benchmarks run --save benchmarks/baseline.json`` records a
+baseline, ``python -m benchmarks run --compare benchmarks/baseline.json``
+measures again and exits non-zero when a case got slower or allocates
+more than the threshold allows.
+"""
@@ -0,0 +1,68 @@
+"""``python -m benchmarks run|compare``; see :mod:`benchmarks`."""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import cases, harness  # noqa: E402
+
+
+def _print_comparison(rows) -> bool:
+    print(f"\n{'benchmark':<28}{'time':>9}{'memory':>9}")
+    regressed = False
+    for name, t_ratio, m_ratio, bad in rows:
+        regressed |= bad
+        flag = "  REGRESSION" if bad else ""
+        print(f"{name:<28}{t_ratio:>8.2f}x{m_ratio:>8.2f}x{flag}")
+    return regressed
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    run_p = sub.add_parser("run", help="measure the benchmarks")
+    run_p.add_argument("names", nargs="*", help=f"subset of: {', '.join(harness.BENCHMARKS)}")
+    run_p.add_argument("--save", help="write results to this JSON file")
+    run_p.add_argument("--compare", help="baseline JSON to compare against")
+    run_p.add_argument("--quick", action="store_true", help="fewer iterations")
+    run_p.add_argument("--users", type=int, default=10_000)
+    run_p.add_argument("--per-user", type=int, default=100, help="inventory rows per user")
+    run_p.add_argument("--db-path", help="reuse or create the seeded SQLite file here")
+
+    cmp_p = sub.add_parser("compare", help="compare two result files")
+    cmp_p.add_argument("base")
+    cmp_p.add_argument("new")
+
+    for p in (run_p, cmp_p):
+        p.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown, 0.15 = 15%%")
+        p.add_argument("--mem-threshold", type=float, default=0.25, help="allowed peak memory growth")
+    args = parser.parse_args(argv)
+
+    if args.cmd == "compare":
+        base_meta, base = harness.load(args.base)
+        new_meta, new = harness.load(args.new)
+        rows = harness.compare(base, new, args.threshold, args.mem_threshold)
+        return 1 if _print_comparison(rows) else 0
+
+    env = cases.Env(args.users, args.per_user, db_path=args.db_path)
+    results = harness.run(args.names, env, quick=args.quick)
+    meta = harness.metadata(users=env.users, per_user=env.per_user, quick=args.quick)
+    if args.save:
+        harness.save(args.save, meta, results)
+    if args.compare:
+        base_meta, base = harness.load(args.compare)
+        for key in ("users", "per_user", "quick"):
+            if base_meta.get(key) != meta[key]:
+                print(f"warning: baseline {key}={base_meta.get(key)}, this run {key}={meta[key]}")
+        rows = harness.compare(base, results, args.threshold, args.mem_threshold)
+        return 1 if _print_comparison(rows) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
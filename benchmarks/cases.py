@@ -0,0 +1,162 @@
+"""The benchmarked functions.
+
+Pure functions run on fixed inputs; database cases run against a SQLite
+file seeded by :mod:`loadtest.seed` (10k users with 100 cards each by
+default, one million inventory rows).
+"""
+
+from __future__ import annotations
+
+import itertools
+import os
+import random
+import tempfile
+
+from benchmarks.harness import benchmark
+
+
+class Env:
+    """Lazily seeded database shared by the database cases."""
+
+    def __init__(self, users: int = 10_000, per_user: int = 100, cards: int = 2000, db_path: str | None = None) -> None:
+        self.users = users
+        self.per_user = per_user
+        self.cards = cards
+        self.db_path = db_path or os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.sqlite")
+        self._ready = False
+
+    @property
+    def user_ids(self):
+        from loadtest import seed
+
+        return seed.user_ids(self.users)
+
+    def prepare(self) -> None:
+        """Seed the database unless ``db_path`` already holds one."""
+        if self._ready:
+            return
+        from loadtest import runner, seed
+
+        fresh = not os.path.exists(self.db_path)
+        db = runner.use_sqlite(self.db_path, trace=False)
+        if fresh:
+            seed.seed(db, self.users, self.cards, self.per_user)
+        import bot
+
+        bot.setup_storage()
+        self._ready = True
+
+
+def _player(i: int, pos: str = "F") -> dict:
+    return {
+        "id": i, "name": f"P{i}", "pos": pos, "points": 40 + i * 3, "country": "CAN" if i % 2 else "SWE",
+        "born": "1994", "weight": "88", "rarity": ["common", "rare", "epic"][i % 3], "owner_level": 5,
+    }
+
+
+def _teams():
+    team1 = [_player(i) for i in range(1, 6)] + [_player(6, "G")]
+    team2 = [_player(i) for i in range(7, 12)] + [_player(12, "G")]
+    return team1, team2
+
+
+def _played_session(seed: int = 7):
+    from battle import BattleController, BattleSession
+
+    random.seed(seed)
+    session = BattleSession(*_teams(), name1="Home", name2="Away")
+    result = BattleController(session).auto_play()
+    return session, result
+
+
+@benchmark("battle.auto_play", number=200)
+def bench_auto_play(env):
+    from battle import BattleController, BattleSession
+
+    team1, team2 = _teams()
+    seeds = itertools.cycle(range(50))
+
+    def run():
+        random.seed(next(seeds))
+        BattleController(BattleSession(team1, team2)).auto_play()
+
+    return run
+
+
+@benchmark("format_period_summary", number=2000)
+def bench_period_summary(env):
+    from helpers.commentary import format_period_summary
+
+    session, _ = _played_session()
+    return lambda: format_period_summary(session)
+
+
+@benchmark("generate_premium_log", number=1000)
+def bench_premium_log(env):
+    from helpers.premium import generate_premium_log
+
+    session, result = _played_session()
+    return lambda: generate_premium_log(session, result)
+
+
+@benchmark("parse_points", number=200)
+def bench_parse_points(env):
+    from bot import parse_points
+
+    samples = [(f"Очки {i}", "C") for i in range(50)] + [(f"Поб {i} КН 2.{i % 10}", "G") for i in range(50)]
+
+    def run():
+        for stats, pos in samples:
+            parse_points(stats, pos)
+
+    return run
+
+
+@benchmark("format_card_caption", number=5000)
+def bench_card_caption(env):
+    from bot import format_card_caption
+
+    card = {
+        "id": 1, "name": "Connor McDavid", "pos": "C", "country": "CAN", "rarity": "legendary",
+        "stats": "Очки 132", "team_en": "Edmonton", "team_ru": "Эдмонтон",
+    }
+    return lambda: format_card_caption(card, index=4, total=120, filter_name="Все", total_cards=340)
+
+
+@benchmark("calculate_user_score", number=200, db=True)
+def bench_user_score(env):
+    import bot
+
+    env.prepare()
+    users = itertools.cycle(env.user_ids)
+    return lambda: bot._calculate_user_score_sync(next(users))
+
+
+@benchmark("get_top_users", number=1, repeat=3, db=True)
+def bench_top_users(env):
+    import bot
+
+    env.prepare()
+
+    def run():
+        bot.SCORE_CACHE.clear()
+        bot._get_top_users_sync(10)
+
+    return run
+
+
+@benchmark("page_user_cards", number=500, db=True)
+def bench_page_user_cards(env):
+    import inventory
+
+    env.prepare()
+    users = itertools.cycle(env.user_ids)
+
+    def run():
+        uid = next(users)
+        rows = inventory.page_user_cards(uid, {"rarity": "common"})
+        if rows:
+            inventory.page_user_cards(uid, {"rarity": "common"}, after=rows[-1][2])
+        inventory.page_user_cards(uid, {})
+
+    return run
@@ -0,0 +1,132 @@
+"""Benchmark registry, measurement and baseline comparison."""
+
+from __future__ import annotations
+
+import datetime
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class Benchmark:
+    """``setup(env)`` returns the zero-argument callable that is timed.
+
+    ``number`` calls make one timed repeat; ``db`` cases need the seeded
+    database from :class:`benchmarks.cases.Env`.
+    """
+
+    def __init__(self, name: str, setup: Callable, number: int = 100, repeat: int = 5, db: bool = False) -> None:
+        self.name = name
+        self.setup = setup
+        self.number = number
+        self.repeat = repeat
+        self.db = db
+
+
+BENCHMARKS: Dict[str, Benchmark] = {}
+
+
+def benchmark(name: str, number: int = 100, repeat: int = 5, db: bool = False):
+    """Register ``setup`` as benchmark ``name``."""
+
+    def register(setup):
+        BENCHMARKS[name] = Benchmark(name, setup, number, repeat, db)
+        return setup
+
+    return register
+
+
+def measure(bench: Benchmark, env, quick: bool = False) -> Dict[str, float]:
+    """Time ``bench`` and trace the memory one call allocates.
+
+    ``seconds`` is the median per-call time over the repeats; ``peak_kib``
+    is the tracemalloc peak during one call above what was live before it
+    and ``retained_kib`` what was still live after it.  Timing and tracing
+    run separately because tracemalloc slows allocation-heavy code.
+    """
+    fn = bench.setup(env)
+    number = max(1, bench.number // 10) if quick else bench.number
+    repeat = min(bench.repeat, 3) if quick else bench.repeat
+    fn()  # warm caches and imports
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds": statistics.median(times),
+        "min_seconds": min(times),
+        "peak_kib": (peak - before) / 1024,
+        "retained_kib": max(0, current - before) / 1024,
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def run(names: Optional[List[str]], env, quick: bool = False, log=print) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        results[name] = measure(bench, env, quick)
+        r = results[name]
+        log(f"{name:<28}{r['seconds'] * 1e6:>12.1f} us{r['peak_kib']:>12.1f} KiB peak")
+    return results
+
+
+def metadata(**extra) -> Dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        **extra,
+    }
+
+
+def save(path: str, meta: Dict, results: Dict) -> None:
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump({"meta": meta, "results": results}, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+
+
+def load(path: str) -> Tuple[Dict, Dict]:
+    with open(path, encoding="utf-8") as fh:
+        data = json.load(fh)
+    return data.get("meta", {}), data["results"]
+
+
+def compare(
+    base: Dict[str, Dict[str, float]],
+    new: Dict[str, Dict[str, float]],
+    threshold: float = 0.15,
+    mem_threshold: float = 0.25,
+) -> List[Tuple[str, float, float, bool]]:
+    """Return ``(name, time ratio, peak memory ratio, regressed)`` per shared case.
+
+    A case regresses when its best repeat got slower by more than
+    ``threshold`` or its peak allocation grew by more than ``mem_threshold``
+    (fractions).  The best repeat is the least disturbed by other load on
+    the machine, so it is compared instead of the median.
+    """
+    rows = []
+    for name in sorted(set(base) & set(new)):
+        b, n = base[name], new[name]
+        t_ratio = n["min_seconds"] / b["min_seconds"] if b["min_seconds"] else 1.0
+        # ignore noise in tiny allocations
+        m_ratio = (n["peak_kib"] + 1) / (b["peak_kib"] + 1)
+        rows.append((name, t_ratio, m_ratio, t_ratio > 1 + threshold or m_ratio > 1 + mem_threshold))
+    return rows
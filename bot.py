@@ -4,6 +4,7 @@ import random
 import re
 import asyncio
 import logging
+import uuid
 import telegram
 import datetime
 
@@ -49,21 +50,41 @@ from telegram import (
 from telegram.helpers import escape_markdown
 from collections import Counter
 from functools import wraps
-import handlers
 import db_pg as db
-from cards import get_card, CARD_FIELDS
+import inventory
+from cards import (
+    get_card,
+    CARD_FIELDS,
+    RARITY_ORDER,
+    club_index,
+    reset_club_index,
+    file_ids,
+    card_photo,
+    remember_file_id,
+    forget_file_id,
+    mark_image_dead,
+    cards_without_file_id,
+    dead_images_due,
+    setup_image_cache,
+)
 from helpers.leveling import xp_to_next
 from helpers import shorten_number, format_ranking_row, format_my_rank
 from helpers.styles import get_player_style
 from helpers.permissions import ADMINS, is_admin, admin_only
 from helpers.admin_utils import (
     record_admin_usage,
-    admin_usage_log,
-    admin_usage_count,
-    admin_action_history,
+    admin_audit,
     banned_users,
     online_users,
 )
+from helpers.state_store import STORE
+from helpers.leaderboard import Board, LeaderboardSnapshots, render_top
+from helpers.usernames import UsernameDirectory
+from helpers import metrics, migrations, query_profiler
+from helpers.lazy import lazy_callback, lazy_module
+
+# fights, duels and team editing; loaded by the first update that needs them
+handlers = lazy_module("handlers")
 
 async def check_subscribe_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -154,14 +175,6 @@ RARITY_RU_PLURAL = {
     "common": "Обычные",
 }
 
-RARITY_ORDER = {
-    "legendary": 0,
-    "mythic": 1,
-    "epic": 2,
-    "rare": 3,
-    "common": 4
-}
-
 RARITY_EMOJI = {
     "legendary": "⭐️",
     "mythic": "🟥",
@@ -320,6 +333,51 @@ def invalidate_score_cache_for_card(card_id: int) -> None:
     # reset top cache so high scores recompute
     globals()['TOP_CACHE'] = ([], 0)
 
+def _shift_cached_score(user_id: int, cards: list[dict], sign: int) -> None:
+    """Add (``sign=1``) or subtract card points from the cached score."""
+    cached = SCORE_CACHE.get(user_id)
+    if cached:
+        delta = sum(
+            get_card_points(c["id"], c.get("pos"), c.get("stats")) * RARITY_MULTIPLIERS.get(c.get("rarity"), 1)
+            for c in cards
+        )
+        score = cached[0] + sign * delta
+        SCORE_CACHE[user_id] = (score, cached[1])
+        top, _ = TOP_CACHE
+        # the top list only changes if this user is on it or now beats its tail
+        if top and (any(row[0] == user_id for row in top) or score > top[-1][2]):
+            globals()['TOP_CACHE'] = ([], 0)
+    RANK_CACHE.pop(user_id, None)
+
+# loop that reads the score caches; set by post_init
+_CACHE_LOOP: asyncio.AbstractEventLoop | None = None
+
+def _on_cache_loop(fn, *args) -> None:
+    """Run ``fn(*args)`` on the loop owning the caches.
+
+    Grants run in ``asyncio.to_thread`` workers, so listeners hand their
+    cache updates back to the loop instead of changing them from the thread.
+    """
+    loop = _CACHE_LOOP
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if loop is None or loop is running or loop.is_closed():
+        fn(*args)
+    else:
+        loop.call_soon_threadsafe(fn, *args)
+
+def _on_cards_granted(user_id: int, cards: list[dict]) -> None:
+    """Add granted cards to the cached score instead of recomputing it."""
+    _on_cache_loop(_shift_cached_score, user_id, cards, 1)
+
+def _on_cards_removed(user_id: int, cards: list[dict]) -> None:
+    _on_cache_loop(_shift_cached_score, user_id, cards, -1)
+
+inventory.add_grant_listener(_on_cards_granted)
+inventory.add_remove_listener(_on_cards_removed)
+
 POS_RU = {
     "C": "Центр",
     "LW": "Левый нап.",
@@ -342,8 +400,10 @@ was_admin_before = set()
 CARDS_PER_PAGE = 50
 
 # --- Для обменов ---
-pending_trades = {}
-trade_confirmations = {}
+# unfinished trades are forgotten after a day
+TRADE_TTL = 24 * 3600
+pending_trades = STORE.namespace("trades", ttl=TRADE_TTL)
+trade_confirmations = STORE.namespace("trade_confirmations", ttl=TRADE_TTL)
 
 
 TRADE_NHL_PHRASES = [
@@ -367,6 +427,15 @@ TRADE_NHL_PHRASES = [
 def get_db():
     return db.get_db()
 
+# usernames of listed players, refreshed from incoming updates
+USERNAMES = UsernameDirectory(get_db, lambda column, values: db.in_clause(column, values))
+USERNAME_FLUSH_INTERVAL = 60  # seconds between writes of changed usernames
+
+def display_name(user_id: int, names: dict) -> str:
+    """Return ``@username`` from ``names`` or the bare id."""
+    uname = names.get(user_id)
+    return f"@{uname}" if uname else str(user_id)
+
 def setup_db():
     conn = get_db()
     c = conn.cursor()
@@ -438,21 +507,9 @@ def flag_from_iso3(iso):
 def _get_random_card_sync():
     conn = get_db()
     c = conn.cursor()
-    rarity = weighted_random_rarity()
-    c.execute(
-        'SELECT * FROM cards WHERE rarity=? '
-        "AND img NOT LIKE '%default-skater.png%' "
-        "AND img NOT LIKE '%default-goalie.png%' "
-        "AND img != '' AND img IS NOT NULL "
-        'ORDER BY RANDOM() LIMIT 1',
-        (rarity,)
-    )
-    row = c.fetchone()
+    card = inventory.draw_card(c, weighted_random_rarity())
     conn.close()
-    if row:
-        fields = ["id", "name", "img", "pos", "country", "born", "height", "weight", "rarity", "stats", "team_en", "team_ru"]
-        return dict(zip(fields, row))
-    return None
+    return card
 
 async def get_random_card(*args, **kwargs):
     return await asyncio.to_thread(_get_random_card_sync, *args, **kwargs)
@@ -674,28 +731,66 @@ async def get_user_rank_cached(user_id):
     return rank, total
 
 def get_weekly_progress(user_id):
+    """Return score gained since the last weekly rollover."""
     conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT last_week_score FROM users WHERE id=?", (user_id,))
+    c.execute(
+        """
+        SELECT COALESCE(SUM(uc.count * cards.score_points), 0) - COALESCE(MAX(users.last_week_score), 0)
+          FROM users
+          LEFT JOIN user_cards uc ON uc.user_id = users.id
+          LEFT JOIN cards ON cards.id = uc.card_id
+         WHERE users.id=?
+        """,
+        (user_id,),
+    )
     row = c.fetchone()
     conn.close()
-    current = get_user_score_cached_sync(user_id)
-    last = row[0] if row and row[0] is not None else 0
-    return current - last
+    return row[0] if row and row[0] is not None else 0
+
+def setup_score_points():
+    """Fill ``cards.score_points`` (points × rarity multiplier) where missing."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT id, pos, stats, rarity FROM cards WHERE score_points IS NULL")
+    rows = [
+        (get_card_points(cid, pos, stats) * RARITY_MULTIPLIERS.get(rarity, 1), cid)
+        for cid, pos, stats, rarity in c.fetchall()
+    ]
+    if rows:
+        c.executemany("UPDATE cards SET score_points=? WHERE id=?", rows)
+        conn.commit()
+    conn.close()
+
+def closed_week(now: datetime.datetime | None = None) -> str:
+    """Return the ISO label of the week that ended before ``now`` (UTC)."""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    day = now.astimezone(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02d}"
+
+async def weekly_rollover(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Snapshot scores of the week that just ended and start a new one."""
+    week = closed_week()
+    await asyncio.to_thread(setup_score_points)
+    count = await asyncio.to_thread(db.rollover_weekly_scores, week)
+    logging.info("Weekly rollover %s: %s users", week, count)
+    await refresh_leaderboards(context)
 
 def _get_top_users_sync(limit=10):
     conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT id, username, level FROM users")
+    c.execute("SELECT id, level FROM users")
     # Исключаем админов из топа
-    users = [(uid, uname, lvl) for (uid, uname, lvl) in c.fetchall() if not is_admin(uid)]
+    users = [(uid, lvl) for (uid, lvl) in c.fetchall() if not is_admin(uid)]
+    conn.close()
     user_scores = []
-    for uid, uname, lvl in users:
+    for uid, lvl in users:
         score = get_user_score_cached_sync(uid)
-        user_scores.append((uid, uname, score, lvl))
-    user_scores.sort(key=lambda x: x[2], reverse=True)
-    conn.close()
-    return user_scores[:limit]
+        user_scores.append((uid, score, lvl))
+    user_scores.sort(key=lambda x: x[1], reverse=True)
+    names = USERNAMES.resolve(uid for uid, _, _ in user_scores[:limit])
+    return [(uid, names.get(uid), score, lvl) for uid, score, lvl in user_scores[:limit]]
 
 async def get_top_users(*args, **kwargs):
     limit = kwargs.get('limit', 10)
@@ -706,6 +801,80 @@ async def get_top_users(*args, **kwargs):
     globals()['TOP_CACHE'] = (result, time.time())
     return result
 
+LEADERBOARD_INTERVAL = 120  # seconds between snapshot rebuilds
+BOARDS = LeaderboardSnapshots()
+
+def _all_user_scores_sync() -> dict[int, float]:
+    """Score every collection with one aggregate over the counter table."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT uc.user_id, SUM(uc.count * cards.score_points)
+          FROM user_cards uc
+          JOIN cards ON uc.card_id = cards.id
+      GROUP BY uc.user_id
+        """
+    )
+    scores = {uid: score or 0 for uid, score in c.fetchall()}
+    conn.close()
+    return scores
+
+def build_leaderboards_sync() -> None:
+    """Rank all rating boards in one batch and publish them in ``BOARDS``."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT id, level, xp, referrals_count, last_week_score FROM users")
+    # Исключаем админов из рейтингов
+    users = [row for row in c.fetchall() if not is_admin(row[0])]
+    conn.close()
+    scores = _all_user_scores_sync()
+
+    top, by_xp, by_ref, week = [], [], [], []
+    for uid, lvl, xp_val, refs, last_week in users:
+        lvl = lvl if lvl is not None else 1
+        score = scores.get(uid, 0)
+        top.append((uid, score, lvl))
+        by_xp.append((uid, xp_val or 0, lvl))
+        by_ref.append((uid, refs or 0, lvl))
+        week.append((uid, score - (last_week or 0), lvl))
+    top.sort(key=lambda e: e[1], reverse=True)
+    by_xp.sort(key=lambda e: (e[2], e[1]), reverse=True)
+    by_ref.sort(key=lambda e: e[1], reverse=True)
+    week.sort(key=lambda e: e[1], reverse=True)
+    # only the rendered heads of the boards need names
+    names = USERNAMES.resolve(e[0] for board in (top, by_xp, by_ref, week) for e in board[:10])
+
+    BOARDS.replace({
+        "top": Board(top, render_top(
+            "🏆 ТОП по очкам:", top, names,
+            lambda e: f"🔥 {shorten_number(int(e[1]))} очков  🔼 {e[2]} ур.",
+        )),
+        "xp": Board(by_xp, render_top(
+            "🔼 ТОП по уровню:", by_xp, names,
+            lambda e: f"🔼 {e[2]} ур.  🔥 {shorten_number(int(scores.get(e[0], 0)))} очков",
+        )),
+        "ref": Board(by_ref, render_top(
+            "🫂 ТОП по приглашениям:", by_ref, names,
+            lambda e: f"🫂 {e[1]}  🔼 {e[2]} ур.",
+        )),
+        "week": Board(week, render_top(
+            "⚡️ Прирост за неделю:", week, names,
+            lambda e: f"⚡️ +{shorten_number(int(e[1]))}  🔼 {e[2]} ур.",
+        )),
+    })
+
+async def refresh_leaderboards(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await asyncio.to_thread(build_leaderboards_sync)
+
+async def get_leaderboard(name: str) -> Board:
+    """Return the snapshot of board ``name``, building it on first use."""
+    board = BOARDS.get(name)
+    if board is None:
+        await asyncio.to_thread(build_leaderboards_sync)
+        board = BOARDS.get(name)
+    return board
+
 # ------- КОМАНДЫ РЕЙТИНГА ----------
 @require_subscribe
 async def me(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -759,33 +928,20 @@ async def xp(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @require_subscribe
 async def top(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT id, username, level FROM users")
-    rows = [(u, n, l) for u, n, l in c.fetchall() if not is_admin(u)]
-    conn.close()
-
-    scores = await asyncio.gather(*[get_user_score_cached(u) for u, _, _ in rows])
-    pairs = [(u, n, s, l) for (u, n, l), s in zip(rows, scores)]
-    pairs.sort(key=lambda x: x[2], reverse=True)
-
-    lines = ["🏆 ТОП по очкам:", ""]
-    for i, (uid, uname, score, lvl) in enumerate(pairs[:10], 1):
-        name = f"@{uname}" if uname else f"ID:{uid}"
-        lines.append(f"{i}. {name}")
-        lines.append(f"🔥 {shorten_number(int(score))} очков  🔼 {lvl} ур.")
-        lines.append("")
+    board = await get_leaderboard("top")
+    lines = [board.top_text.rstrip(), ""]
 
     user_id = update.effective_user.id
-    total = len(pairs)
-    rank = next((idx + 1 for idx, (u, _, _, _) in enumerate(pairs) if u == user_id), total)
-    score = int(await get_user_score_cached(user_id))
-    _, lvl = db.get_xp_level(user_id)
-    lines.append(f"👀 Ты — #{rank} из {total}")
+    rank, entry, gap = board.position(user_id)
+    if entry:
+        score, lvl = int(entry[1]), entry[2]
+    else:
+        score = int(await get_user_score_cached(user_id))
+        _, lvl = db.get_xp_level(user_id)
+    lines.append(f"👀 Ты — #{rank} из {len(board)}")
     lines.append(f"🔥 {shorten_number(score)} очков  🔼 {lvl} ур.")
-    if rank > 1:
-        diff = int(pairs[rank-2][2] - score)
-        lines.append(f"🚀 До следующего места: {shorten_number(diff)} очков")
+    if gap is not None:
+        lines.append(f"🚀 До следующего места: {shorten_number(int(gap))} очков")
 
     text = "\n".join(lines).rstrip()
     await _send_rank_text(update, text)
@@ -869,47 +1025,96 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show main menu. Same as /start."""
     await send_main_menu(update, context)
 
+# parts of BadRequest messages that blame the photo itself
+_IMAGE_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file",
+    "failed to get http url content",
+    "wrong type of the web page content",
+    "image_process_failed",
+    "photo_invalid_dimensions",
+)
+
+def is_image_error(error: Exception) -> bool:
+    text = str(error).lower()
+    return any(part in text for part in _IMAGE_ERRORS)
+
+async def remember_photo(card: dict, message) -> None:
+    """Cache the file id Telegram assigned to the photo just sent for ``card``."""
+    photos = getattr(message, "photo", None)
+    if photos and card.get("id") is not None and file_ids().get(card["id"]) != photos[-1].file_id:
+        await asyncio.to_thread(remember_file_id, card["id"], photos[-1].file_id)
+
+async def photo_failed(card: dict, photo: str, error: Exception) -> None:
+    """Drop a rejected file id, or flag the card when its image URL is broken."""
+    if card.get("id") is None or not is_image_error(error):
+        return
+    if photo != card.get("img"):
+        await asyncio.to_thread(forget_file_id, card["id"])
+    else:
+        logging.warning("Card %s image is unavailable: %s", card["id"], error)
+        await asyncio.to_thread(mark_image_dead, card["id"])
+
+# private chat that receives photo uploads for the file id cache; unset disables the job
+IMAGE_CACHE_CHAT_ID = os.getenv("IMAGE_CACHE_CHAT_ID")
+IMAGE_PRELOAD_INTERVAL = 600  # seconds
+IMAGE_PRELOAD_BATCH = 20
+# a dead image URL is tried again after this many seconds; the host may be back
+IMAGE_RETRY_COOLDOWN = 24 * 3600
+
+async def preload_card_images(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job: upload photos of cards without a file id to the cache chat.
+
+    Dead images past their cool-down are retried in the same batch; a
+    successful upload puts the card back into /card drops.
+    """
+    pending = await asyncio.to_thread(cards_without_file_id, IMAGE_PRELOAD_BATCH)
+    if len(pending) < IMAGE_PRELOAD_BATCH:
+        pending += await asyncio.to_thread(
+            dead_images_due, IMAGE_RETRY_COOLDOWN, IMAGE_PRELOAD_BATCH - len(pending)
+        )
+    for card_id, img in pending:
+        try:
+            msg = await context.bot.send_photo(IMAGE_CACHE_CHAT_ID, img, disable_notification=True)
+        except telegram.error.RetryAfter:
+            # the next run continues with the same cards
+            return
+        except BadRequest as e:
+            await photo_failed({"id": card_id, "img": img}, img, e)
+            continue
+        await remember_photo({"id": card_id}, msg)
+
 @require_subscribe
 async def card(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id in banned_users:
+    if await banned_users.acontains(user_id):
         await update.message.reply_text("🚫 Вы заблокированы в боте.")
         return
-    now = int(time.time())
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT last_card_time FROM users WHERE id=?", (user_id,))
-    row = c.fetchone()
-    last = row[0] if row else 0
-    if user_id not in admin_no_cooldown:
-        if now - last < CARD_COOLDOWN:
-            mins = (CARD_COOLDOWN - (now - last)) // 60
-            await update.message.reply_text(
-                f"⏳ Следующую карточку можно получить через {mins} мин.\n"
-                "💡 Если твой друг зайдёт по твоей ссылке из /invite, кулдаун сбросится сразу!"
-            )
-            conn.close()
-            return
-    card_obj = await get_random_card()
+    cooldown = 0 if user_id in admin_no_cooldown else CARD_COOLDOWN
+    card_obj, total_cards, wait = await inventory.claim_card(user_id, weighted_random_rarity(), cooldown)
+    if wait:
+        mins = wait // 60
+        await update.message.reply_text(
+            f"⏳ Следующую карточку можно получить через {mins} мин.\n"
+            "💡 Если твой друг зайдёт по твоей ссылке из /invite, кулдаун сбросится сразу!"
+        )
+        return
     if not card_obj:
         await update.message.reply_text("В базе нет карточек с фото или данного раритета.")
-        conn.close()
         return
-    c.execute("INSERT INTO inventory (user_id, card_id, time_got) VALUES (?, ?, ?)", (user_id, card_obj["id"], now))
-    c.execute("UPDATE users SET last_card_time=? WHERE id=?", (now, user_id))
-    conn.commit()
-    conn.close()
 
-    _, total_cards = get_inventory_counts(user_id)
     caption = format_card_caption(
         card_obj,
         total_cards=total_cards,
         show_filter=False,
     )
 
+    photo = card_photo(card_obj)
     try:
-        await context.bot.send_photo(update.message.chat_id, card_obj.get('img', ''), caption=caption, parse_mode='Markdown')
-    except BadRequest:
+        msg = await context.bot.send_photo(update.message.chat_id, photo, caption=caption, parse_mode='Markdown')
+        await remember_photo(card_obj, msg)
+    except BadRequest as e:
+        await photo_failed(card_obj, photo, e)
         await update.message.reply_text(
             f"⚠️ Картинка карточки недоступна, но вот информация:\n{caption}",
             parse_mode='Markdown'
@@ -955,7 +1160,7 @@ async def show_trade_cards(context, user_id, prompt):
     conn.close()
     if not cards:
         await context.bot.send_message(user_id, "У тебя нет карточек для обмена.")
-        pending_trades.pop(user_id, None)
+        await pending_trades.apop(user_id)
         return
     buttons = []
     for card_id, count in cards:
@@ -968,42 +1173,17 @@ async def show_trade_cards(context, user_id, prompt):
         buttons.append(btn)
     if not buttons:
         await context.bot.send_message(user_id, "Нет доступных карт для обмена.")
-        pending_trades.pop(user_id, None)
+        await pending_trades.apop(user_id)
         return
     markup = InlineKeyboardMarkup(buttons)
     await context.bot.send_message(user_id, prompt, reply_markup=markup)
 
-async def show_trade_selector(context, user_id, prompt, is_acceptor=False, page=0, edit_message_id=None):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT card_id FROM inventory WHERE user_id=?", (user_id,))
-    card_ids = [r[0] for r in c.fetchall()]
-    count_dict = Counter(card_ids)
-    conn.close()
-
-    if not card_ids:
-        await context.bot.send_message(user_id, "У тебя нет карточек для обмена.")
-        pending_trades.pop(user_id, None)
-        return
-
-    trade_state = pending_trades[user_id]
+def _trade_selector_markup(trade_state):
+    """Build the selector keyboard from the page cached in ``trade_state``."""
     selected = trade_state.get('selected', set())
-    trade_state['page'] = page
-
-    card_items = list(count_dict.items())
-    card_items.sort()
-
-    # Пагинация
-    total_pages = (len(card_items) + TRADE_CARDS_PER_PAGE - 1) // TRADE_CARDS_PER_PAGE
-    start = page * TRADE_CARDS_PER_PAGE
-    end = start + TRADE_CARDS_PER_PAGE
-    page_cards = card_items[start:end]
-
+    page = trade_state.get('page', 0)
     buttons = []
-    for card_id, count in page_cards:
-        card_name, rarity = get_card_name_rarity(card_id)
-        if card_name == "?":
-            continue  # не показываем битые карты!
+    for card_id, card_name, rarity in trade_state.get('page_rows', []):
         checked = "✅ " if card_id in selected else ""
         btn = InlineKeyboardButton(
             f"{checked}{card_name} ({RARITY_RU.get(rarity, rarity)})",
@@ -1020,7 +1200,7 @@ async def show_trade_selector(context, user_id, prompt, is_acceptor=False, page=
     nav_buttons = []
     if page > 0:
         nav_buttons.append(InlineKeyboardButton("◀️ Назад", callback_data="trade_page_prev"))
-    if page < total_pages - 1:
+    if page < trade_state.get('pages', 1) - 1:
         nav_buttons.append(InlineKeyboardButton("Вперёд ▶️", callback_data="trade_page_next"))
 
     markup_list = []
@@ -1028,7 +1208,31 @@ async def show_trade_selector(context, user_id, prompt, is_acceptor=False, page=
         markup_list.append(nav_buttons)
     markup_list += buttons
     markup_list.append(controls)
-    markup = InlineKeyboardMarkup(markup_list)
+    return InlineKeyboardMarkup(markup_list)
+
+async def show_trade_selector(context, user_id, prompt, is_acceptor=False, page=0, edit_message_id=None):
+    page_cards, total_pages = await asyncio.to_thread(
+        inventory.page_trade_cards, user_id, page, TRADE_CARDS_PER_PAGE
+    )
+    if not total_pages:
+        await context.bot.send_message(user_id, "У тебя нет карточек для обмена.")
+        await pending_trades.apop(user_id)
+        return
+    if not page_cards:
+        # карты ушли, пока листали — показываем последнюю страницу
+        page = total_pages - 1
+        page_cards, total_pages = await asyncio.to_thread(
+            inventory.page_trade_cards, user_id, page, TRADE_CARDS_PER_PAGE
+        )
+
+    trade_state = await pending_trades.aget(user_id)
+    if trade_state is None:
+        return
+    trade_state['page'] = page
+    trade_state['pages'] = total_pages
+    trade_state['page_rows'] = [(cid, name, rarity) for cid, _, name, rarity in page_cards]
+    await pending_trades.aset(user_id, trade_state)
+    markup = _trade_selector_markup(trade_state)
 
     if edit_message_id:
         await context.bot.edit_message_reply_markup(
@@ -1077,24 +1281,24 @@ async def trade(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пользователь не найден.")
         return
 
-    pending_trades[user_id] = {
+    await pending_trades.aset(user_id, {
         'partner_id': partner_id,
         'stage': 'initiator_selecting',
         'selected': set()
-    }
-    pending_trades[partner_id] = {
+    })
+    await pending_trades.aset(partner_id, {
         'partner_id': user_id,
         'stage': 'accept_offer'
-    }
+    })
     await show_trade_selector(context, user_id, "Выбери до 5 своих карточек для обмена (можно несколько):")
 
 async def trade_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
-    if user_id not in pending_trades:
+    trade_state = await pending_trades.aget(user_id)
+    if trade_state is None:
         await query.answer("Нет активного обмена.")
         return
-    trade_state = pending_trades[user_id]
     page = trade_state.get('page', 0)
     if query.data == "trade_page_prev":
         page = max(0, page - 1)
@@ -1115,11 +1319,11 @@ async def trade_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
 
-    if user_id not in pending_trades:
+    trade_state = await pending_trades.aget(user_id)
+    if trade_state is None:
         await query.answer("Нет активного обмена.")
         return
 
-    trade_state = pending_trades[user_id]
     stage = trade_state['stage']
     partner_id = trade_state['partner_id']
     data = query.data
@@ -1155,12 +1359,17 @@ async def trade_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             sel.add(card_id)
         trade_state['selected'] = sel
-        await show_trade_selector(
-            context, user_id,
-            "Выбери до 5 своих карточек для обмена (можно несколько):",
-            page=trade_state.get('page', 0),
-            edit_message_id=query.message.message_id
-        )
+        await pending_trades.aset(user_id, trade_state)
+        if 'page_rows' in trade_state:
+            # страница уже в состоянии — перерисовываем только клавиатуру
+            await query.edit_message_reply_markup(reply_markup=_trade_selector_markup(trade_state))
+        else:
+            await show_trade_selector(
+                context, user_id,
+                "Выбери до 5 своих карточек для обмена (можно несколько):",
+                page=trade_state.get('page', 0),
+                edit_message_id=query.message.message_id
+            )
         try:
             await query.answer()
         except BadRequest:
@@ -1173,12 +1382,13 @@ async def trade_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not trade_state.get('selected'):
                 await query.answer("Выбери хотя бы одну карту для обмена.")
                 return
-            pending_trades[user_id]['stage'] = 'waiting_accept'
-            pending_trades[partner_id] = {
+            trade_state['stage'] = 'waiting_accept'
+            await pending_trades.aset(user_id, trade_state)
+            await pending_trades.aset(partner_id, {
                 'partner_id': user_id,
                 'stage': 'accept_offer',
                 'offer': set(trade_state['selected'])
-            }
+            })
             card_names = [get_card_name_rarity(cid)[0] for cid in trade_state['selected']]
             text = (
                 f"Тебе предлагают обмен на эти карты:\n"
@@ -1200,13 +1410,13 @@ async def trade_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             offer1 = set(trade_state['offer'])
             offer2 = set(trade_state['selected'])
             # Сохраняем инфу для финального подтверждения
-            trade_confirmations[(user_id, partner_id)] = {
+            await trade_confirmations.aset((user_id, partner_id), {
                 "initiator": partner_id,
                 "acceptor": user_id,
                 "offer1": offer1,
                 "offer2": offer2,
                 "confirmed": set()
-            }
+            })
             await show_trade_confirmation(context, partner_id, user_id, offer1, offer2)
             await show_trade_confirmation(context, user_id, partner_id, offer1, offer2)
             await query.edit_message_text("Ожидание подтверждения обмена обоими игроками.")
@@ -1216,6 +1426,7 @@ async def trade_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "trade_accept_offer":
         trade_state['stage'] = 'acceptor_selecting'
         trade_state['selected'] = set()
+        await pending_trades.aset(user_id, trade_state)
         await show_trade_selector(
             context, user_id,
             "Выбери до 5 своих карточек для обмена (можно несколько):",
@@ -1229,8 +1440,8 @@ async def trade_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "trade_reject_offer":
         await context.bot.send_message(user_id, "Ты отклонил обмен.")
         await context.bot.send_message(partner_id, "Твой обмен был отклонён.")
-        pending_trades.pop(user_id, None)
-        pending_trades.pop(partner_id, None)
+        await pending_trades.apop(user_id)
+        await pending_trades.apop(partner_id)
         try:
             await query.edit_message_text("Обмен отклонён.")
         except:
@@ -1241,8 +1452,8 @@ async def trade_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "trade_cancel":
         await context.bot.send_message(user_id, "Обмен отменён.")
         await context.bot.send_message(partner_id, "Обмен отменён второй стороной.")
-        pending_trades.pop(user_id, None)
-        pending_trades.pop(partner_id, None)
+        await pending_trades.apop(user_id)
+        await pending_trades.apop(partner_id)
         try:
             await query.edit_message_text("Обмен отменён.")
         except:
@@ -1251,18 +1462,25 @@ async def trade_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Финальное подтверждение обмена
     if data == "trade_final_confirm":
-        # Найти трейд
-        found = None
-        for k in trade_confirmations.keys():
-            if user_id in k:
-                found = k
-                break
+        found = await _find_trade_confirmation(user_id, partner_id)
         if not found:
             await query.answer("Нет ожидающего подтверждения обмена.")
             return
-        trade_confirmations[found]["confirmed"].add(user_id)
-        if len(trade_confirmations[found]["confirmed"]) == 2:
-            vals = trade_confirmations.pop(found)
+        token = uuid.uuid4().hex
+
+        def confirm(current):
+            # only the confirmation that completes the pair finalizes
+            if not current or current.get("done"):
+                return None
+            confirmed = current["confirmed"] | {user_id}
+            new = {**current, "confirmed": confirmed}
+            if len(confirmed) == 2:
+                new["done"] = token
+            return new
+
+        vals = await trade_confirmations.aupdate(found, confirm)
+        if vals and vals.get("done") == token:
+            await trade_confirmations.apop(found)
             await finalize_multi_trade(
                 context,
                 vals["acceptor"],  # второй игрок
@@ -1275,24 +1493,30 @@ async def trade_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if data == "trade_final_cancel":
-        found = None
-        for k in trade_confirmations.keys():
-            if user_id in k:
-                found = k
-                break
+        found = await _find_trade_confirmation(user_id, partner_id)
         if not found:
             await query.answer("Нет ожидающего подтверждения обмена.")
             return
-        vals = trade_confirmations.pop(found)
+        vals = await trade_confirmations.apop(found)
+        if vals is None:
+            await query.answer("Нет ожидающего подтверждения обмена.")
+            return
         await context.bot.send_message(vals["initiator"], "Обмен отменён одним из участников.")
         await context.bot.send_message(vals["acceptor"], "Обмен отменён одним из участников.")
-        pending_trades.pop(vals["initiator"], None)
-        pending_trades.pop(vals["acceptor"], None)
+        await pending_trades.apop(vals["initiator"])
+        await pending_trades.apop(vals["acceptor"])
         await query.edit_message_text("Обмен отменён.")
         return
 
     await query.answer("Неизвестное действие.")
 
+async def _find_trade_confirmation(user_id, partner_id):
+    """Return the ``trade_confirmations`` key for a pair of traders."""
+    for key in ((user_id, partner_id), (partner_id, user_id)):
+        if await trade_confirmations.acontains(key):
+            return key
+    return None
+
 async def show_trade_confirmation(context, uid, other_uid, offer1, offer2):
     # Кто ты: инициатор или акцептор
     if uid == other_uid:
@@ -1325,15 +1549,18 @@ async def show_trade_confirmation(context, uid, other_uid, offer1, offer2):
 
 async def finalize_multi_trade(context, acceptor_id, initiator_id, offer1, offer2):
     # offer1 — карты инициатора, offer2 — карты acceptor
-    for cid in offer1:
-        remove_card(initiator_id, cid)
-        add_card(acceptor_id, cid)
-    for cid in offer2:
-        remove_card(acceptor_id, cid)
-        add_card(initiator_id, cid)
-
-    offer1_names = [get_card_name_rarity(cid)[0] for cid in offer1]
-    offer2_names = [get_card_name_rarity(cid)[0] for cid in offer2]
+    receipt = await inventory.trade_cards(initiator_id, offer1, acceptor_id, offer2)
+    await pending_trades.apop(initiator_id)
+    await pending_trades.apop(acceptor_id)
+    if receipt is None:
+        for uid in (initiator_id, acceptor_id):
+            await context.bot.send_message(
+                uid, "Обмен не состоялся: у одного из игроков уже нет выбранных карточек."
+            )
+        return receipt
+
+    offer1_names = [c["name"] for c in receipt["gave"][initiator_id]]
+    offer2_names = [c["name"] for c in receipt["gave"][acceptor_id]]
     nhl_phrase = random.choice(TRADE_NHL_PHRASES)
 
     await context.bot.send_message(
@@ -1356,8 +1583,7 @@ async def finalize_multi_trade(context, acceptor_id, initiator_id, offer1, offer
             "🎯 Готов к следующему шагу?",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Вернуться в меню", callback_data="menu_back")]]),
         )
-    pending_trades.pop(initiator_id, None)
-    pending_trades.pop(acceptor_id, None)
+    return receipt
 
 def get_card_name_rarity(card_id):
     card = get_card(card_id)
@@ -1375,27 +1601,10 @@ def get_rarity_emoji(rarity):
     }.get(rarity, "🟢")
 
 def remove_card(user_id, card_id):
-    conn = get_db()
-    c = conn.cursor()
-    try:
-        c.execute(
-            "DELETE FROM inventory WHERE ctid IN (SELECT ctid FROM inventory WHERE user_id=? AND card_id=? LIMIT 1)",
-            (user_id, card_id),
-        )
-    except Exception:
-        c.execute(
-            "DELETE FROM inventory WHERE user_id=? AND card_id=? LIMIT 1",
-            (user_id, card_id),
-        )
-    conn.commit()
-    conn.close()
+    inventory.remove_card_sync(user_id, card_id)
 
 def add_card(user_id, card_id):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("INSERT INTO inventory (user_id, card_id, time_got) VALUES (?, ?, ?)", (user_id, card_id, int(time.time())))
-    conn.commit()
-    conn.close()
+    inventory.grant_cards_sync(user_id, [card_id])
 
 def get_full_cards_for_user(user_id):
     conn = get_db()
@@ -1430,63 +1639,20 @@ def get_full_cards_for_user(user_id):
 
 def get_inventory_counts(user_id):
     """Return number of unique cards and total copies for user."""
-    cards, total = get_full_cards_for_user(user_id)
-    return len(cards), total
+    return inventory.get_counts(user_id)
 
 def get_all_club_keys():
     """Return sorted list of all club keys from team_en or team_ru."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT DISTINCT COALESCE(team_en, team_ru) AS club
-          FROM cards
-         WHERE COALESCE(team_en, team_ru) IS NOT NULL
-           AND COALESCE(team_en, team_ru) != ''
-        """
-    )
-    clubs = sorted(r[0] for r in c.fetchall())
-    conn.close()
-    return clubs
+    return club_index()[0]
 
 
 def get_club_total_counts():
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT COALESCE(team_en, team_ru) AS club,
-               COUNT(DISTINCT id)
-          FROM cards
-         WHERE COALESCE(team_en, team_ru) IS NOT NULL
-           AND COALESCE(team_en, team_ru) != ''
-      GROUP BY COALESCE(team_en, team_ru)
-        """
-    )
-    data = {row[0]: row[1] for row in c.fetchall()}
-    conn.close()
-    return data
+    return club_index()[1]
 
 
 def get_user_club_counts(user_id):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT COALESCE(cards.team_en, cards.team_ru) AS club,
-               COUNT(DISTINCT cards.id)
-          FROM inventory
-          JOIN cards ON inventory.card_id = cards.id
-         WHERE inventory.user_id = ?
-           AND COALESCE(cards.team_en, cards.team_ru) IS NOT NULL
-           AND COALESCE(cards.team_en, cards.team_ru) != ''
-      GROUP BY COALESCE(cards.team_en, cards.team_ru)
-        """,
-        (user_id,)
-    )
-    data = {row[0]: row[1] for row in c.fetchall()}
-    conn.close()
-    return data
+    """Return ``{club: unique cards owned}`` from the inventory counters."""
+    return {club: uniq for club, (uniq, _) in inventory.get_group_counts(user_id, "club").items()}
 
 
 def get_user_club_cards(user_id, club_key):
@@ -1531,63 +1697,89 @@ def get_team_cards(user_id):
             cards.append(cpy)
     return cards, len(cards)
 
-def fetch_user_cards(user_id, rarity=None, club=None, new_only=False):
-    conn = get_db()
-    c = conn.cursor()
-    query = (
-        "SELECT cards.id, cards.name, cards.rarity, COUNT(*) as cnt "
-        "FROM inventory JOIN cards ON inventory.card_id = cards.id "
-        "WHERE inventory.user_id=?"
-    )
-    params = [user_id]
-    if rarity:
-        query += " AND cards.rarity=?"
-        params.append(rarity)
-    if club:
-        query += " AND COALESCE(cards.team_en, cards.team_ru)=?"
-        params.append(club)
-    if new_only:
-        query += " AND inventory.time_got >= ?"
-        params.append(int(time.time()) - 86400)
-    query += " GROUP BY cards.id, cards.name, cards.rarity"
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
-    return rows
+# cards kept in ``user_data`` around the one shown in the carousel
+COLL_WINDOW = 20
+
+RARITY_BY_RANK = {rank: rarity for rarity, rank in RARITY_ORDER.items()}
+
+
+def _coll_filter(state):
+    return {k: state.get(k) for k in ("rarity", "club", "duplicates", "new_only")}
+
+
+def _set_window(state, rows, offset):
+    """Keep ids and counts of ``rows`` plus keyset cursors around them."""
+    state["ids"] = [[cid, cnt] for cid, cnt, _ in rows]
+    state["offset"] = offset
+    state["first"] = rows[0][2] if rows else None
+    state["last"] = rows[-1][2] if rows else None
+
+
+def _open_carousel(user_id, **flt):
+    """Return carousel state for the first window of cards matching ``flt``."""
+    state = {**flt, "mode": "carousel", "index": 0}
+    _, total = get_inventory_counts(user_id)
+    if flt.get("team"):
+        cards, _ = get_team_cards(user_id)
+        state.update(ids=[[c["id"], 1] for c in cards], offset=0, count=len(cards), total=total)
+        return state
+    unique, _ = inventory.count_user_cards(user_id, flt)
+    rows = inventory.page_user_cards(user_id, flt, limit=COLL_WINDOW)
+    state.update(count=unique, total=total)
+    _set_window(state, rows, 0)
+    return state
+
+
+def _move_carousel(user_id, state, step):
+    """Move the carousel by ``step`` cards, loading the next window if needed."""
+    idx = max(0, min(state["index"] + step, state["count"] - 1))
+    offset, ids = state["offset"], state["ids"]
+    if ids and not state.get("team") and not offset <= idx < offset + len(ids):
+        flt = _coll_filter(state)
+        if idx >= offset + len(ids):
+            rows = inventory.page_user_cards(user_id, flt, after=state["last"], limit=COLL_WINDOW)
+            if rows:
+                _set_window(state, rows, offset + len(ids))
+        else:
+            rows = inventory.page_user_cards(user_id, flt, before=state["first"], limit=COLL_WINDOW)
+            if rows:
+                _set_window(state, rows, max(0, offset - len(rows)))
+        # the collection changed under the cursor: stay inside what we have
+        offset, ids = state["offset"], state["ids"]
+        idx = max(offset, min(idx, offset + len(ids) - 1))
+    state["index"] = idx
+
+
+def _current_card(state):
+    ids = state.get("ids") or []
+    pos = state.get("index", 0) - state.get("offset", 0)
+    if not 0 <= pos < len(ids):
+        return None
+    cid, cnt = ids[pos]
+    card = get_card(cid)
+    if not card:
+        return None
+    card = card.copy()
+    card["count"] = cnt
+    return card
 
-def build_filtered_cards(user_id, *, rarity=None, club=None, new_only=False, duplicates=False):
-    """Return a sorted list of card dicts with count."""
-    rows = fetch_user_cards(user_id, rarity=rarity, club=club, new_only=new_only)
-    if duplicates:
-        rows = [r for r in rows if r[3] > 1]
-    cards = []
-    for cid, name, rar, cnt in rows:
-        card = get_card(cid)
-        if not card:
-            continue
-        cpy = card.copy()
-        cpy["count"] = cnt
-        cards.append(cpy)
-    cards.sort(key=lambda c: (RARITY_ORDER.get(c.get("rarity", "common"), 99), c.get("name", "")))
-    return cards
 
 async def send_card_page(
     chat_id,
     context,
-    cards,
+    card,
     index=0,
     *,
+    count=1,
     user_id=None,
     edit=False,
     message_id=None,
     total_cards=None,
 ):
     """Send or edit a single card with navigation buttons."""
-    if not cards:
+    if not card:
         await context.bot.send_message(chat_id, "У тебя нет карточек по этому фильтру.")
         return
-    index = max(0, min(index, len(cards) - 1))
-    card = cards[index]
     # progress info
     state = context.user_data.get("coll", {})
     if state.get("rarity"):
@@ -1607,7 +1799,7 @@ async def send_card_page(
     caption = format_card_caption(
         card,
         index=index,
-        total=len(cards),
+        total=count,
         filter_name=filter_name,
         total_cards=total_cards,
         show_filter=True,
@@ -1616,7 +1808,7 @@ async def send_card_page(
     nav = []
     if index > 0:
         nav.append(InlineKeyboardButton("⬅️", callback_data="coll_prev"))
-    if index < len(cards) - 1:
+    if index < count - 1:
         nav.append(InlineKeyboardButton("➡️", callback_data="coll_next"))
     rows = []
     if nav:
@@ -1624,30 +1816,33 @@ async def send_card_page(
     rows.append([InlineKeyboardButton("🔙 Назад", callback_data="coll_back")])
     markup = InlineKeyboardMarkup(rows)
 
+    photo = card_photo(card)
     try:
         if edit and message_id:
-            await context.bot.edit_message_media(
+            msg = await context.bot.edit_message_media(
                 chat_id=chat_id,
                 message_id=message_id,
                 media=InputMediaPhoto(
-                    card.get("img", ""),
+                    photo,
                     caption=caption,
                     parse_mode="Markdown",
                 ),
                 reply_markup=markup,
             )
         else:
-            await context.bot.send_photo(
+            msg = await context.bot.send_photo(
                 chat_id,
-                card.get("img", ""),
+                photo,
                 caption=caption,
                 parse_mode="Markdown",
                 reply_markup=markup,
             )
+        await remember_photo(card, msg)
     except BadRequest as e:
         # Ignore attempts to edit the message when nothing changed
         if "Message is not modified" in str(e):
             return
+        await photo_failed(card, photo, e)
         if edit and message_id:
             try:
                 await context.bot.edit_message_text(
@@ -1679,33 +1874,36 @@ async def send_collection_page(
     club=None,
     new_only=False,
     duplicates=False,
+    after=None,
+    before=None,
     edit_message=False,
     message_id=None,
 ):
-    rows = fetch_user_cards(user_id, rarity=rarity, club=club, new_only=new_only)
-    if duplicates:
-        rows = [r for r in rows if r[3] > 1]
-
-    card_info = []
-    for cid, name, rar, cnt in rows:
-        idx = RARITY_ORDER.get(rar, 99)
-        card_info.append((idx, name, cid, cnt, rar))
-
-    if not card_info:
+    """Show one list page; ``after``/``before`` are cursors of the neighbour page."""
+    flt = {"rarity": rarity, "club": club, "new_only": new_only, "duplicates": duplicates}
+    unique_total, total_cards = inventory.count_user_cards(user_id, flt)
+    if not unique_total:
         await context.bot.send_message(chat_id, "У тебя нет карточек по этому фильтру.")
         return
 
-    card_info.sort(key=lambda x: (x[0], x[1]))
-    start = page * CARDS_PER_PAGE
-    end = start + CARDS_PER_PAGE
-    page_cards = card_info[start:end]
+    page_cards = inventory.page_user_cards(
+        user_id,
+        flt,
+        after=after,
+        before=before,
+        offset=page * CARDS_PER_PAGE,
+        limit=CARDS_PER_PAGE,
+    )
     if not page_cards:
         await context.bot.send_message(chat_id, "На этой странице нет карточек.")
         return
+    state = context.user_data.setdefault("coll", {})
+    state["first"] = page_cards[0][2]
+    state["last"] = page_cards[-1][2]
 
     grouped = {}
-    for _, name, cid, count, rar in page_cards:
-        grouped.setdefault(rar, []).append((name, count))
+    for _, count, (rank, name, _) in page_cards:
+        grouped.setdefault(RARITY_BY_RANK.get(rank), []).append((name, count))
 
     lines = []
     for rar in ["legendary", "mythic", "epic", "rare", "common"]:
@@ -1718,9 +1916,7 @@ async def send_collection_page(
             lines.append(f"• {name}{suffix}")
         lines.append("")
 
-    total_cards = sum(r[3] for r in card_info)
-    unique_total = len(card_info)
-    total_pages = (len(card_info) + CARDS_PER_PAGE - 1) // CARDS_PER_PAGE
+    total_pages = (unique_total + CARDS_PER_PAGE - 1) // CARDS_PER_PAGE
 
     nav = []
     if page > 0:
@@ -1808,35 +2004,20 @@ async def invite(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def topref(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "SELECT id, username, referrals_count, level FROM users ORDER BY referrals_count DESC"
-    )
-    rows = [(uid, uname, cnt, lvl) for uid, uname, cnt, lvl in c.fetchall() if not is_admin(uid)]
-    conn.close()
-    if not rows:
+    board = await get_leaderboard("ref")
+    if not board:
         await _send_rank_text(update, "Пока никто не приглашал друзей.")
         return
-
-    lines = ["🫂 ТОП по приглашениям:", ""]
-    for i, (uid, username, count, lvl) in enumerate(rows[:10], 1):
-        name = f"@{username}" if username else f"ID:{uid}"
-        lines.append(f"{i}. {name}")
-        lines.append(f"🫂 {count}  🔼 {lvl} ур.")
-        lines.append("")
+    lines = [board.top_text.rstrip(), ""]
 
     user_id = update.effective_user.id
-    total = len(rows)
-    idx = next((j for j,(uid,_,_,_) in enumerate(rows) if uid == user_id), total-1)
-    rank = idx + 1
-    my_cnt = rows[idx][2] if idx < len(rows) else 0
-    _, my_lvl = db.get_xp_level(user_id)
-    lines.append(f"👀 Ты — #{rank} из {total}")
+    rank, entry, gap = board.position(user_id)
+    my_cnt = entry[1] if entry else 0
+    my_lvl = entry[2] if entry else db.get_xp_level(user_id)[1]
+    lines.append(f"👀 Ты — #{rank} из {len(board)}")
     lines.append(f"🫂 {my_cnt}  🔼 {my_lvl} ур.")
-    if rank > 1:
-        diff = rows[rank-2][2] - my_cnt
-        lines.append(f"🚀 До следующего места: {diff} приглаш.")
+    if gap is not None:
+        lines.append(f"🚀 До следующего места: {gap} приглаш.")
 
     text = "\n".join(lines).rstrip()
     await _send_rank_text(update, text)
@@ -1844,35 +2025,17 @@ async def topref(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @require_subscribe
 async def topweek(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT id, username, level FROM users")
-    rows = [(uid, uname, lvl) for uid, uname, lvl in c.fetchall() if not is_admin(uid)]
-    conn.close()
-
-    progress_list = []
-    for uid, uname, lvl in rows:
-        prog = get_weekly_progress(uid)
-        progress_list.append((uid, uname, prog, lvl))
-    progress_list.sort(key=lambda x: x[2], reverse=True)
-
-    lines = ["⚡️ Прирост за неделю:", ""]
-    for i, (uid, uname, prog, lvl) in enumerate(progress_list[:10], 1):
-        name = f"@{uname}" if uname else f"ID:{uid}"
-        lines.append(f"{i}. {name}")
-        lines.append(f"⚡️ +{shorten_number(int(prog))}  🔼 {lvl} ур.")
-        lines.append("")
+    board = await get_leaderboard("week")
+    lines = [board.top_text.rstrip(), ""]
 
     user_id = update.effective_user.id
-    my_prog = get_weekly_progress(user_id)
-    total = len(progress_list)
-    rank = next((idx + 1 for idx, (uid, *_ ) in enumerate(progress_list) if uid == user_id), total)
-    _, my_lvl = db.get_xp_level(user_id)
-    lines.append(f"👀 Ты — #{rank} из {total}")
+    rank, entry, gap = board.position(user_id)
+    my_prog = entry[1] if entry else get_weekly_progress(user_id)
+    my_lvl = entry[2] if entry else db.get_xp_level(user_id)[1]
+    lines.append(f"👀 Ты — #{rank} из {len(board)}")
     lines.append(f"⚡️ +{shorten_number(int(my_prog))}  🔼 {my_lvl} ур.")
-    if rank > 1:
-        diff = int(progress_list[rank-2][2] - my_prog)
-        lines.append(f"🚀 До следующего места: {shorten_number(diff)} очков")
+    if gap is not None:
+        lines.append(f"🚀 До следующего места: {shorten_number(int(gap))} очков")
 
     text = "\n".join(lines).rstrip()
     await _send_rank_text(update, text)
@@ -1880,49 +2043,17 @@ async def topweek(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @require_subscribe
 async def topxp(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db()
-    c = conn.cursor()
-    if ADMINS:
-        placeholders = ','.join('?' for _ in ADMINS)
-        query = f"SELECT id, username, level, xp FROM users WHERE id NOT IN ({placeholders}) ORDER BY level DESC, xp DESC"
-        c.execute(query, tuple(ADMINS))
-    else:
-        query = "SELECT id, username, level, xp FROM users ORDER BY level DESC, xp DESC"
-        c.execute(query)
-    rows = [
-        (
-            uid,
-            uname,
-            lvl if lvl is not None else 1,
-            xp if xp is not None else 0,
-        )
-        for uid, uname, lvl, xp in c.fetchall()
-    ]
-    # В некоторых инсталляциях порядок из БД может быть некорректным.
-    # Отсортируем ещё раз в Python по уровню и XP по убыванию.
-    rows.sort(key=lambda r: (r[2], r[3]), reverse=True)
-    conn.close()
-
-    lines = ["🔼 ТОП по уровню:", ""]
-    top_rows = rows[:10]
-    scores = await asyncio.gather(*[get_user_score_cached(r[0]) for r in top_rows])
-    for i, ((uid, uname, lvl, _), score) in enumerate(zip(top_rows, scores), 1):
-        name = f"@{uname}" if uname else f"ID:{uid}"
-        lines.append(f"{i}. {name}")
-        lines.append(f"🔼 {lvl} ур.  🔥 {shorten_number(int(score))} очков")
-        lines.append("")
+    board = await get_leaderboard("xp")
+    lines = [board.top_text.rstrip(), ""]
 
     user_id = update.effective_user.id
-    total = len(rows)
-    rank = next((idx + 1 for idx, (uid, *_ ) in enumerate(rows) if uid == user_id), total)
-    xp_val = int(next((xp for uid, _, _, xp in rows if uid == user_id), 0))
+    rank, entry, gap = board.position(user_id)
     score = int(await get_user_score_cached(user_id))
-    _, user_lvl = db.get_xp_level(user_id)
-    lines.append(f"👀 Ты — #{rank} из {total}")
+    user_lvl = entry[2] if entry else db.get_xp_level(user_id)[1]
+    lines.append(f"👀 Ты — #{rank} из {len(board)}")
     lines.append(f"🔼 {user_lvl} ур.  🔥 {shorten_number(score)} очков")
-    if rank > 1:
-        diff = int(rows[rank-2][3] - xp_val)
-        lines.append(f"🚀 До следующего места: {shorten_number(diff)} XP")
+    if gap is not None:
+        lines.append(f"🚀 До следующего места: {shorten_number(int(gap))} XP")
 
     text = "\n".join(lines).rstrip()
     await _send_rank_text(update, text)
@@ -2024,6 +2155,20 @@ async def collection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     nav = context.user_data.setdefault("coll_nav", ["collection"])
 
+    async def show_carousel(state):
+        context.user_data["coll"] = state
+        await send_card_page(
+            query.message.chat_id,
+            context,
+            _current_card(state),
+            index=state["index"],
+            count=state["count"],
+            user_id=uid,
+            edit=True,
+            message_id=query.message.message_id,
+            total_cards=state.get("total"),
+        )
+
     async def show_state(state):
         async def send_or_edit(text: str, markup: InlineKeyboardMarkup):
             if query.message and query.message.photo:
@@ -2044,26 +2189,7 @@ async def collection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
             await send_or_edit("Выбери редкость:", InlineKeyboardMarkup(buttons))
             return
         if state.startswith("rarity_"):
-            rarity = state.split("_", 1)[1]
-            cards = build_filtered_cards(uid, rarity=rarity)
-            _, total = get_inventory_counts(uid)
-            context.user_data["coll"] = {
-                "rarity": rarity,
-                "mode": "carousel",
-                "index": 0,
-                "cards": cards,
-                "total": total,
-            }
-            await send_card_page(
-                query.message.chat_id,
-                context,
-                cards,
-                index=0,
-                user_id=uid,
-                edit=True,
-                message_id=query.message.message_id,
-                total_cards=total,
-            )
+            await show_carousel(_open_carousel(uid, rarity=state.split("_", 1)[1]))
             return
         if state.startswith("clubpage_"):
             page = int(state.split("_")[1])
@@ -2074,89 +2200,16 @@ async def collection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await send_club_list_page(query.message.chat_id, context, uid, page=page, edit=True, message_id=query.message.message_id)
             return
         if state.startswith("club_"):
-            club = state[5:]
-            cards = build_filtered_cards(uid, club=club)
-            _, total = get_inventory_counts(uid)
-            context.user_data["coll"] = {
-                "club": club,
-                "mode": "carousel",
-                "index": 0,
-                "cards": cards,
-                "total": total,
-            }
-            await send_card_page(
-                query.message.chat_id,
-                context,
-                cards,
-                index=0,
-                user_id=uid,
-                edit=True,
-                message_id=query.message.message_id,
-                total_cards=total,
-            )
+            await show_carousel(_open_carousel(uid, club=state[5:]))
             return
         if state == "duplicates":
-            cards = build_filtered_cards(uid, duplicates=True)
-            _, total = get_inventory_counts(uid)
-            context.user_data["coll"] = {
-                "duplicates": True,
-                "mode": "carousel",
-                "index": 0,
-                "cards": cards,
-                "total": total,
-            }
-            await send_card_page(
-                query.message.chat_id,
-                context,
-                cards,
-                index=0,
-                user_id=uid,
-                edit=True,
-                message_id=query.message.message_id,
-                total_cards=total,
-            )
+            await show_carousel(_open_carousel(uid, duplicates=True))
             return
         if state == "new":
-            cards = build_filtered_cards(uid, new_only=True)
-            _, total = get_inventory_counts(uid)
-            context.user_data["coll"] = {
-                "new_only": True,
-                "mode": "carousel",
-                "index": 0,
-                "cards": cards,
-                "total": total,
-            }
-            await send_card_page(
-                query.message.chat_id,
-                context,
-                cards,
-                index=0,
-                user_id=uid,
-                edit=True,
-                message_id=query.message.message_id,
-                total_cards=total,
-            )
+            await show_carousel(_open_carousel(uid, new_only=True))
             return
         if state == "team":
-            cards, _ = get_team_cards(uid)
-            _, total = get_inventory_counts(uid)
-            context.user_data["coll"] = {
-                "team": True,
-                "mode": "carousel",
-                "index": 0,
-                "cards": cards,
-                "total": total,
-            }
-            await send_card_page(
-                query.message.chat_id,
-                context,
-                cards,
-                index=0,
-                user_id=uid,
-                edit=True,
-                message_id=query.message.message_id,
-                total_cards=total,
-            )
+            await show_carousel(_open_carousel(uid, team=True))
             return
         if state.startswith("all_page_"):
             page = int(state.split("_")[2])
@@ -2234,31 +2287,17 @@ async def collection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     if data in {"coll_next", "coll_prev"}:
         state = context.user_data.get("coll", {})
         if state.get("mode") == "carousel":
-            idx = state.get("index", 0)
-            if data == "coll_next":
-                idx += 1
-            else:
-                idx = max(0, idx - 1)
-            cards = state.get("cards", [])
-            idx = max(0, min(idx, len(cards) - 1))
-            state["index"] = idx
-            context.user_data["coll"] = state
-            await send_card_page(
-                query.message.chat_id,
-                context,
-                cards,
-                index=idx,
-                user_id=uid,
-                edit=True,
-                message_id=query.message.message_id,
-                total_cards=state.get("total"),
-            )
+            _move_carousel(uid, state, 1 if data == "coll_next" else -1)
+            await show_carousel(state)
         else:
             page = state.get("page", 0)
+            cursor = {}
             if data == "coll_next":
                 page += 1
-            else:
-                page = max(0, page - 1)
+                cursor["after"] = state.get("last")
+            elif page > 0:
+                page -= 1
+                cursor["before"] = state.get("first")
             state["page"] = page
             context.user_data["coll"] = state
             if context.user_data.get("coll_nav"):
@@ -2274,6 +2313,7 @@ async def collection_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
                 duplicates=state.get("duplicates", False),
                 edit_message=True,
                 message_id=query.message.message_id,
+                **cursor,
             )
         return
 
@@ -2310,17 +2350,15 @@ async def whoisadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         uid = update.message.reply_to_message.from_user.id
 
     if uid is None:
-        conn = get_db()
-        c = conn.cursor()
+        users = admin_audit.admins()
+        names = await asyncio.to_thread(USERNAMES.resolve, users)
         lines = []
-        for user_id in sorted(admin_usage_log):
-            c.execute("SELECT username FROM users WHERE id=?", (user_id,))
-            row = c.fetchone()
-            username = row[0] if row else None
+        for user_id in users:
+            username = names.get(user_id)
             if username:
                 username = escape_markdown(username, version=1)
             cmds = sorted(
-                escape_markdown(cmd, version=1) for cmd in admin_usage_log.get(user_id, [])
+                escape_markdown(cmd, version=1) for cmd in admin_audit.commands(user_id)
             )
             name = f"@{username}" if username else "—"
             lines.append(f"👤 ID: {user_id} | {name}")
@@ -2333,8 +2371,7 @@ async def whoisadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"• Сейчас в ADMINS: {'✅' if user_id in ADMINS else '❌'}"
             )
             lines.append("")
-        conn.close()
-        total = len(admin_usage_log)
+        total = len(users)
         lines.append(
             f"Всего пользователей, использовавших админ-функции: {total}"
         )
@@ -2344,12 +2381,7 @@ async def whoisadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # detailed info for selected uid
     record_admin_usage(requester_id, "/whoisadmin")
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT username FROM users WHERE id=?", (uid,))
-    row = c.fetchone()
-    conn.close()
-    username = row[0] if row else None
+    username = await asyncio.to_thread(USERNAMES.get, uid)
     if username:
         username = escape_markdown(username, version=1)
 
@@ -2361,7 +2393,7 @@ async def whoisadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     no_cd = uid in admin_no_cooldown
     has_panel = is_admin(uid)
     passes_sub = True if has_panel else await is_user_subscribed(context.bot, uid)
-    used_cmds = sorted(escape_markdown(cmd, version=1) for cmd in admin_usage_log.get(uid, []))
+    used_cmds = sorted(escape_markdown(cmd, version=1) for cmd in admin_audit.commands(uid))
 
     lines = [
         f"👤 ID: {uid}",
@@ -2424,39 +2456,51 @@ async def deletecard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     c = conn.cursor()
     c.execute('SELECT id FROM cards WHERE name = ?', (name,))
     row = c.fetchone()
+    conn.close()
     if not row:
         await update.message.reply_text(f"Не найдено карточки с именем: {name}")
-    else:
-        c.execute('DELETE FROM cards WHERE id = ?', (row[0],))
-        conn.commit()
-        await update.message.reply_text(f"Карточка игрока '{name}' удалена.")
-    conn.close()
+        return
+    holders = await inventory.delete_card(row[0])
+    reset_club_index()
+    for uid in holders:
+        SCORE_CACHE.pop(uid, None)
+        RANK_CACHE.pop(uid, None)
+    await update.message.reply_text(f"Карточка игрока '{name}' удалена.")
 
 @admin_only
 async def giveallcards(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/giveallcards [rarity=<r>] [club=<club>] [user_id ...]
+
+    Give every listed user (the caller by default) each matching card
+    they do not own yet.
+    """
     user_id = update.effective_user.id
     record_admin_usage(user_id, "/giveallcards")
+    targets = []
+    flt = {}
+    for arg in context.args or []:
+        key, sep, value = arg.partition("=")
+        if sep and key in ("rarity", "club") and value:
+            flt[key] = value
+        elif arg.isdigit():
+            targets.append(int(arg))
+        else:
+            await update.message.reply_text(
+                "Используй: /giveallcards [rarity=epic] [club=Boston] [user_id ...]"
+            )
+            return
+    if flt.get("rarity") and flt["rarity"] not in RARITY_ORDER:
+        await update.message.reply_text(f"Неизвестная редкость: {flt['rarity']}")
+        return
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT id FROM cards")
-    all_ids = {row[0] for row in c.fetchall()}
-    c.execute("SELECT card_id FROM inventory WHERE user_id=?", (user_id,))
-    have_ids = {row[0] for row in c.fetchall()}
-    missing = all_ids - have_ids
-
-    now = int(time.time())
-    for cid in missing:
-        c.execute(
-            "INSERT INTO inventory (user_id, card_id, time_got) VALUES (?, ?, ?)",
-            (user_id, cid, now),
-        )
-    conn.commit()
-    conn.close()
-
-    await update.message.reply_text(
-        f"✅ Выдано {len(missing)} новых карточек."
-    )
+    start = time.perf_counter()
+    added = await inventory.bulk_grant(targets or [user_id], **flt)
+    elapsed = (time.perf_counter() - start) * 1000
+    total = sum(added.values())
+    text = f"✅ Выдано {total} новых карточек"
+    if targets:
+        text += f" (получили {len(added)} из {len(targets)} пользователей)"
+    await update.message.reply_text(f"{text} за {elapsed:.0f} мс.")
 
 
 async def admin_remove_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2477,21 +2521,42 @@ async def admin_remove_callback(update: Update, context: ContextTypes.DEFAULT_TY
             text += "\n\n✅ Удалён"
         await query.edit_message_text(text, parse_mode="Markdown")
         await query.answer("Удалён")
+AUDIT_PERIOD_RE = re.compile(r"^(\d+)([hd])$")
+ADMIN_AUDIT_FLUSH_INTERVAL = 30  # seconds between writes of the admin log
+
+def parse_audit_filters(args) -> dict | None:
+    """Parse ``[admin_id] [/command] [<N>h|<N>d]`` into ``history`` filters."""
+    filters = {}
+    for arg in args:
+        period = AUDIT_PERIOD_RE.match(arg)
+        if period:
+            hours = int(period.group(1)) * (24 if period.group(2) == "d" else 1)
+            filters["since"] = int(time.time()) - hours * 3600
+        elif arg.startswith("/"):
+            filters["command"] = arg
+        elif arg.isdigit():
+            filters["admin_id"] = int(arg)
+        else:
+            return None
+    return filters
+
 @admin_only
 async def logadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     record_admin_usage(user_id, "/logadmin")
-    conn = get_db()
-    c = conn.cursor()
-    entries = admin_action_history[-20:][::-1]
+    filters = parse_audit_filters(context.args or [])
+    if filters is None:
+        await update.message.reply_text("Используй: /logadmin [id] [/команда] [24h|7d]")
+        return
+    if filters:
+        entries = await asyncio.to_thread(admin_audit.history, limit=20, **filters)
+    else:
+        entries = admin_audit.recent(20)
+    names = await asyncio.to_thread(USERNAMES.resolve, [uid for _, uid, _ in entries])
     lines = []
     for ts, uid, cmd in entries:
-        c.execute("SELECT username FROM users WHERE id=?", (uid,))
-        row = c.fetchone()
-        name = f"@{row[0]}" if row and row[0] else str(uid)
         dt = datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
-        lines.append(f"{dt} | {name} → {cmd}")
-    conn.close()
+        lines.append(f"{dt} | {display_name(uid, names)} → {cmd}")
     await update.message.reply_text("\n".join(lines) if lines else "Лог пуст.")
 
 
@@ -2499,16 +2564,9 @@ async def logadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admintop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     record_admin_usage(user_id, "/admintop")
-    conn = get_db()
-    c = conn.cursor()
-    items = sorted(admin_usage_count.items(), key=lambda x: x[1], reverse=True)
-    lines = []
-    for i, (uid, cnt) in enumerate(items[:10], 1):
-        c.execute("SELECT username FROM users WHERE id=?", (uid,))
-        row = c.fetchone()
-        name = f"@{row[0]}" if row and row[0] else str(uid)
-        lines.append(f"{i}. {name} — {cnt}")
-    conn.close()
+    items = sorted(admin_audit.totals().items(), key=lambda x: x[1], reverse=True)[:10]
+    names = await asyncio.to_thread(USERNAMES.resolve, [uid for uid, _ in items])
+    lines = [f"{i}. {display_name(uid, names)} — {cnt}" for i, (uid, cnt) in enumerate(items, 1)]
     await update.message.reply_text("\n".join(lines) if lines else "Нет данных.")
 
 
@@ -2530,59 +2588,127 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     c.execute("SELECT COUNT(*) FROM battles")
     total_battles = c.fetchone()[0]
     conn.close()
+    queue = handlers.PVP_QUEUE.stats()
     text = (
         f"Пользователей: {total_users}\n"
         f"Паков сегодня: {packs_today}\n"
         f"Карточек выдано: {total_cards}\n"
         f"Начислено XP: {total_xp}\n"
-        f"Боёв проведено: {total_battles}"
+        f"Боёв проведено: {total_battles}\n"
+        f"Очередь дуэлей: {queue['waiting']} "
+        f"(пар: {queue['matched']}, истекло: {queue['expired']})\n"
+        f"Ожидание дуэли: ср. {queue['avg_wait']:.0f}с, "
+        f"p50 {queue['p50_wait']:.0f}с, p95 {queue['p95_wait']:.0f}с"
     )
     await update.message.reply_text(text)
 
+@admin_only
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    record_admin_usage(user_id, "/metrics")
+    if not metrics.ENABLED:
+        await update.message.reply_text("Метрики выключены (BOT_METRICS=1).")
+        return
+    lines = ["Хендлер: вызовы/ошибки, p50/p95/p99 мс"]
+    for label, calls, errors, p50, p95, p99 in metrics.summary():
+        lines.append(f"{label}: {calls}/{errors}, {p50 * 1000:.0f}/{p95 * 1000:.0f}/{p99 * 1000:.0f}")
+    await update.message.reply_text("\n".join(lines) if len(lines) > 1 else "Нет данных.")
+
+@admin_only
+async def queries_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    record_admin_usage(user_id, "/queries")
+    if not query_profiler.ENABLED:
+        await update.message.reply_text("Профилировщик запросов выключен (QUERY_PROFILE=1).")
+        return
+    lines = ["Запросов на вызов: ср./макс., ср. мс"]
+    for name, calls, avg_q, max_q, avg_ms in query_profiler.handler_report():
+        lines.append(f"{name} ×{calls}: {avg_q:.1f}/{max_q}, {avg_ms:.0f} мс")
+    lines += ["", "Самые дорогие запросы (всего мс):"]
+    for fp, count, total_ms, max_ms in query_profiler.query_report(5):
+        lines.append(f"{total_ms:.0f} мс ×{count} (макс {max_ms:.0f}): {fp[:120]}")
+    await update.message.reply_text("\n".join(lines))
+
 @admin_only
 async def whoonline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     record_admin_usage(user_id, "/whoonline")
     now = time.time()
-    active = [uid for uid, ts in online_users.items() if now - ts <= 600]
-    conn = get_db()
-    c = conn.cursor()
-    names = []
-    for uid in active:
-        c.execute("SELECT username FROM users WHERE id=?", (uid,))
-        row = c.fetchone()
-        names.append(f"@{row[0]}" if row and row[0] else str(uid))
-    conn.close()
+    seen = await online_users.store.run(online_users.items)
+    active = [uid for uid, ts in seen if now - ts <= 600]
+    resolved = await asyncio.to_thread(USERNAMES.resolve, active)
+    names = [display_name(uid, resolved) for uid in active]
     if names:
         await update.message.reply_text("Сейчас онлайн:\n" + "\n".join(names))
     else:
         await update.message.reply_text("Никого нет онлайн.")
 
-TEMP_DICTS = [
-    pending_trades,
-    trade_confirmations,
-]
+# online marks are written at most this often per user (seconds)
+ONLINE_HEARTBEAT = 60
+# user_id -> when this worker last wrote the user's online mark
+_online_written: dict[int, float] = {}
 
 async def track_user_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Record last activity time for a user."""
-    if update.effective_user:
-        online_users[update.effective_user.id] = time.time()
+    """Record last activity time and current username of a user."""
+    user = update.effective_user
+    if user:
+        now = time.time()
+        if now - _online_written.get(user.id, 0) >= ONLINE_HEARTBEAT:
+            _online_written[user.id] = now
+            await asyncio.to_thread(online_users.__setitem__, user.id, now)
+        USERNAMES.observe(user.id, user.username)
+
+async def flush_usernames(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await asyncio.to_thread(USERNAMES.flush)
+
+async def flush_admin_audit(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await asyncio.to_thread(admin_audit.flush)
 
 async def cleanup_expired(context: ContextTypes.DEFAULT_TYPE):
-    now = time.time()
-    TTL = 24 * 3600
-    for d in TEMP_DICTS:
-        for k in list(d.keys()):
-            created = d[k].get("created", now)
-            if now - created > TTL:
-                d.pop(k, None)
+    # trades, duels and online marks expire by their TTL in the state store
+    await asyncio.to_thread(STORE.purge_expired)
+    cutoff = time.time() - ONLINE_HEARTBEAT
+    for uid in [uid for uid, ts in _online_written.items() if ts < cutoff]:
+        del _online_written[uid]
     handlers.cleanup_pvp_queue()
-    # cleanup online users older than 10 minutes
-    for uid, ts in list(online_users.items()):
-        if now - ts > 600:
-            online_users.pop(uid, None)
+
+# how often waiting players are re-checked with a wider rating window
+PVP_MATCH_INTERVAL = 5
+# how often expired duel phases are resolved
+DUEL_TICK_INTERVAL = 5
+# how often bot rosters for PvE are topped up
+POOL_REFILL_INTERVAL = 60
+
+# how often inventory counters are compared with the inventory table
+INVENTORY_CHECK_INTERVAL = 6 * 3600
+
+async def check_inventory_counters(context: ContextTypes.DEFAULT_TYPE):
+    drifted = await inventory.check_counters()
+    for uid in drifted:
+        SCORE_CACHE.pop(uid, None)
+        RANK_CACHE.pop(uid, None)
+
+def _warm_card_points_sync() -> None:
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT id, pos, stats FROM cards")
+    for cid, pos, stats in c.fetchall():
+        get_card_points(cid, pos, stats)
+    conn.close()
+
+async def warm_up_catalog() -> None:
+    """Fill catalog caches, then build the rating boards from them."""
+    await asyncio.gather(
+        asyncio.to_thread(setup_score_points),
+        asyncio.to_thread(_warm_card_points_sync),
+        asyncio.to_thread(club_index),
+        asyncio.to_thread(file_ids),
+    )
+    await refresh_leaderboards(None)
 
 async def post_init(application: Application):
+    global _CACHE_LOOP
+    _CACHE_LOOP = asyncio.get_running_loop()
     bot_commands = [
         BotCommand("menu", "Главное меню"),
         BotCommand("card", "Получить карточку"),
@@ -2593,7 +2719,24 @@ async def post_init(application: Application):
         BotCommand("duel_list", "Кто ждёт дуэль"),
         BotCommand("invite", "Пригласить друга"),
     ]
-    await application.bot.set_my_commands(bot_commands)
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        application.bot.set_my_commands(bot_commands),
+        warm_up_catalog(),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning("Warm-up step failed: %s", result)
+    logging.info("Warm-up finished in %.2fs", time.perf_counter() - start)
+
+async def post_shutdown(application: Application):
+    # write what the periodic flush jobs have not picked up yet
+    for flush in (admin_audit.flush, USERNAMES.flush):
+        try:
+            await asyncio.to_thread(flush)
+        except Exception as e:
+            logging.warning("Shutdown flush failed: %s", e)
 
 
 def safe_polling(app):
@@ -2607,18 +2750,86 @@ def safe_polling(app):
             logging.exception("Unexpected error in polling:", exc_info=e)
             time.sleep(10)
 
-def main():
-    setup_db()
-    db.setup_battle_db()
-    db.setup_team_db()
-    application = (
+def setup_storage():
+    """Create or migrate every table the bot uses."""
+    STORE.setup()
+    # append new steps at the end; names of applied steps must not change
+    migrations.migrate(get_db, [
+        ("0001_users", setup_db),
+        ("0002_inventory_counters", inventory.setup_counters),
+        ("0003_collection_index", inventory.setup_collection_index),
+        ("0004_battles", db.setup_battle_db),
+        ("0005_teams", db.setup_team_db),
+        ("0006_weekly_scores", db.setup_weekly_db),
+        ("0007_xp_ledger", db.setup_xp_ledger),
+        ("0008_card_images", setup_image_cache),
+        ("0009_admin_audit", db.setup_admin_audit),
+    ])
+    admin_audit.open(get_db)
+
+
+def build_application(token: str = TOKEN, base_url: str | None = None) -> Application:
+    """Build the application with all jobs and handlers registered.
+
+    ``base_url`` points the bot at another Bot API server, e.g. the load
+    test stand-in from :mod:`loadtest.fake_api`.
+    """
+    builder = (
         Application.builder()
-        .token(TOKEN)
+        .token(token)
         .persistence(DictPersistence())
         .post_init(post_init)
-        .build()
+        .post_shutdown(post_shutdown)
     )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
     application.job_queue.run_repeating(cleanup_expired, interval=3600)
+    application.job_queue.run_repeating(
+        flush_admin_audit,
+        interval=ADMIN_AUDIT_FLUSH_INTERVAL,
+        first=ADMIN_AUDIT_FLUSH_INTERVAL,
+    )
+    application.job_queue.run_repeating(
+        flush_usernames,
+        interval=USERNAME_FLUSH_INTERVAL,
+        first=USERNAME_FLUSH_INTERVAL,
+    )
+    application.job_queue.run_repeating(
+        check_inventory_counters,
+        interval=INVENTORY_CHECK_INTERVAL,
+        first=INVENTORY_CHECK_INTERVAL,
+    )
+    # the first refill loads handlers in the background once polling runs
+    application.job_queue.run_repeating(
+        lazy_callback(handlers, "refill_opponent_pool"),
+        interval=POOL_REFILL_INTERVAL,
+        first=0,
+    )
+    application.job_queue.run_repeating(
+        lazy_callback(handlers, "matchmaking_tick"),
+        interval=PVP_MATCH_INTERVAL,
+    )
+    application.job_queue.run_repeating(
+        lazy_callback(handlers, "duel_deadline_tick"),
+        interval=DUEL_TICK_INTERVAL,
+    )
+    # boards are first built by post_init
+    application.job_queue.run_repeating(
+        refresh_leaderboards,
+        interval=LEADERBOARD_INTERVAL,
+        first=LEADERBOARD_INTERVAL,
+    )
+    if IMAGE_CACHE_CHAT_ID:
+        application.job_queue.run_repeating(
+            preload_card_images,
+            interval=IMAGE_PRELOAD_INTERVAL,
+            first=IMAGE_PRELOAD_INTERVAL,
+        )
+    # PTB counts days from Sunday: 1 is Monday 00:00 UTC
+    application.job_queue.run_daily(
+        weekly_rollover, time=datetime.time(0, 0, tzinfo=datetime.timezone.utc), days=(1,)
+    )
 
     # track user activity
     application.add_handler(
@@ -2637,6 +2848,8 @@ def main():
     application.add_handler(CommandHandler("logadmin", logadmin))
     application.add_handler(CommandHandler("admintop", admintop))
     application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("metrics", metrics_cmd))
+    application.add_handler(CommandHandler("queries", queries_cmd))
     application.add_handler(CommandHandler("whoonline", whoonline))
     application.add_handler(CommandHandler("deletecard", deletecard))
     application.add_handler(CommandHandler("giveallcards", giveallcards))
@@ -2649,33 +2862,38 @@ def main():
     application.add_handler(CommandHandler("collection", collection))
     application.add_handler(CallbackQueryHandler(collection_callback, pattern="^coll_"))
     application.add_handler(CallbackQueryHandler(trade_page_callback, pattern="^trade_page_(prev|next)$"))
-    application.add_handler(CommandHandler("rename_player", handlers.rename_player))
-    application.add_handler(CallbackQueryHandler(handlers.rename_select_callback, pattern="^rename_select:\d+$"))
-    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handlers.rename_player_text), group=5)
-    application.add_handler(CommandHandler("myteam", handlers.show_my_team))
+    application.add_handler(CommandHandler("rename_player", lazy_callback(handlers, "rename_player")))
+    application.add_handler(CallbackQueryHandler(lazy_callback(handlers, "rename_select_callback"), pattern="^rename_select:\d+$"))
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), lazy_callback(handlers, "rename_player_text")), group=5)
+    application.add_handler(CommandHandler("myteam", lazy_callback(handlers, "show_my_team")))
     application.add_handler(CallbackQueryHandler(check_subscribe_callback, pattern="^check_subscribe$"))
     application.add_handler(CommandHandler("invite", invite))
     application.add_handler(CommandHandler("rank", rank))
     application.add_handler(CallbackQueryHandler(rank_callback, pattern="^rank_"))
-    application.add_handler(CommandHandler("team", handlers.create_team))
-    application.add_handler(CallbackQueryHandler(handlers.team_callback, pattern="^team_"))
-    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handlers.team_text_handler))
+    application.add_handler(CommandHandler("team", lazy_callback(handlers, "create_team")))
+    application.add_handler(CallbackQueryHandler(lazy_callback(handlers, "team_callback"), pattern="^team_"))
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), lazy_callback(handlers, "team_text_handler")))
     application.add_handler(CallbackQueryHandler(admin_remove_callback, pattern="^remove_admin_\d+$"))
     application.add_handler(CallbackQueryHandler(open_team, pattern="^open_team$"))
-    application.add_handler(CommandHandler("fight", handlers.start_fight))
-    application.add_handler(CommandHandler("duel", handlers.start_duel))
-    application.add_handler(CommandHandler("duel_list", handlers.duel_list))
-    application.add_handler(CommandHandler("history", handlers.show_battle_history))
-    application.add_handler(CallbackQueryHandler(handlers.tactic_callback, pattern="^tactic_"))
-    application.add_handler(CallbackQueryHandler(handlers.battle_callback, pattern="^dir_"))
-    application.add_handler(CallbackQueryHandler(handlers.battle_callback, pattern="^battle_"))
-    application.add_handler(CallbackQueryHandler(handlers.duel_callback, pattern="^(challenge_\\d+|duel_cancel)$"))
-
-
-
+    application.add_handler(CommandHandler("fight", lazy_callback(handlers, "start_fight")))
+    application.add_handler(CommandHandler("duel", lazy_callback(handlers, "start_duel")))
+    application.add_handler(CommandHandler("duel_list", lazy_callback(handlers, "duel_list")))
+    application.add_handler(CommandHandler("history", lazy_callback(handlers, "show_battle_history")))
+    application.add_handler(CallbackQueryHandler(lazy_callback(handlers, "tactic_callback"), pattern="^tactic_"))
+    application.add_handler(CallbackQueryHandler(lazy_callback(handlers, "battle_callback"), pattern="^dir_"))
+    application.add_handler(CallbackQueryHandler(lazy_callback(handlers, "battle_callback"), pattern="^battle_"))
+    application.add_handler(CallbackQueryHandler(lazy_callback(handlers, "duel_callback"), pattern="^(challenge_\\d+|duel_cancel)$"))
 
+    # must run after the last add_handler call
+    metrics.instrument_application(application)
+    return application
 
 
+def main():
+    setup_storage()
+    application = build_application()
+    if metrics.ENABLED and os.getenv("METRICS_PORT"):
+        metrics.start_http_server(int(os.getenv("METRICS_PORT")))
     safe_polling(application)
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
-from typing import Optional, Dict
+import time
+from typing import Optional, Dict, List, Tuple
 import db_pg as db
 
 CARD_FIELDS = [
@@ -16,6 +17,15 @@ CARD_FIELDS = [
     "team_ru",
 ]
 
+# order of rarities on collection screens
+RARITY_ORDER = {
+    "legendary": 0,
+    "mythic": 1,
+    "epic": 2,
+    "rare": 3,
+    "common": 4,
+}
+
 def get_card(card_id: int) -> Optional[Dict]:
     """Fetch card data directly from the database."""
     conn = db.get_db()
@@ -29,3 +39,141 @@ def get_card(card_id: int) -> Optional[Dict]:
     if row:
         return dict(zip(CARD_FIELDS, row))
     return None
+
+
+# (sorted club keys, {club: cards in catalog}); built on first use
+_CLUB_INDEX: Optional[Tuple[List[str], Dict[str, int]]] = None
+
+
+def club_index() -> Tuple[List[str], Dict[str, int]]:
+    """Return all clubs and their catalog sizes, read once per process.
+
+    The club of a card is ``team_en`` or, when empty, ``team_ru`` – the
+    same key the per-user counters in :mod:`inventory` use.
+    """
+    global _CLUB_INDEX
+    if _CLUB_INDEX is None:
+        conn = db.get_db()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT COALESCE(NULLIF(team_en, ''), team_ru) AS club, COUNT(*) FROM cards "
+            "GROUP BY COALESCE(NULLIF(team_en, ''), team_ru)"
+        )
+        totals = {club: cnt for club, cnt in cur.fetchall() if club}
+        conn.close()
+        _CLUB_INDEX = (sorted(totals), totals)
+    return _CLUB_INDEX
+
+
+def reset_club_index() -> None:
+    """Forget the club index after the card catalog changed."""
+    global _CLUB_INDEX
+    _CLUB_INDEX = None
+
+
+def setup_image_cache() -> None:
+    """Add ``cards.tg_file_id``, ``cards.img_dead`` and ``cards.img_failed_at``."""
+    conn = db.get_db()
+    for stmt in (
+        "ALTER TABLE cards ADD COLUMN tg_file_id TEXT",
+        "ALTER TABLE cards ADD COLUMN img_dead INTEGER DEFAULT 0",
+        "ALTER TABLE cards ADD COLUMN img_failed_at BIGINT",
+    ):
+        try:
+            conn.execute(stmt)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+    conn.close()
+
+
+# {card id: Telegram file_id of its photo}; read once per process
+_FILE_IDS: Optional[Dict[int, str]] = None
+
+
+def file_ids() -> Dict[int, str]:
+    """Return the cached photo file ids, loading them on first use."""
+    global _FILE_IDS
+    if _FILE_IDS is None:
+        conn = db.get_db()
+        cur = conn.cursor()
+        cur.execute("SELECT id, tg_file_id FROM cards WHERE tg_file_id IS NOT NULL")
+        loaded = dict(cur.fetchall())
+        conn.close()
+        _FILE_IDS = loaded
+    return _FILE_IDS
+
+
+def card_photo(card: Dict) -> str:
+    """Return what to pass to ``send_photo``: the file id once known, else the URL."""
+    return file_ids().get(card.get("id")) or card.get("img", "")
+
+
+def remember_file_id(card_id: int, file_id: str) -> None:
+    """Store the file id Telegram returned for the first upload of a card.
+
+    A successful upload also clears a dead-image flag.
+    """
+    if file_ids().get(card_id) == file_id:
+        return
+    _FILE_IDS[card_id] = file_id
+    conn = db.get_db()
+    conn.execute(
+        "UPDATE cards SET tg_file_id=?, img_dead=0, img_failed_at=NULL WHERE id=?",
+        (file_id, card_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def forget_file_id(card_id: int) -> None:
+    """Drop a file id Telegram no longer accepts; the URL is used again."""
+    if file_ids().pop(card_id, None) is None:
+        return
+    conn = db.get_db()
+    conn.execute("UPDATE cards SET tg_file_id=NULL WHERE id=?", (card_id,))
+    conn.commit()
+    conn.close()
+
+
+def mark_image_dead(card_id: int, now: int | None = None) -> None:
+    """Flag a card whose image URL Telegram cannot fetch, noting when.
+
+    The flag is not final: :func:`dead_images_due` offers the card for
+    another upload once a cool-down has passed.
+    """
+    file_ids().pop(card_id, None)
+    now = int(time.time()) if now is None else now
+    conn = db.get_db()
+    conn.execute("UPDATE cards SET img_dead=1, img_failed_at=?, tg_file_id=NULL WHERE id=?", (now, card_id))
+    conn.commit()
+    conn.close()
+
+
+def cards_without_file_id(limit: int) -> List[Tuple[int, str]]:
+    """Return up to ``limit`` ``(id, img)`` of live images not uploaded yet."""
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id, img FROM cards WHERE tg_file_id IS NULL AND COALESCE(img_dead, 0) = 0 "
+        "AND img != '' AND img IS NOT NULL ORDER BY id LIMIT ?",
+        (limit,),
+    )
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def dead_images_due(cooldown: int, limit: int, now: int | None = None) -> List[Tuple[int, str]]:
+    """Return up to ``limit`` ``(id, img)`` of dead images that failed over ``cooldown`` seconds ago."""
+    now = int(time.time()) if now is None else now
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id, img FROM cards WHERE img_dead = 1 AND COALESCE(img_failed_at, 0) <= ? "
+        "AND img != '' AND img IS NOT NULL ORDER BY img_failed_at, id LIMIT ?",
+        (now - cooldown, limit),
+    )
+    rows = cur.fetchall()
+    conn.close()
+    return rows
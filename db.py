@@ -1,6 +1,9 @@
 import sqlite3
 import json
 import os
+import time
+
+from helpers.leveling import level_from_xp
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'botdb.sqlite')
 
@@ -24,6 +27,26 @@ def _ensure_user_columns(conn):
         cur.execute("ALTER TABLE users ADD COLUMN win_streak INTEGER DEFAULT 0")
     conn.commit()
 
+# physical row id used to delete one of several identical rows
+ROW_ID = "rowid"
+
+# SQLite has no row locks; begin_write() takes the database write lock instead
+FOR_UPDATE = ""
+
+
+def begin_write(conn) -> None:
+    """Start a transaction that holds the write lock until commit."""
+    conn.execute("BEGIN IMMEDIATE")
+
+
+def in_clause(column: str, values) -> tuple[str, tuple]:
+    """Return a ``column IN (...)`` fragment and its params."""
+    values = tuple(values)
+    if not values:
+        return "0", ()
+    return f"{column} IN ({', '.join('?' for _ in values)})", values
+
+
 def setup_battle_db():
     conn = get_db()
     conn.execute(
@@ -182,6 +205,10 @@ def team_name_taken(name: str, exclude_user_id: int) -> bool:
     return row is not None
 
 
+# ``xp_daily`` belongs to the day in ``last_xp_reset``; older values count as 0
+_DAILY_XP = "(CASE WHEN last_xp_reset = CURRENT_DATE THEN COALESCE(xp_daily, 0) ELSE 0 END)"
+
+
 def get_xp_level(uid: int):
     conn = get_db()
     cur = conn.cursor()
@@ -203,28 +230,97 @@ def update_xp(uid: int, xp: int, level: int, delta: int):
     conn = get_db()
     try:
         conn.execute(
-            "UPDATE users SET xp=?, level=?, xp_daily = xp_daily + ?, last_xp_reset=last_xp_reset WHERE id=?",
+            f"UPDATE users SET xp=?, level=?, xp_daily = {_DAILY_XP} + ?, last_xp_reset=CURRENT_DATE WHERE id=?",
             (xp, level, delta, uid),
         )
     except sqlite3.OperationalError:
         _ensure_user_columns(conn)
         conn.execute(
-            "UPDATE users SET xp=?, level=?, xp_daily = xp_daily + ?, last_xp_reset=last_xp_reset WHERE id=?",
+            f"UPDATE users SET xp=?, level=?, xp_daily = {_DAILY_XP} + ?, last_xp_reset=CURRENT_DATE WHERE id=?",
             (xp, level, delta, uid),
         )
     conn.commit()
     conn.close()
 
 
-def reset_daily_xp():
+def get_daily_xp(uid: int) -> int:
+    """Return XP earned today; a value from an earlier day reads as zero."""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(f"SELECT {_DAILY_XP} FROM users WHERE id=?", (uid,))
+    row = cur.fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+
+def setup_xp_ledger():
+    """Create the per-day, per-source XP ledger used for caps and anti-farm."""
     conn = get_db()
     conn.execute(
-        "UPDATE users SET xp_daily=0, last_xp_reset=DATE('now') WHERE last_xp_reset < DATE('now')"
+        '''
+        CREATE TABLE IF NOT EXISTS xp_ledger (
+            user_id BIGINT NOT NULL,
+            day DATE NOT NULL,
+            source TEXT NOT NULL,
+            xp INTEGER NOT NULL DEFAULT 0,
+            events INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, source)
+        )
+        '''
     )
     conn.commit()
     conn.close()
 
 
+def setup_admin_audit():
+    """Create the append-only admin command log and its per-admin counters."""
+    conn = get_db()
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS admin_audit (
+            ts BIGINT NOT NULL,
+            admin_id BIGINT NOT NULL,
+            command TEXT NOT NULL
+        )
+        '''
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_admin_audit_admin ON admin_audit (admin_id, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_admin_audit_command ON admin_audit (command, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_admin_audit_ts ON admin_audit (ts)")
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS admin_audit_counts (
+            admin_id BIGINT NOT NULL,
+            command TEXT NOT NULL,
+            calls BIGINT NOT NULL DEFAULT 0,
+            last_ts BIGINT,
+            PRIMARY KEY (admin_id, command)
+        )
+        '''
+    )
+    conn.commit()
+    conn.close()
+
+
+def get_xp_earned(uid: int, since, source: str | None = None):
+    """Return ``(xp, events)`` logged for ``uid`` from day ``since`` on.
+
+    ``since`` is a ``date``; daily, weekly and seasonal caps differ only in
+    how far back it points.
+    """
+    sql = "SELECT COALESCE(SUM(xp), 0), COALESCE(SUM(events), 0) FROM xp_ledger WHERE user_id=? AND day >= ?"
+    params = [uid, since.isoformat()]
+    if source is not None:
+        sql += " AND source=?"
+        params.append(source)
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    row = cur.fetchone()
+    conn.close()
+    return row[0], row[1]
+
+
 def get_win_streak(uid: int) -> int:
     conn = get_db()
     cur = conn.cursor()
@@ -247,6 +343,198 @@ def update_win_streak(uid: int, won: bool):
     return streak
 
 
+def _streak_gain_sql(won, gains):
+    """Return a ``CASE`` picking ``gains[new_streak]`` and its params.
+
+    ``gains`` lists the XP gain for every new win streak up to its last
+    index, which also covers longer streaks.
+    """
+    if not won:
+        return "?", [gains[0]]
+    parts = ["CASE"]
+    params = []
+    for streak in range(len(gains) - 1, 1, -1):
+        parts.append("WHEN COALESCE(win_streak, 0) + 1 >= ? THEN ?")
+        params.extend((streak, gains[streak]))
+    parts.append("ELSE ? END")
+    params.append(gains[1])
+    return " ".join(parts), params
+
+
+def settle_battle(players, battle=None, source=None):
+    """Apply battle results for all ``players`` in one transaction.
+
+    ``players`` is a list of ``(uid, won, gains)`` where ``gains`` is the XP
+    table indexed by the new win streak.  Streak, XP, daily XP and level are
+    updated with one ``UPDATE ... RETURNING`` per player, so concurrent
+    matches never overwrite each other.  ``battle`` is an optional
+    ``(user_id, opponent_name, result)`` row for the ``battles`` table.
+    With a ``source`` every gain is also added to today's ``xp_ledger`` row.
+
+    Returns a list of ``(uid, xp_gain, xp, level, old_level)`` tuples.
+    """
+    conn = get_db()
+    cur = conn.cursor()
+    if battle is not None:
+        user_id, opponent_name, result = battle
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS battles (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                opponent TEXT,
+                result TEXT,
+                score_team1 INTEGER,
+                score_team2 INTEGER,
+                mvp TEXT,
+                log TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cur.execute(
+            '''
+            INSERT INTO battles (user_id, opponent, result, score_team1, score_team2, mvp, log)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''',
+            (
+                user_id,
+                opponent_name,
+                result["winner"],
+                result["score"]["team1"],
+                result["score"]["team2"],
+                result["mvp"],
+                json.dumps(result["log"]),
+            ),
+        )
+    settled = []
+    for uid, won, gains in players:
+        gain_sql, gain_params = _streak_gain_sql(won, gains)
+        streak_sql = "COALESCE(win_streak, 0) + 1" if won else "0"
+        cur.execute(
+            f'''
+            UPDATE users SET
+                win_streak = {streak_sql},
+                xp = COALESCE(xp, 0) + {gain_sql},
+                xp_daily = {_DAILY_XP} + {gain_sql},
+                last_xp_reset = CURRENT_DATE
+            WHERE id=?
+            RETURNING xp, COALESCE(level, 1), win_streak
+            ''',
+            gain_params + gain_params + [uid],
+        )
+        row = cur.fetchone()
+        if not row:
+            continue
+        xp, old_level, streak = row
+        gain = gains[min(streak, len(gains) - 1)]
+        level = max(old_level, level_from_xp(xp))
+        if level != old_level:
+            cur.execute("UPDATE users SET level=? WHERE id=?", (level, uid))
+        if source is not None:
+            cur.execute(
+                "INSERT INTO xp_ledger (user_id, day, source, xp, events) VALUES (?, CURRENT_DATE, ?, ?, 1) "
+                "ON CONFLICT (user_id, day, source) DO UPDATE SET "
+                "xp = xp_ledger.xp + EXCLUDED.xp, events = xp_ledger.events + 1",
+                (uid, source, gain),
+            )
+        settled.append((uid, gain, xp, level, old_level))
+    conn.commit()
+    conn.close()
+    return settled
+
+
+def setup_weekly_db():
+    """Add ``cards.score_points``, the ``weekly_scores`` history and closed weeks."""
+    conn = get_db()
+    try:
+        conn.execute("ALTER TABLE cards ADD COLUMN score_points REAL")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS weekly_scores (
+            week TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            score REAL NOT NULL,
+            delta REAL NOT NULL,
+            PRIMARY KEY (week, user_id)
+        )
+        '''
+    )
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS weekly_rollovers (
+            week TEXT PRIMARY KEY,
+            closed_at BIGINT NOT NULL
+        )
+        '''
+    )
+    conn.commit()
+    conn.close()
+
+
+# every user's collection score next to the baseline of the running week
+_USER_SCORES = """
+    SELECT u.id AS user_id,
+           COALESCE(SUM(uc.count * c.score_points), 0) AS score,
+           COALESCE(u.last_week_score, 0) AS last
+      FROM users u
+      LEFT JOIN user_cards uc ON uc.user_id = u.id
+      LEFT JOIN cards c ON c.id = uc.card_id
+  GROUP BY u.id, u.last_week_score
+"""
+
+
+def rollover_weekly_scores(week: str) -> int:
+    """Close ``week``: store every user's score and delta, reset baselines.
+
+    Everything runs in one transaction that first claims ``week`` in
+    ``weekly_rollovers``; a week that is already claimed, also by a
+    concurrent worker, is skipped.  Baselines are reset from the stored
+    snapshot, so the scores are aggregated once.  Returns the number of
+    users snapshotted.
+    """
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO weekly_rollovers (week, closed_at) VALUES (?, ?) ON CONFLICT (week) DO NOTHING",
+        (week, int(time.time())),
+    )
+    if cur.rowcount != 1:
+        conn.rollback()
+        conn.close()
+        return 0
+    cur.execute(
+        "INSERT INTO weekly_scores (week, user_id, score, delta) "
+        f"SELECT ?, user_id, score, score - last FROM ({_USER_SCORES}) s",
+        (week,),
+    )
+    count = cur.rowcount
+    cur.execute(
+        "UPDATE users SET last_week_score = CAST(ROUND(w.score) AS INTEGER) "
+        "FROM weekly_scores w WHERE w.week = ? AND users.id = w.user_id",
+        (week,),
+    )
+    conn.commit()
+    conn.close()
+    return count
+
+
+def get_weekly_history(uid: int, weeks: int = 8):
+    """Return the latest ``(week, score, delta)`` rows, newest first."""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT week, score, delta FROM weekly_scores WHERE user_id=? ORDER BY week DESC LIMIT ?",
+        (uid, weeks),
+    )
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
 def get_all_players(limit: int = 20):
     """Return a list of player ``(id, name)`` tuples ordered by name."""
     conn = get_db()
@@ -1,8 +1,8 @@
-from collections import OrderedDict
 import random
 import asyncio
 import re
 import time
+import uuid
 import logging
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
@@ -10,8 +10,13 @@ from telegram.error import Forbidden
 from helpers.permissions import admin_only, is_admin
 from battle import BattleSession, BattleController, POSITION_EMOJI
 import db_pg as db
-from helpers.leveling import level_from_xp, xp_to_next, calc_battle_xp
+import inventory
+from helpers.leveling import xp_to_next, calc_battle_xp
 from helpers.commentary import format_period_summary, format_final_summary
+from helpers.opponent_pool import OpponentPool
+from helpers.matchmaking import MatchmakingQueue
+from helpers.state_store import STORE
+from helpers.deadlines import DeadlineScheduler
 
 
 async def _safe_send_message(bot, chat_id: int, text: str, **kwargs) -> None:
@@ -27,21 +32,7 @@ level_up_msg = "🆙 *Новый уровень!*  Ты достиг Lv {lvl}.\n
 
 
 async def grant_level_reward(uid: int, lvl: int, context: ContextTypes.DEFAULT_TYPE):
-    conn = db.get_db()
-    cur = conn.cursor()
-    cards = []
-    count = random.randint(1, 3)
-    for _ in range(count):
-        card = await get_random_card()
-        if not card:
-            continue
-        cur.execute(
-            "INSERT INTO inventory (user_id, card_id, time_got) VALUES (?, ?, EXTRACT(EPOCH FROM NOW())::bigint)",
-            (uid, card["id"]),
-        )
-        cards.append(card)
-    conn.commit()
-    conn.close()
+    cards = await inventory.grant_random_cards(uid, random.randint(1, 3))
 
     reward_lines = [f"{RARITY_EMOJI.get(c.get('rarity','common'), '')} {c['name']}" for c in cards]
     reward_text = "\n".join(reward_lines) if reward_lines else "карты не выданы"
@@ -52,19 +43,45 @@ async def grant_level_reward(uid: int, lvl: int, context: ContextTypes.DEFAULT_T
     )
 
 
+# ``calc_battle_xp`` no longer depends on the streak past this value
+XP_STREAK_CAP = 10
+
+
+def _xp_table(result: dict, opponent_is_bot: bool) -> list[int]:
+    """Return XP gains for ``result`` indexed by the new win streak."""
+    gap = result.get("str_gap", 0.0)
+    return [
+        calc_battle_xp(result, is_pve=opponent_is_bot, streak=streak, strength_gap=gap)
+        for streak in range(XP_STREAK_CAP + 1)
+    ]
+
+
+async def settle_match(outcomes, context: ContextTypes.DEFAULT_TYPE, battle=None):
+    """Award XP for ``(uid, result, opponent_is_bot)`` outcomes in one transaction.
+
+    ``battle`` is an optional ``(user_id, opponent_name, result)`` row saved
+    in the same transaction; gains are logged in ``xp_ledger``.  Returns ``(xp_gain, level, leveled_up)`` for
+    every outcome.
+    """
+    players = [(uid, res.get("winner") == "team1", _xp_table(res, is_bot)) for uid, res, is_bot in outcomes]
+    source = "pve" if all(is_bot for _, _, is_bot in outcomes) else "pvp"
+    settled = await asyncio.to_thread(db.settle_battle, players, battle, source)
+    rows = {row[0]: row for row in settled}
+    summary = []
+    for uid, _, _ in outcomes:
+        _, xp_gain, _, new_lvl, old_lvl = rows.get(uid, (uid, 0, 0, 1, 1))
+        leveled_up = new_lvl > old_lvl
+        if leveled_up:
+            await grant_level_reward(uid, new_lvl, context)
+        if xp_gain:
+            await context.bot.send_message(uid, f"➕ +{xp_gain} XP", parse_mode="Markdown")
+        summary.append((xp_gain, new_lvl, leveled_up))
+    return summary
+
+
 async def apply_xp(uid: int, result: dict, opponent_is_bot: bool, context: ContextTypes.DEFAULT_TYPE):
-    streak = db.update_win_streak(uid, result.get("winner") == "team1")
-    xp_gain = calc_battle_xp(result, is_pve=opponent_is_bot, streak=streak, strength_gap=result.get("str_gap", 0.0))
-    old_xp, old_lvl = db.get_xp_level(uid)
-    new_xp = old_xp + xp_gain
-    new_lvl = level_from_xp(new_xp)
-    db.update_xp(uid, new_xp, new_lvl, xp_gain)
-    leveled_up = new_lvl > old_lvl
-    if leveled_up:
-        await grant_level_reward(uid, new_lvl, context)
-    if xp_gain:
-        await context.bot.send_message(uid, f"➕ +{xp_gain} XP", parse_mode="Markdown")
-    return xp_gain, new_lvl, leveled_up
+    (summary,) = await settle_match([(uid, result, opponent_is_bot)], context)
+    return summary
 
 
 def _parse_points(stats: str | None, pos: str | None) -> float:
@@ -160,12 +177,27 @@ async def get_user_cards(user_id):
 
 # TTL for entries in PVP queue, seconds
 PVP_TTL = 600
-PVP_QUEUE = OrderedDict()
+PVP_QUEUE = MatchmakingQueue()
 
+# abandoned duels are dropped from the state store after this many seconds
+DUEL_TTL = 6 * 3600
 # Active PvP duels mapped by a tuple of user ids
-ACTIVE_DUELS: dict[tuple[int, int], dict] = {}
+ACTIVE_DUELS = STORE.namespace("duels", ttl=DUEL_TTL)
 # Map user id to current duel key
-DUEL_USERS: dict[int, tuple[int, int]] = {}
+DUEL_USERS = STORE.namespace("duel_users", ttl=DUEL_TTL)
+# seconds a player has to pick a tactic before the default is used
+DUEL_PHASE_TIMEOUT = 90
+DUEL_DEFAULT_TACTIC = "balanced"
+# local wake-up hints; the authoritative phase deadline is ``state["deadline"]``
+DUEL_DEADLINES = DeadlineScheduler()
+# seconds between scans of the stored duels for deadlines with no local hint
+DUEL_RESCAN_INTERVAL = 60
+_DUEL_SCANNED_AT = 0.0
+
+# Pre-built bot rosters for PvE, refilled by ``refill_opponent_pool``
+OPPONENT_POOL = OpponentPool()
+POOL_CATALOG_TTL = 3600  # seconds
+_POOL_LOADED_AT = 0.0
 
 TACTICS = {
     "tactic_aggressive": "aggressive",
@@ -265,7 +297,7 @@ async def show_my_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not team:
         await update.message.reply_text("Команда не создана. Используй /team")
         return
-    cards = {c["id"]: c for c in await get_user_cards(user_id)}
+    cards, _, _ = await load_team_cards(user_id, team.get("lineup", []) + team.get("bench", []))
     lineup = [cards[cid] for cid in team.get("lineup", []) if cid in cards]
     bench = [cards[cid] for cid in team.get("bench", []) if cid in cards]
 
@@ -364,7 +396,11 @@ async def send_team_page(chat_id, user_id, context, edit=False, message_id=None)
     tb = context.user_data.get("team_build", {})
     step = tb.get("step")
     page = tb.get("page", 0)
-    cards = {c["id"]: c for c in await get_user_cards(user_id)}
+    cards = tb.get("cards")
+    if cards is None:
+        # loaded once per builder session, dropped together with ``team_build``
+        cards = {c["id"]: c for c in await get_user_cards(user_id)}
+        tb["cards"] = cards
 
     if not cards:
         await context.bot.send_message(
@@ -562,7 +598,7 @@ async def team_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начать интерактивный бой против бота."""
     from helpers.admin_utils import banned_users
-    if update.effective_user.id in banned_users:
+    if await banned_users.acontains(update.effective_user.id):
         await update.message.reply_text("🚫 Вы заблокированы в боте.")
         return
     context.user_data["fight_mode"] = "pve"
@@ -570,7 +606,7 @@ async def start_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     team_data = db.get_team(user_id)
     team_name = team_data["name"] if team_data else "Team1"
     team1 = await _build_team(user_id, team_data["lineup"] if team_data else None)
-    team2 = await _build_team(0)
+    team2 = await _pick_bot_team(team1)
     session = BattleSession(team1, team2, name1=team_name, name2="Bot")
     controller = BattleController(session)
     context.user_data["battle_state"] = {"controller": controller}
@@ -587,7 +623,7 @@ async def start_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_duel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Join PvP queue without tactic selection."""
     from helpers.admin_utils import banned_users
-    if update.effective_user.id in banned_users:
+    if await banned_users.acontains(update.effective_user.id):
         await update.message.reply_text("🚫 Вы заблокированы в боте.")
         return
     context.user_data["fight_mode"] = "pvp"
@@ -599,109 +635,241 @@ async def start_duel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     team_data = db.get_team(user_id)
     team_name = team_data["name"] if team_data else "Team1"
     team = await _build_team(user_id, team_data["lineup"] if team_data else None)
+    await _join_pvp_queue(user, team, team_name, tactic, context, update.message.reply_text)
+
+async def duel_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    opponents = PVP_QUEUE.nearby(user_id)
+    if not opponents:
+        await update.message.reply_text("Никто не ожидает дуэли.")
+        return
+    buttons = [[InlineKeyboardButton(data.get("username", str(uid)), callback_data=f"challenge_{uid}")] for uid, data in opponents]
+    buttons.append([InlineKeyboardButton("❌ Отмена", callback_data="duel_cancel")])
+    await update.message.reply_text("Выбери соперника:", reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _team_rating(team: list[dict]) -> float:
+    """Matchmaking rating: average card points with the owner level bonus."""
+    if not team:
+        return 0.0
+    avg = sum(p.get("points", 0) for p in team) / len(team)
+    level = team[0].get("owner_level", 1)
+    return avg * (1 + (level // 5) * 0.02)
+
+
+def _pvp_job_name(uid: int) -> str:
+    return f"pvp_ttl_{uid}"
+
+
+def _schedule_pvp_expiry(context: ContextTypes.DEFAULT_TYPE, uid: int) -> None:
+    job_queue = getattr(context, "job_queue", None)
+    if job_queue is None:
+        return
+    _cancel_pvp_expiry(context, uid)
+    job_queue.run_once(_expire_pvp_entry, PVP_TTL, data=uid, name=_pvp_job_name(uid))
+
+
+def _cancel_pvp_expiry(context: ContextTypes.DEFAULT_TYPE, uid: int) -> None:
+    job_queue = getattr(context, "job_queue", None)
+    if job_queue is None:
+        return
+    for job in job_queue.get_jobs_by_name(_pvp_job_name(uid)):
+        job.schedule_removal()
+
+
+async def _expire_pvp_entry(context: ContextTypes.DEFAULT_TYPE):
+    """Job: drop a queue entry whose TTL has passed."""
+    uid = context.job.data
+    if PVP_QUEUE.pop(uid, None) is None:
+        return
+    PVP_QUEUE.expired += 1
+    await _safe_send_message(context.bot, uid, "⌛️ Соперник не найден, поиск дуэли остановлен.")
 
+
+async def _join_pvp_queue(user, team, team_name, tactic, context, reply) -> None:
+    """Queue ``user`` for PvP and start a duel if a close opponent waits."""
+    user_id = user.id
     existing = PVP_QUEUE.get(user_id)
     if existing and existing.get("reserved"):
-        await update.message.reply_text("Ожидание соперника...")
+        await reply("Ожидание соперника...")
         return
-
-    entry = {
+    PVP_QUEUE.add(user_id, {
         "team": team,
         "tactic": tactic,
         "name": team_name,
         "username": user.username or str(user_id),
         "reserved": True,
         "created": time.time(),
+        "rating": _team_rating(team),
+    })
+    match = PVP_QUEUE.match(user_id)
+    if match:
+        opp_id, opp_data, _ = match
+        _cancel_pvp_expiry(context, opp_id)
+        await _start_pvp_duel(user_id, opp_id, team, opp_data["team"], team_name, opp_data["name"], context)
+        return
+    _schedule_pvp_expiry(context, user_id)
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отменить", callback_data="duel_cancel")]])
+    await reply("Ждём второго игрока...", reply_markup=markup)
+
+
+async def matchmaking_tick(context: ContextTypes.DEFAULT_TYPE):
+    """Job: retry pairing waiting players as their rating window widens."""
+    now = time.time()
+    for uid in PVP_QUEUE.keys():
+        if uid not in PVP_QUEUE:
+            continue
+        match = PVP_QUEUE.match(uid, now)
+        if not match:
+            continue
+        opp_id, opp_data, my_data = match
+        _cancel_pvp_expiry(context, uid)
+        _cancel_pvp_expiry(context, opp_id)
+        await _start_pvp_duel(
+            uid,
+            opp_id,
+            my_data["team"],
+            opp_data["team"],
+            my_data["name"],
+            opp_data["name"],
+            context,
+        )
+
+
+def _team_entry(card: dict, level: int) -> dict:
+    """Convert a card row into a battle roster entry."""
+    return {
+        "id": card["id"],
+        "name": card["name"],
+        "pos": card.get("pos", ""),
+        "country": card.get("country", ""),
+        "born": str(card.get("born", "")),
+        "weight": str(card.get("weight", "")),
+        "rarity": card.get("rarity", "common"),
+        "points": float(card.get("points", 50)),
+        "owner_level": level,
     }
-    PVP_QUEUE[user_id] = entry
 
-    opponents = [(uid, data) for uid, data in PVP_QUEUE.items() if uid != user_id]
-    if not opponents:
-        markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отменить", callback_data="duel_cancel")]])
-        await update.message.reply_text("Ждём второго игрока...", reply_markup=markup)
-    elif len(opponents) == 1:
-        opp_id, opp_data = opponents[0]
-        PVP_QUEUE.pop(opp_id, None)
-        PVP_QUEUE.pop(user_id, None)
-        await _start_pvp_duel(user_id, opp_id, team, opp_data["team"], team_name, opp_data["name"], context)
-    else:
-        buttons = [
-            [InlineKeyboardButton(data.get("username", str(uid)), callback_data=f"challenge_{uid}")]
-            for uid, data in opponents
-        ]
-        buttons.append([InlineKeyboardButton("❌ Отменить", callback_data="duel_cancel")])
-        await update.message.reply_text("Выбери соперника:", reply_markup=InlineKeyboardMarkup(buttons))
 
-async def duel_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    opponents = [(uid, data) for uid, data in PVP_QUEUE.items() if uid != user_id]
-    if not opponents:
-        await update.message.reply_text("Никто не ожидает дуэли.")
-        return
-    buttons = [[InlineKeyboardButton(data.get("username", str(uid)), callback_data=f"challenge_{uid}")] for uid, data in opponents]
-    buttons.append([InlineKeyboardButton("❌ Отмена", callback_data="duel_cancel")])
-    await update.message.reply_text("Выбери соперника:", reply_markup=InlineKeyboardMarkup(buttons))
+_CARD_COLUMNS = (
+    "cards.id, cards.name, cards.pos, cards.country, cards.born, cards.weight, "
+    "cards.rarity, cards.stats, cards.team_en, cards.team_ru"
+)
+_CARD_KEYS = ["id", "name", "pos", "country", "born", "weight", "rarity", "stats", "team_en", "team_ru"]
+
+
+def _load_team_sync(user_id, ids, fill=0):
+    """Fetch owned cards ``ids`` plus ``fill`` random owned extras in one query.
+
+    Returns ``(chosen, extras, level)`` where ``chosen`` maps card id to card.
+    """
+    ids = [cid for cid in ids or [] if cid]
+    clause, params = db.in_clause("cards.id", ids)
+    query = (
+        f"SELECT picked.* FROM (SELECT {_CARD_COLUMNS}, 1 AS chosen FROM cards "
+        f"WHERE {clause} AND EXISTS (SELECT 1 FROM inventory "
+        "WHERE inventory.user_id = ? AND inventory.card_id = cards.id)) AS picked"
+    )
+    params = (*params, user_id)
+    if fill:
+        query += (
+            f" UNION ALL SELECT extra.* FROM (SELECT {_CARD_COLUMNS}, 0 AS chosen "
+            "FROM inventory JOIN cards ON inventory.card_id = cards.id "
+            "WHERE inventory.user_id = ? ORDER BY RANDOM() LIMIT ?) AS extra"
+        )
+        params = (*params, user_id, fill + len(ids))
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(query, params)
+    rows = cur.fetchall()
+    cur.execute("SELECT level FROM users WHERE id=?", (user_id,))
+    row = cur.fetchone()
+    conn.close()
+
+    chosen: dict[int, dict] = {}
+    extras: dict[int, dict] = {}
+    for row_ in rows:
+        card = dict(zip(_CARD_KEYS, row_[:-1]))
+        card["points"] = _parse_points(card["stats"], card["pos"])
+        (chosen if row_[-1] else extras)[card["id"]] = card
+    level = row[0] if row and row[0] is not None else 1
+    return chosen, [c for cid, c in extras.items() if cid not in chosen], level
+
+
+async def load_team_cards(user_id, ids, fill=0):
+    return await asyncio.to_thread(_load_team_sync, user_id, ids, fill)
+
 
 async def _build_team(user_id, ids=None):
-    cards = await get_user_cards(user_id)
-    level = db.get_xp_level(user_id)[1] if user_id else 1
-    team = []
-    if ids:
-        id_set = list(ids)
-        for cid in id_set:
-            card = next((c for c in cards if c["id"] == cid), None)
-            if card:
-                team.append({
-                    "id": card["id"],
-                    "name": card["name"],
-                    "pos": card.get("pos", ""),
-                    "country": card.get("country", ""),
-                    "born": str(card.get("born", "")),
-                    "weight": str(card.get("weight", "")),
-                    "rarity": card.get("rarity", "common"),
-                    "points": float(card.get("points", 50)),
-                    "owner_level": level,
-                })
-        cards = [c for c in cards if c["id"] not in id_set]
-    random.shuffle(cards)
-    for card in cards[: max(0, 6 - len(team))]:
-        team.append({
-            "id": card["id"],
-            "name": card["name"],
-            "pos": card.get("pos", ""),
-            "country": card.get("country", ""),
-            "born": str(card.get("born", "")),
-            "weight": str(card.get("weight", "")),
-            "rarity": card.get("rarity", "common"),
-            "points": float(card.get("points", 50)),
-            "owner_level": level,
-        })
+    ids = list(ids or [])
+    if user_id:
+        # lineup cards may have been traded away: extras cover them too
+        chosen, extras, level = await load_team_cards(user_id, ids, 6)
+    else:
+        chosen, extras, level = {}, [], 1
+    team = [_team_entry(chosen[cid], level) for cid in ids if cid in chosen]
+    for card in extras[: max(0, 6 - len(team))]:
+        team.append(_team_entry(card, level))
     # если нет карт, добавляем случайные
     while len(team) < 6:
         card = await get_random_card()
-        team.append({
-            "id": card["id"],
-            "name": card["name"],
-            "pos": card.get("pos", ""),
-            "country": card.get("country", ""),
-            "born": str(card.get("born", "")),
-            "weight": str(card.get("weight", "")),
-            "rarity": card.get("rarity", "common"),
-            "points": float(card.get("points", 50)),
-            "owner_level": level,
-        })
+        team.append(_team_entry(card, level))
     return team
 
 
+def _get_catalog_sync():
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id, name, pos, country, born, weight, rarity, stats, team_en, team_ru FROM cards"
+    )
+    rows = cur.fetchall()
+    conn.close()
+    fields = ["id", "name", "pos", "country", "born", "weight", "rarity", "stats", "team_en", "team_ru"]
+    entries = []
+    for row in rows:
+        card = dict(zip(fields, row))
+        card["points"] = _parse_points(card["stats"], card["pos"])
+        entries.append(_team_entry(card, 1))
+    return entries
+
+
+async def refill_opponent_pool(context: ContextTypes.DEFAULT_TYPE):
+    """Job: reload the card catalog when stale and top up bot rosters."""
+    global _POOL_LOADED_AT
+    now = time.time()
+    if not OPPONENT_POOL.loaded or now - _POOL_LOADED_AT > POOL_CATALOG_TTL:
+        catalog = await asyncio.to_thread(_get_catalog_sync)
+        OPPONENT_POOL.load_catalog(catalog)
+        _POOL_LOADED_AT = now
+    OPPONENT_POOL.refill()
+
+
+async def _pick_bot_team(team: list[dict]) -> list[dict]:
+    """Return a pooled bot roster matching ``team`` strength."""
+    avg = sum(p.get("points", 0) for p in team) / len(team) if team else 0
+    roster = OPPONENT_POOL.pick(avg)
+    if roster is None:
+        # pool not warmed up yet
+        return await _build_team(0)
+    return roster
+
 
 async def _start_pvp_duel(uid1: int, uid2: int, team1, team2, name1: str, name2: str, context: ContextTypes.DEFAULT_TYPE):
     """Initialize interactive PvP duel using ``BattleController``."""
     session = BattleSession(team1, team2, name1=name1, name2=name2)
     controller = BattleController(session)
     duel_key = tuple(sorted((uid1, uid2)))
-    ACTIVE_DUELS[duel_key] = {"controller": controller, "choices": {}, "users": (uid1, uid2)}
-    DUEL_USERS[uid1] = duel_key
-    DUEL_USERS[uid2] = duel_key
+    deadline = time.time() + DUEL_PHASE_TIMEOUT
+    await ACTIVE_DUELS.aset(duel_key, {
+        "controller": controller,
+        "choices": {},
+        "users": (uid1, uid2),
+        "phase": 0,
+        "deadline": deadline,
+    })
+    await DUEL_USERS.aset(uid1, duel_key)
+    await DUEL_USERS.aset(uid2, duel_key)
     keyboard = [
         [InlineKeyboardButton("⚡️ Играть агрессивно", callback_data="battle_aggressive")],
         [InlineKeyboardButton("🛡 Играть осторожно", callback_data="battle_defensive")],
@@ -710,6 +878,7 @@ async def _start_pvp_duel(uid1: int, uid2: int, team1, team2, name1: str, name2:
     markup = InlineKeyboardMarkup(keyboard)
     await _safe_send_message(context.bot, uid1, "⏱ Первый период. Выбери установку:", reply_markup=markup)
     await _safe_send_message(context.bot, uid2, "⏱ Первый период. Выбери установку:", reply_markup=markup)
+    DUEL_DEADLINES.schedule(duel_key, deadline)
 
 
 async def _prompt_pvp_phase(state: dict, context: ContextTypes.DEFAULT_TYPE):
@@ -766,44 +935,17 @@ async def tactic_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     team_name = team_data["name"] if team_data else "Team1"
     team = await _build_team(user_id, team_data["lineup"] if team_data else None)
     if mode == "pvp":
-        existing = PVP_QUEUE.get(user_id)
-        if existing and existing.get("reserved"):
-            await query.edit_message_text("Ожидание соперника...")
-            return
-        entry = {
-            "team": team,
-            "tactic": tactic,
-            "name": team_name,
-            "username": query.from_user.username or str(user_id),
-            "reserved": True,
-            "created": time.time(),
-        }
-        PVP_QUEUE[user_id] = entry
-        opponents = [(uid, data) for uid, data in PVP_QUEUE.items() if uid != user_id]
-        if not opponents:
-            markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отменить", callback_data="duel_cancel")]])
-            await query.edit_message_text("Ждём второго игрока...", reply_markup=markup)
-        elif len(opponents) == 1:
-            opp_id, opp_data = opponents[0]
-            PVP_QUEUE.pop(opp_id, None)
-            PVP_QUEUE.pop(user_id, None)
-            await _start_pvp_duel(user_id, opp_id, team, opp_data["team"], team_name, opp_data["name"], context)
-        else:
-            buttons = [
-                [InlineKeyboardButton(data.get("username", str(uid)), callback_data=f"challenge_{uid}")]
-                for uid, data in opponents
-            ]
-            buttons.append([InlineKeyboardButton("❌ Отменить", callback_data="duel_cancel")])
-            await query.edit_message_text("Выбери соперника:", reply_markup=InlineKeyboardMarkup(buttons))
+        await _join_pvp_queue(query.from_user, team, team_name, tactic, context, query.edit_message_text)
     else:
         team1 = team
-        team2 = await _build_team(0)
+        team2 = await _pick_bot_team(team1)
         tactic2 = random.choice(list(TACTICS.values()))
         session = BattleSession(team1, team2, tactic1=tactic, tactic2=tactic2, name1=team_name, name2="Bot")
         controller = BattleController(session)
         result = await asyncio.to_thread(controller.auto_play)
-        db.save_battle_result(user_id, "Bot", result)
-        xp_gain, lvl, leveled = await apply_xp(user_id, result, True, context)
+        ((xp_gain, lvl, leveled),) = await settle_match(
+            [(user_id, result, True)], context, battle=(user_id, "Bot", result)
+        )
         summary = format_final_summary(session, result, xp_gain, lvl, leveled)
         await context.bot.send_message(
             user_id,
@@ -822,7 +964,7 @@ async def battle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle step-by-step battle choices for PvE matches."""
     query = update.callback_query
     await query.answer()
-    if query.from_user.id in DUEL_USERS:
+    if await DUEL_USERS.acontains(query.from_user.id):
         await _handle_pvp_battle(update, context)
         return
     state = context.user_data.get("battle_state")
@@ -967,8 +1109,8 @@ async def battle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def _handle_pvp_battle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     uid = query.from_user.id
-    duel_key = DUEL_USERS.get(uid)
-    state = ACTIVE_DUELS.get(duel_key)
+    duel_key = await DUEL_USERS.aget(uid)
+    state = await ACTIVE_DUELS.aget(duel_key)
     if not state:
         return
 
@@ -990,60 +1132,177 @@ async def _handle_pvp_battle(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if tactic is None:
         return
 
-    state["choices"][uid] = tactic
+    state = await ACTIVE_DUELS.store.run(_claim_duel_step, duel_key, {uid: tactic})
     await query.edit_message_text("Ожидание соперника...")
-
-    if len(state["choices"]) < 2:
-        return
-
+    if state:
+        await _advance_duel(duel_key, state, context)
+
+
+def _claim_duel_step(duel_key, choices: dict, fill_missing: bool = False, phase: int | None = None) -> dict | None:
+    """Record tactic ``choices`` and return the state if this call may step.
+
+    Only the update that completes the pair claims the step, so the duel
+    advances exactly once even when both players answer on different
+    workers.  With ``fill_missing`` absent players get the default tactic,
+    but only once the stored deadline has passed and, if given, the duel
+    is still in ``phase``.
+    """
+    token = uuid.uuid4().hex
+
+    def add_choice(current):
+        if not current or current.get("stepping"):
+            return None
+        if fill_missing and (
+            current.get("deadline", 0) > time.time()
+            or (phase is not None and current.get("phase", 0) != phase)
+        ):
+            return None
+        merged = {**current["choices"], **choices}
+        if fill_missing:
+            for user in current["users"]:
+                merged.setdefault(user, DUEL_DEFAULT_TACTIC)
+        new_state = {**current, "choices": merged}
+        if len(merged) == 2:
+            new_state["stepping"] = token
+        return new_state
+
+    state = ACTIVE_DUELS.update(duel_key, add_choice)
+    if not state or state.get("stepping") != token:
+        return None
+    DUEL_DEADLINES.cancel(duel_key)
+    return state
+
+
+async def _advance_duel(duel_key, state: dict, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Play the claimed phase; on failure release the claim for a later retry."""
+    try:
+        await _play_duel_phase(duel_key, state, context)
+    except Exception:
+        token = state.get("stepping")
+        deadline = time.time() + DUEL_PHASE_TIMEOUT
+
+        def release(current):
+            if not current or current.get("stepping") != token:
+                return None
+            return {**current, "stepping": None, "deadline": deadline}
+
+        try:
+            await ACTIVE_DUELS.aupdate(duel_key, release)
+            DUEL_DEADLINES.schedule(duel_key, deadline)
+        except Exception as e:
+            logging.warning("Failed to release duel %s: %s", duel_key, e)
+        raise
+
+
+async def _play_duel_phase(duel_key, state: dict, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Play the claimed phase and either finish the duel or prompt the next one."""
     uid1, uid2 = state["users"]
-    t1 = state["choices"].pop(uid1)
-    t2 = state["choices"].pop(uid2)
+    t1 = state["choices"][uid1]
+    t2 = state["choices"][uid2]
     controller: BattleController = state["controller"]
     controller.step(t1, t2)
 
     if controller.phase == "end":
-        result = controller.session.finish()
-        db.save_battle_result(uid1, str(uid2), result)
-        xp1, lvl1, up1 = await apply_xp(uid1, result, False, context)
-        opp_result = result.copy()
-        if result.get("winner") == "team1":
-            opp_result["winner"] = "team2"
-        elif result.get("winner") == "team2":
-            opp_result["winner"] = "team1"
-        opp_result["str_gap"] = -result.get("str_gap", 0.0)
-        xp2, lvl2, up2 = await apply_xp(uid2, opp_result, False, context)
-        summary1 = format_final_summary(controller.session, result, xp1, lvl1, up1)
-        summary2 = format_final_summary(controller.session, opp_result, xp2, lvl2, up2)
-        await _safe_send_message(
-            context.bot,
-            uid1,
-            summary1,
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("⚙ Управление командой", callback_data="open_team")],
-                    [InlineKeyboardButton("🏠 Вернуться в меню", callback_data="menu_back")],
-                ]
-            ),
-            parse_mode="HTML",
-        )
-        await _safe_send_message(
-            context.bot,
-            uid2,
-            summary2,
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("⚙ Управление командой", callback_data="open_team")],
-                    [InlineKeyboardButton("🏠 Вернуться в меню", callback_data="menu_back")],
-                ]
-            ),
-            parse_mode="HTML",
-        )
-        DUEL_USERS.pop(uid1, None)
-        DUEL_USERS.pop(uid2, None)
-        ACTIVE_DUELS.pop(duel_key, None)
+        await _settle_pvp_duel(duel_key, state, context)
     else:
+        deadline = time.time() + DUEL_PHASE_TIMEOUT
+        await ACTIVE_DUELS.aset(duel_key, {
+            **state,
+            "choices": {},
+            "stepping": None,
+            "phase": state.get("phase", 0) + 1,
+            "deadline": deadline,
+        })
         await _prompt_pvp_phase(state, context)
+        DUEL_DEADLINES.schedule(duel_key, deadline)
+
+
+async def _settle_pvp_duel(duel_key, state: dict, context: ContextTypes.DEFAULT_TYPE) -> None:
+    uid1, uid2 = state["users"]
+    controller: BattleController = state["controller"]
+    result = controller.session.finish()
+    opp_result = result.copy()
+    if result.get("winner") == "team1":
+        opp_result["winner"] = "team2"
+    elif result.get("winner") == "team2":
+        opp_result["winner"] = "team1"
+    opp_result["str_gap"] = -result.get("str_gap", 0.0)
+    (xp1, lvl1, up1), (xp2, lvl2, up2) = await settle_match(
+        [(uid1, result, False), (uid2, opp_result, False)],
+        context,
+        battle=(uid1, str(uid2), result),
+    )
+    summary1 = format_final_summary(controller.session, result, xp1, lvl1, up1)
+    summary2 = format_final_summary(controller.session, opp_result, xp2, lvl2, up2)
+    await _safe_send_message(
+        context.bot,
+        uid1,
+        summary1,
+        reply_markup=InlineKeyboardMarkup(
+            [
+                [InlineKeyboardButton("⚙ Управление командой", callback_data="open_team")],
+                [InlineKeyboardButton("🏠 Вернуться в меню", callback_data="menu_back")],
+            ]
+        ),
+        parse_mode="HTML",
+    )
+    await _safe_send_message(
+        context.bot,
+        uid2,
+        summary2,
+        reply_markup=InlineKeyboardMarkup(
+            [
+                [InlineKeyboardButton("⚙ Управление командой", callback_data="open_team")],
+                [InlineKeyboardButton("🏠 Вернуться в меню", callback_data="menu_back")],
+            ]
+        ),
+        parse_mode="HTML",
+    )
+    await DUEL_USERS.apop(uid1)
+    await DUEL_USERS.apop(uid2)
+    await ACTIVE_DUELS.apop(duel_key)
+    DUEL_DEADLINES.cancel(duel_key)
+
+
+def _saved_duel_deadlines() -> list[tuple]:
+    return [(key, state.get("deadline", 0)) for key, state in ACTIVE_DUELS.items()]
+
+
+async def duel_deadline_tick(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Play expired duel phases with the default tactic for silent players."""
+    global _DUEL_SCANNED_AT
+    now = time.time()
+    if now - _DUEL_SCANNED_AT >= DUEL_RESCAN_INTERVAL:
+        # duels saved before a restart or by a crashed worker have no local hint
+        _DUEL_SCANNED_AT = now
+        for duel_key, deadline in await ACTIVE_DUELS.store.run(_saved_duel_deadlines):
+            if duel_key not in DUEL_DEADLINES:
+                DUEL_DEADLINES.schedule(duel_key, deadline)
+    for duel_key in DUEL_DEADLINES.pop_due(now):
+        before = await ACTIVE_DUELS.aget(duel_key)
+        if not before:
+            continue
+        deadline = before.get("deadline", 0)
+        if deadline > now:
+            # the duel moved on, possibly on another worker
+            DUEL_DEADLINES.schedule(duel_key, deadline)
+            continue
+        state = await ACTIVE_DUELS.store.run(
+            _claim_duel_step, duel_key, {}, True, before.get("phase", 0)
+        )
+        if not state:
+            continue
+        for user in state["users"]:
+            if user not in before["choices"]:
+                await _safe_send_message(
+                    context.bot,
+                    user,
+                    "⌛ Время на выбор вышло — команда держит темп.",
+                )
+        try:
+            await _advance_duel(duel_key, state, context)
+        except Exception as e:
+            logging.exception("Failed to advance duel %s: %s", duel_key, e)
 
 
 async def duel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1052,6 +1311,7 @@ async def duel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     if data == "duel_cancel":
         PVP_QUEUE.pop(user_id, None)
+        _cancel_pvp_expiry(context, user_id)
         await query.edit_message_text("Поиск дуэли отменён.")
         return
     if data.startswith("challenge_"):
@@ -1061,6 +1321,8 @@ async def duel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         opp_data = PVP_QUEUE.pop(opp_id)
         my_data = PVP_QUEUE.pop(user_id)
+        _cancel_pvp_expiry(context, opp_id)
+        _cancel_pvp_expiry(context, user_id)
         await _start_pvp_duel(
             user_id,
             opp_id,
@@ -1130,9 +1392,5 @@ async def rename_player_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 def cleanup_pvp_queue():
-    """Remove stale entries from PVP queue."""
-    now = time.time()
-    for uid in list(PVP_QUEUE.keys()):
-        created = PVP_QUEUE[uid].get("created", now)
-        if now - created > PVP_TTL:
-            PVP_QUEUE.pop(uid, None)
+    """Remove stale entries missed by the per-entry expiry timers."""
+    PVP_QUEUE.expire(PVP_TTL)
@@ -0,0 +1,160 @@
+"""Persistent log of admin commands.
+
+Every call is appended to the ``admin_audit`` table and counted in
+``admin_audit_counts`` (one row per admin and command).  Handlers only
+touch memory: :meth:`AdminAudit.record` queues the entry, bumps the
+counters and pushes it onto a ring buffer of the latest entries, which is
+all ``/logadmin`` needs.  A periodic job calls :meth:`AdminAudit.flush` to
+write queued entries in one transaction.  Older history is read with
+:meth:`AdminAudit.history`, filtered by admin, command and time range.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+Entry = Tuple[int, int, str]  # (timestamp, admin_id, command)
+
+
+class AdminAudit:
+    """Admin command log with a batched writer and in-memory counters.
+
+    ``connect`` is a ``get_db``-style factory; until :meth:`open` provides
+    one, entries are only kept in memory and queued for the first flush.
+    """
+
+    def __init__(self, connect: Optional[Callable] = None, ring_size: int = 200) -> None:
+        self._connect = connect
+        self._recent: "deque[Entry]" = deque(maxlen=ring_size)
+        self._pending: List[Entry] = []
+        self._counts: Dict[int, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, admin_id: int, command: str, ts: Optional[int] = None) -> None:
+        entry = (int(ts if ts is not None else time.time()), admin_id, command)
+        with self._lock:
+            self._recent.append(entry)
+            self._pending.append(entry)
+            per_admin = self._counts.setdefault(admin_id, {})
+            per_admin[command] = per_admin.get(command, 0) + 1
+
+    def open(self, connect: Callable) -> None:
+        """Attach to the database and load counters and the latest entries."""
+        self._connect = connect
+        conn = connect()
+        cur = conn.cursor()
+        cur.execute("SELECT admin_id, command, calls FROM admin_audit_counts")
+        counts: Dict[int, Dict[str, int]] = {}
+        for admin_id, command, calls in cur.fetchall():
+            counts.setdefault(admin_id, {})[command] = calls
+        cur.execute(
+            "SELECT ts, admin_id, command FROM admin_audit ORDER BY ts DESC LIMIT ?",
+            (self._recent.maxlen,),
+        )
+        stored = [tuple(row) for row in reversed(cur.fetchall())]
+        conn.close()
+        with self._lock:
+            # entries recorded before opening are not in the table yet
+            for _, admin_id, command in self._pending:
+                per_admin = counts.setdefault(admin_id, {})
+                per_admin[command] = per_admin.get(command, 0) + 1
+            self._counts = counts
+            self._recent = deque(stored + self._pending, maxlen=self._recent.maxlen)
+
+    def flush(self) -> int:
+        """Write queued entries and their counters; return how many."""
+        if self._connect is None:
+            return 0
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return 0
+        totals: Dict[Tuple[int, str], List[int]] = {}
+        for ts, admin_id, command in batch:
+            total = totals.setdefault((admin_id, command), [0, ts])
+            total[0] += 1
+            total[1] = max(total[1], ts)
+        conn = self._connect()
+        try:
+            cur = conn.cursor()
+            cur.executemany("INSERT INTO admin_audit (ts, admin_id, command) VALUES (?, ?, ?)", batch)
+            cur.executemany(
+                "INSERT INTO admin_audit_counts (admin_id, command, calls, last_ts) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (admin_id, command) DO UPDATE SET "
+                "calls=admin_audit_counts.calls + EXCLUDED.calls, last_ts=EXCLUDED.last_ts",
+                [(admin_id, command, calls, ts) for (admin_id, command), (calls, ts) in totals.items()],
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            with self._lock:
+                self._pending[:0] = batch
+            raise
+        finally:
+            conn.close()
+        return len(batch)
+
+    def recent(self, limit: int = 20) -> List[Entry]:
+        """Return up to ``limit`` latest entries, newest first."""
+        with self._lock:
+            entries = list(self._recent)
+        return entries[::-1][:limit]
+
+    def history(
+        self,
+        admin_id: Optional[int] = None,
+        command: Optional[str] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        limit: int = 50,
+    ) -> List[Entry]:
+        """Return stored entries matching all given filters, newest first."""
+        if self._connect is None:
+            entries = [
+                e for e in self.recent(len(self._recent))
+                if (admin_id is None or e[1] == admin_id)
+                and (command is None or e[2] == command)
+                and (since is None or e[0] >= since)
+                and (until is None or e[0] < until)
+            ]
+            return entries[:limit]
+        self.flush()
+        where, params = [], []
+        if admin_id is not None:
+            where.append("admin_id=?")
+            params.append(admin_id)
+        if command is not None:
+            where.append("command=?")
+            params.append(command)
+        if since is not None:
+            where.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("ts < ?")
+            params.append(until)
+        sql = "SELECT ts, admin_id, command FROM admin_audit"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute(sql + " ORDER BY ts DESC LIMIT ?", (*params, limit))
+        rows = [tuple(row) for row in cur.fetchall()]
+        conn.close()
+        return rows
+
+    def admins(self) -> List[int]:
+        with self._lock:
+            return sorted(self._counts)
+
+    def commands(self, admin_id: int) -> Dict[str, int]:
+        """Return ``{command: calls}`` for ``admin_id``."""
+        with self._lock:
+            return dict(self._counts.get(admin_id, {}))
+
+    def totals(self) -> Dict[int, int]:
+        """Return ``{admin_id: calls}`` over all commands."""
+        with self._lock:
+            return {admin_id: sum(c.values()) for admin_id, c in self._counts.items()}
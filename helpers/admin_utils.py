@@ -1,21 +1,16 @@
-import time
-from typing import Dict, List, Set, Tuple
+from helpers.admin_audit import AdminAudit
+from helpers.state_store import STORE
 
-banned_users: Set[int] = set()
+# user_id -> ban reason, shared between bot workers
+banned_users = STORE.namespace("banned")
 
-# user_id -> set of used admin commands
-admin_usage_log: Dict[int, Set[str]] = {}
-# user_id -> total count of admin command calls
-admin_usage_count: Dict[int, int] = {}
-# chronological list of (timestamp, user_id, command)
-admin_action_history: List[Tuple[int, int, str]] = []
+# admin command log; the bot attaches it to the database on startup
+admin_audit = AdminAudit(ring_size=200)
 
-# user_id -> last activity timestamp
-online_users: Dict[int, float] = {}
+# user_id -> last activity timestamp, forgotten after 10 minutes
+online_users = STORE.namespace("online", ttl=600)
 
 
 def record_admin_usage(user_id: int, command: str) -> None:
     """Record usage of an admin command."""
-    admin_usage_log.setdefault(user_id, set()).add(command)
-    admin_usage_count[user_id] = admin_usage_count.get(user_id, 0) + 1
-    admin_action_history.append((int(time.time()), user_id, command))
+    admin_audit.record(user_id, command)
@@ -0,0 +1,56 @@
+"""Heap-based deadline scheduler for many concurrent timers."""
+
+from __future__ import annotations
+
+import heapq
+import itertools
+import time
+from typing import Dict, Hashable, List, Tuple
+
+
+class DeadlineScheduler:
+    """Keyed deadlines kept in a binary heap.
+
+    Scheduling and cancelling are O(log n) and O(1): a cancelled or
+    rescheduled entry stays in the heap and is skipped when it surfaces.
+    A single periodic job calls :meth:`pop_due` instead of every timer
+    having its own job.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._live: Dict[Hashable, int] = {}
+        self._seq = itertools.count()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._live
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def schedule(self, key: Hashable, deadline: float) -> None:
+        """Set the deadline for ``key``, replacing any previous one."""
+        seq = next(self._seq)
+        self._live[key] = seq
+        heapq.heappush(self._heap, (deadline, seq, key))
+        # keep stale entries from piling up when timers are mostly cancelled
+        if len(self._heap) > 2 * len(self._live) + 64:
+            self._compact()
+
+    def cancel(self, key: Hashable) -> bool:
+        return self._live.pop(key, None) is not None
+
+    def pop_due(self, now: float | None = None) -> List[Hashable]:
+        """Remove and return keys whose deadline is ``<= now``."""
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, key = heapq.heappop(self._heap)
+            if self._live.get(key) == seq:
+                del self._live[key]
+                due.append(key)
+        return due
+
+    def _compact(self) -> None:
+        self._heap = [item for item in self._heap if self._live.get(item[2]) == item[1]]
+        heapq.heapify(self._heap)
@@ -0,0 +1,39 @@
+"""Deferred imports for modules that only some updates need."""
+
+from __future__ import annotations
+
+import importlib.util
+import sys
+from types import ModuleType
+
+
+def lazy_module(name: str) -> ModuleType:
+    """Return module ``name``, executed on first attribute access.
+
+    A module that is already imported is returned as is.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def lazy_callback(module: ModuleType, attr: str):
+    """Return an async callback forwarding to ``module.attr``.
+
+    Registering it with a handler or job does not load ``module``; the
+    first call does.  The wrapper carries ``attr`` as its name so metrics
+    labels stay the same.
+    """
+
+    async def callback(*args, **kwargs):
+        return await getattr(module, attr)(*args, **kwargs)
+
+    callback.__name__ = callback.__qualname__ = attr
+    return callback
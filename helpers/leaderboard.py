@@ -0,0 +1,68 @@
+"""Precomputed leaderboard snapshots.
+
+A periodic job ranks every board in one batch and swaps the results in at
+once.  Rating commands then only look up the caller's place and append it
+to the pre-rendered top of the board.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+class Board:
+    """One ranked board.
+
+    ``entries`` are tuples ``(user_id, value, *extra)`` already sorted from
+    first place down; ``top_text`` is the rendered head of the board.
+    """
+
+    def __init__(self, entries: Sequence[tuple], top_text: str = "") -> None:
+        self.entries = list(entries)
+        self.top_text = top_text
+        self._index = {entry[0]: i for i, entry in enumerate(self.entries)}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._index
+
+    def position(self, user_id: int) -> Tuple[int, Optional[tuple], Optional[float]]:
+        """Return ``(rank, entry, gap)`` for ``user_id``.
+
+        ``gap`` is how much value the user lacks to the next place.  Users
+        missing from the snapshot are ranked last with no entry or gap.
+        """
+        i = self._index.get(user_id)
+        if i is None:
+            return len(self.entries), None, None
+        gap = self.entries[i - 1][1] - self.entries[i][1] if i else None
+        return i + 1, self.entries[i], gap
+
+
+class LeaderboardSnapshots:
+    """Latest set of boards, replaced as a whole by the builder job."""
+
+    def __init__(self) -> None:
+        self._boards: Dict[str, Board] = {}
+        self.built_at = 0.0
+
+    def get(self, name: str) -> Optional[Board]:
+        return self._boards.get(name)
+
+    def replace(self, boards: Dict[str, Board]) -> None:
+        self._boards = dict(boards)
+        self.built_at = time.time()
+
+
+def render_top(title: str, entries: List[tuple], names: Dict[int, str], line, limit: int = 10) -> str:
+    """Render the first ``limit`` entries as ``title`` plus two lines each."""
+    lines = [title, ""]
+    for i, entry in enumerate(entries[:limit], 1):
+        uname = names.get(entry[0])
+        lines.append(f"{i}. {'@' + uname if uname else f'ID:{entry[0]}'}")
+        lines.append(line(entry))
+        lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,187 @@
+"""Skill-bucketed PvP matchmaking queue."""
+
+from __future__ import annotations
+
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+_MISSING = object()
+
+
+class MatchmakingQueue:
+    """Waiting PvP players bucketed by team rating.
+
+    Entries are plain dicts with at least ``rating`` and ``created`` keys.
+    A player is paired with the closest waiting player whose rating lies
+    within the larger of both tolerance windows.  The window starts at
+    ``base_tolerance`` and widens by ``widen_per_sec`` for every second spent
+    in the queue, so only a bounded number of neighbouring buckets is ever
+    inspected regardless of queue size.
+    """
+
+    def __init__(
+        self,
+        bucket_width: float = 10.0,
+        base_tolerance: float = 10.0,
+        widen_per_sec: float = 1.0,
+        max_tolerance: float = 300.0,
+        history: int = 500,
+    ) -> None:
+        self.bucket_width = bucket_width
+        self.base_tolerance = base_tolerance
+        self.widen_per_sec = widen_per_sec
+        self.max_tolerance = max_tolerance
+        self._entries: Dict[int, Dict] = {}
+        self._buckets: Dict[int, Dict[int, None]] = {}
+        self._waits: Deque[float] = deque(maxlen=history)
+        self.matched = 0
+        self.expired = 0
+
+    # --- mapping interface -------------------------------------------------
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._entries
+
+    def __getitem__(self, uid: int) -> Dict:
+        return self._entries[uid]
+
+    def __setitem__(self, uid: int, entry: Dict) -> None:
+        self.add(uid, entry)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._entries))
+
+    def get(self, uid: int, default=None):
+        return self._entries.get(uid, default)
+
+    def keys(self) -> List[int]:
+        return list(self._entries)
+
+    def items(self) -> List[Tuple[int, Dict]]:
+        return list(self._entries.items())
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._buckets.clear()
+
+    def pop(self, uid: int, default=_MISSING):
+        entry = self._entries.pop(uid, None)
+        if entry is None:
+            if default is _MISSING:
+                raise KeyError(uid)
+            return default
+        key = self._bucket(entry.get("rating", 0.0))
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.pop(uid, None)
+            if not bucket:
+                del self._buckets[key]
+        return entry
+
+    # --- matchmaking -------------------------------------------------------
+    def _bucket(self, rating: float) -> int:
+        return int(rating // self.bucket_width)
+
+    def add(self, uid: int, entry: Dict) -> None:
+        """Put ``uid`` in the queue, replacing any previous entry."""
+        if uid in self._entries:
+            self.pop(uid)
+        entry.setdefault("rating", 0.0)
+        entry.setdefault("created", time.time())
+        self._entries[uid] = entry
+        self._buckets.setdefault(self._bucket(entry["rating"]), {})[uid] = None
+
+    def tolerance(self, entry: Dict, now: float | None = None) -> float:
+        now = time.time() if now is None else now
+        waited = max(0.0, now - entry.get("created", now))
+        return min(self.max_tolerance, self.base_tolerance + waited * self.widen_per_sec)
+
+    def find_match(self, uid: int, now: float | None = None) -> Optional[int]:
+        """Return the closest acceptable opponent for ``uid`` or ``None``."""
+        entry = self._entries.get(uid)
+        if entry is None:
+            return None
+        now = time.time() if now is None else now
+        rating = entry["rating"]
+        center = self._bucket(rating)
+        span = math.ceil(self.max_tolerance / self.bucket_width)
+        best: Optional[int] = None
+        best_gap = math.inf
+        for offset in range(span + 1):
+            # the nearest bucket outside the current best cannot improve it
+            if best is not None and (offset - 1) * self.bucket_width > best_gap:
+                break
+            for key in {center - offset, center + offset}:
+                for other in self._buckets.get(key, ()):
+                    if other == uid:
+                        continue
+                    other_entry = self._entries[other]
+                    gap = abs(other_entry["rating"] - rating)
+                    allowed = max(self.tolerance(entry, now), self.tolerance(other_entry, now))
+                    if gap <= allowed and gap < best_gap:
+                        best, best_gap = other, gap
+        return best
+
+    def match(self, uid: int, now: float | None = None) -> Optional[Tuple[int, Dict, Dict]]:
+        """Pair ``uid`` and remove both players from the queue.
+
+        Returns ``(opponent_id, opponent_entry, own_entry)`` or ``None``.
+        """
+        now = time.time() if now is None else now
+        opp = self.find_match(uid, now)
+        if opp is None:
+            return None
+        mine = self.pop(uid)
+        theirs = self.pop(opp)
+        for entry in (mine, theirs):
+            self._waits.append(max(0.0, now - entry.get("created", now)))
+        self.matched += 1
+        return opp, theirs, mine
+
+    def nearby(self, uid: int, limit: int = 10) -> List[Tuple[int, Dict]]:
+        """Return up to ``limit`` waiting players ordered by rating gap."""
+        entry = self._entries.get(uid)
+        rating = entry["rating"] if entry else 0.0
+        center = self._bucket(rating)
+        keys = sorted(self._buckets, key=lambda k: abs(k - center))
+        found: List[Tuple[int, Dict]] = []
+        for key in keys:
+            for other in self._buckets[key]:
+                if other != uid:
+                    found.append((other, self._entries[other]))
+            if len(found) >= limit:
+                break
+        found.sort(key=lambda item: abs(item[1]["rating"] - rating))
+        return found[:limit]
+
+    def expire(self, ttl: float, now: float | None = None) -> List[int]:
+        """Drop entries older than ``ttl`` seconds. Return removed ids."""
+        now = time.time() if now is None else now
+        stale = [uid for uid, e in self._entries.items() if now - e.get("created", now) > ttl]
+        for uid in stale:
+            self.pop(uid, None)
+        self.expired += len(stale)
+        return stale
+
+    # --- metrics -----------------------------------------------------------
+    def stats(self) -> Dict[str, float]:
+        """Return queue size and wait-time statistics for recent matches."""
+        waits = sorted(self._waits)
+
+        def pct(p: float) -> float:
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(p * len(waits)))]
+
+        return {
+            "waiting": len(self._entries),
+            "matched": self.matched,
+            "expired": self.expired,
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p50_wait": pct(0.5),
+            "p95_wait": pct(0.95),
+        }
@@ -0,0 +1,206 @@
+"""Per-handler call counts, errors and latency histograms.
+
+:func:`instrument_application` wraps the callback of every registered
+handler.  Callback queries are labelled by handler name and callback-data
+prefix (``collection_callback:coll_rarity``).  Metrics are off unless
+``BOT_METRICS=1``; disabled, handlers are left unwrapped so there is no
+per-update cost.  :func:`render_prometheus` produces the text exposition
+format and :func:`start_http_server` serves it on a local port.
+"""
+
+from __future__ import annotations
+
+import bisect
+import functools
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from helpers import query_profiler
+
+ENABLED = os.getenv("BOT_METRICS", "0") == "1"
+
+# latency bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram with percentile estimates."""
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.n += 1
+
+    def percentile(self, p: float) -> float:
+        """Return the upper bound of the bucket holding the ``p`` quantile."""
+        if not self.n:
+            return 0.0
+        rank = p * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class HandlerStats:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+STATS: Dict[str, HandlerStats] = {}
+_lock = threading.Lock()
+
+
+def observe(label: str, seconds: float, error: bool = False) -> None:
+    with _lock:
+        stats = STATS.get(label)
+        if stats is None:
+            stats = STATS[label] = HandlerStats()
+        stats.calls += 1
+        stats.errors += error
+        stats.latency.observe(seconds)
+
+
+def callback_prefix(data: str | None) -> str:
+    """Return ``data`` up to its first variable part, at most two segments.
+
+    ``trade_select_12`` and ``coll_rarity_epic`` become ``trade_select`` and
+    ``coll_rarity``.
+    """
+    if not data:
+        return ""
+    parts = []
+    for part in data.replace(":", "_").split("_")[:2]:
+        if any(ch.isdigit() for ch in part):
+            break
+        parts.append(part)
+    return "_".join(parts)
+
+
+def _label(name: str, update) -> str:
+    query = getattr(update, "callback_query", None)
+    if query is not None and getattr(query, "data", None):
+        return f"{name}:{callback_prefix(query.data)}"
+    return name
+
+
+def instrument(callback, name: str | None = None):
+    """Wrap an async handler ``callback`` to record its calls and latency."""
+    if getattr(callback, "__metrics_wrapped__", False):
+        return callback
+    name = name or getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context, *args, **kwargs):
+        label = _label(name, update)
+        token = query_profiler.enter(label) if query_profiler.ENABLED else None
+        start = time.perf_counter()
+        error = False
+        try:
+            return await callback(update, context, *args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            if ENABLED:
+                observe(label, time.perf_counter() - start, error)
+            if token is not None:
+                query_profiler.leave(token)
+
+    wrapper.__metrics_wrapped__ = True
+    return wrapper
+
+
+def instrument_application(application) -> int:
+    """Wrap every handler registered on ``application``; return how many.
+
+    Handlers are also wrapped when only the query profiler is on, so its
+    statements are attributed to the handler that ran them.
+    """
+    if not (ENABLED or query_profiler.ENABLED):
+        return 0
+    wrapped = 0
+    for group in application.handlers.values():
+        for handler in group:
+            if getattr(handler, "callback", None) is not None:
+                handler.callback = instrument(handler.callback)
+                wrapped += 1
+    return wrapped
+
+
+def summary(limit: int = 15) -> List[Tuple[str, int, int, float, float, float]]:
+    """Return ``(label, calls, errors, p50, p95, p99)`` sorted by p95."""
+    with _lock:
+        rows = [
+            (
+                label,
+                s.calls,
+                s.errors,
+                s.latency.percentile(0.5),
+                s.latency.percentile(0.95),
+                s.latency.percentile(0.99),
+            )
+            for label, s in STATS.items()
+        ]
+    rows.sort(key=lambda r: (r[4], r[1]), reverse=True)
+    return rows[:limit]
+
+
+def _escape(label: str) -> str:
+    return label.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def render_prometheus() -> str:
+    """Return all handler metrics in the Prometheus text format."""
+    lines = [
+        "# TYPE bot_handler_calls_total counter",
+        "# TYPE bot_handler_errors_total counter",
+        "# TYPE bot_handler_seconds histogram",
+    ]
+    with _lock:
+        items = sorted(STATS.items())
+        for label, s in items:
+            tag = f'handler="{_escape(label)}"'
+            lines.append(f"bot_handler_calls_total{{{tag}}} {s.calls}")
+            lines.append(f"bot_handler_errors_total{{{tag}}} {s.errors}")
+            cumulative = 0
+            for bound, count in zip(s.latency.buckets, s.latency.counts):
+                cumulative += count
+                lines.append(f'bot_handler_seconds_bucket{{{tag},le="{bound}"}} {cumulative}')
+            lines.append(f'bot_handler_seconds_bucket{{{tag},le="+Inf"}} {s.latency.n}')
+            lines.append(f"bot_handler_seconds_sum{{{tag}}} {s.latency.total:.6f}")
+            lines.append(f"bot_handler_seconds_count{{{tag}}} {s.latency.n}")
+    return "\n".join(lines) + "\n"
+
+
+def start_http_server(port: int, host: str = "127.0.0.1"):
+    """Serve :func:`render_prometheus` on ``host:port`` from a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
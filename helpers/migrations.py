@@ -0,0 +1,60 @@
+"""Run schema setup steps once per database.
+
+Every migration is a named, idempotent function.  Names that completed
+are stored in ``schema_migrations``; a startup against an up-to-date
+database costs one connection instead of a round of ``CREATE``/``ALTER``
+checks.  Steps are never renamed: a new name runs again.
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from typing import Callable, List, Sequence, Set, Tuple
+
+Migration = Tuple[str, Callable[[], None]]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    name TEXT PRIMARY KEY,
+    applied_at BIGINT NOT NULL
+)
+"""
+
+
+def applied(get_db: Callable) -> Set[str]:
+    """Return names of migrations already run, creating the table if needed."""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(SCHEMA)
+    conn.commit()
+    cur.execute("SELECT name FROM schema_migrations")
+    names = {row[0] for row in cur.fetchall()}
+    conn.close()
+    return names
+
+
+def migrate(get_db: Callable, migrations: Sequence[Migration]) -> List[str]:
+    """Run pending ``migrations`` in order and return their names.
+
+    A step is recorded only after it succeeds, so a failed startup retries
+    it next time.  Two processes starting together may both run a step;
+    steps are idempotent and the second record is ignored.
+    """
+    done = applied(get_db)
+    ran = []
+    for name, step in migrations:
+        if name in done:
+            continue
+        start = time.perf_counter()
+        step()
+        conn = get_db()
+        conn.execute(
+            "INSERT INTO schema_migrations (name, applied_at) VALUES (?, ?) ON CONFLICT (name) DO NOTHING",
+            (name, int(time.time())),
+        )
+        conn.commit()
+        conn.close()
+        logging.info("Migration %s applied in %.2fs", name, time.perf_counter() - start)
+        ran.append(name)
+    return ran
@@ -0,0 +1,91 @@
+"""Pool of pre-built bot rosters for PvE fights."""
+
+from __future__ import annotations
+
+import bisect
+import random
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence
+
+TEAM_SIZE = 6
+
+
+class OpponentPool:
+    """Ready-made bot rosters bucketed by average card points.
+
+    The card catalog is sorted by points and split into ``tiers`` slices of
+    roughly equal size.  Each tier keeps a queue of rosters drawn from its
+    slice, so a player's team can be matched against bots of similar strength
+    without touching the database.
+    """
+
+    def __init__(self, tiers: int = 5, per_tier: int = 20) -> None:
+        self.tiers = tiers
+        self.per_tier = per_tier
+        self._catalog: List[Dict] = []
+        self._slices: List[List[Dict]] = []
+        # lowest points value of every tier except the first one
+        self._bounds: List[float] = []
+        self._rosters: List[Deque[List[Dict]]] = [deque() for _ in range(tiers)]
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self._catalog)
+
+    def load_catalog(self, cards: Sequence[Dict]) -> None:
+        """Replace the catalog used to build rosters and drop stale rosters."""
+        ordered = sorted(cards, key=lambda c: c.get("points", 0))
+        self._catalog = ordered
+        self._slices = []
+        self._bounds = []
+        if not ordered:
+            for queue in self._rosters:
+                queue.clear()
+            return
+        size = len(ordered)
+        for tier in range(self.tiers):
+            start = tier * size // self.tiers
+            end = (tier + 1) * size // self.tiers
+            chunk = ordered[start:end] or ordered[start:start + 1] or ordered[-1:]
+            self._slices.append(chunk)
+            if tier:
+                self._bounds.append(chunk[0].get("points", 0))
+        for queue in self._rosters:
+            queue.clear()
+
+    def tier_for(self, avg_points: float) -> int:
+        """Return tier index matching the given average card points."""
+        return min(bisect.bisect_right(self._bounds, avg_points), self.tiers - 1)
+
+    def _build_roster(self, tier: int) -> List[Dict]:
+        chunk = self._slices[tier]
+        roster = random.sample(chunk, min(TEAM_SIZE, len(chunk)))
+        while len(roster) < TEAM_SIZE:
+            roster.append(random.choice(self._catalog))
+        return roster
+
+    def refill(self) -> int:
+        """Top up every tier to ``per_tier`` rosters. Return number built."""
+        if not self._catalog:
+            return 0
+        built = 0
+        for tier, queue in enumerate(self._rosters):
+            while len(queue) < self.per_tier:
+                queue.append(self._build_roster(tier))
+                built += 1
+        return built
+
+    def pick(self, avg_points: float) -> Optional[List[Dict]]:
+        """Take a roster closest to ``avg_points`` or ``None`` if unloaded."""
+        if not self._catalog:
+            return None
+        tier = self.tier_for(avg_points)
+        for offset in range(self.tiers):
+            for idx in (tier - offset, tier + offset):
+                if 0 <= idx < self.tiers and self._rosters[idx]:
+                    return self._rosters[idx].popleft()
+        # every queue is drained: build one on the spot from memory
+        return self._build_roster(tier)
+
+    def size(self) -> int:
+        return sum(len(q) for q in self._rosters)
@@ -0,0 +1,115 @@
+"""Opt-in SQL profiling for :class:`db_pg.PGCursor`.
+
+With ``QUERY_PROFILE=1`` every statement is timed, reduced to a
+fingerprint (literals and ``IN`` lists replaced by ``?``) and counted
+against the handler that issued it.  The current handler travels in a
+contextvar, which ``asyncio.to_thread`` copies into worker threads.
+Statements slower than ``SLOW_QUERY_MS`` are logged.  Per-handler query
+counts make N+1 loops stand out: their max per call grows with the data.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+ENABLED = os.getenv("QUERY_PROFILE", "0") == "1"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+
+class _Scope:
+    __slots__ = ("name", "queries", "seconds")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.queries = 0
+        self.seconds = 0.0
+
+
+_current: contextvars.ContextVar[Optional[_Scope]] = contextvars.ContextVar("query_scope", default=None)
+_lock = threading.Lock()
+
+# fingerprint -> [count, total seconds, max seconds]
+QUERIES: Dict[str, List[float]] = {}
+# handler -> [invocations, queries, max queries per invocation, seconds]
+HANDLERS: Dict[str, List[float]] = {}
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAM = re.compile(r"%s|\?")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+def fingerprint(sql: str) -> str:
+    """Normalise ``sql`` so statements differing only in values match."""
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _PARAM.sub("?", sql)
+    sql = _SPACE.sub(" ", sql).strip()
+    return _LIST.sub("(...)", sql)
+
+
+def enter(name: str) -> contextvars.Token:
+    """Attribute following queries to handler ``name`` until :func:`leave`."""
+    return _current.set(_Scope(name))
+
+
+def leave(token: contextvars.Token) -> None:
+    scope = _current.get()
+    _current.reset(token)
+    if scope is None:
+        return
+    with _lock:
+        stats = HANDLERS.setdefault(scope.name, [0, 0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += scope.queries
+        stats[2] = max(stats[2], scope.queries)
+        stats[3] += scope.seconds
+
+
+def record(sql: str, seconds: float) -> None:
+    """Account one executed statement."""
+    fp = fingerprint(sql)
+    scope = _current.get()
+    if scope is not None:
+        scope.queries += 1
+        scope.seconds += seconds
+    with _lock:
+        stats = QUERIES.get(fp)
+        if stats is None:
+            stats = QUERIES[fp] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        logging.warning(
+            "Slow query %.0f ms in %s: %s",
+            seconds * 1000,
+            scope.name if scope else "-",
+            fp[:300],
+        )
+
+
+def handler_report(limit: int = 15) -> List[Tuple[str, int, float, int, float]]:
+    """Return ``(handler, calls, avg queries, max queries, avg ms)`` by avg queries."""
+    with _lock:
+        rows = [
+            (name, int(n), q / n, int(mx), secs / n * 1000)
+            for name, (n, q, mx, secs) in HANDLERS.items()
+            if n
+        ]
+    rows.sort(key=lambda r: r[2], reverse=True)
+    return rows[:limit]
+
+
+def query_report(limit: int = 10) -> List[Tuple[str, int, float, float]]:
+    """Return ``(fingerprint, count, total ms, max ms)`` by total time."""
+    with _lock:
+        rows = [(fp, int(n), total * 1000, mx * 1000) for fp, (n, total, mx) in QUERIES.items()]
+    rows.sort(key=lambda r: r[2], reverse=True)
+    return rows[:limit]
@@ -0,0 +1,433 @@
+"""Shared storage for short-lived bot state (duels, trades, presence).
+
+Two backends share one interface:
+
+* ``MemoryStateStore`` keeps everything in the current process.
+* ``SQLStateStore`` keeps JSON-encoded values in a ``state_kv`` table so
+  several bot workers (and restarts) see the same duels and trades.
+
+Every value carries a version number used by :meth:`compare_and_set` and an
+optional expiry time.  ``StateMapping`` wraps one namespace in a dict-like
+view so handlers can keep using ``mapping[key]``.  Values read from the SQL
+backend are copies: code that mutates a value must assign it back.
+Coroutines use the ``a*`` accessors (``await mapping.aget(key)``), which run
+the query in a worker thread when the backend blocks on the database.
+
+The JSON encoding keeps tuples, sets and non-string dict keys.  Objects
+are stored only for classes registered with :func:`register_state_type`,
+so reading the shared table never constructs anything else.
+"""
+
+from __future__ import annotations
+
+import abc
+import ast
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+_MISSING = object()
+
+# classes whose instances may be stored by the SQL backend, by qualified name
+_STATE_TYPES: Dict[str, type] = {}
+
+
+def register_state_type(cls: type) -> type:
+    """Allow instances of ``cls`` in stored values; usable as a decorator.
+
+    The instance ``__dict__`` is stored; ``__setstate__``, if defined,
+    receives it back on load.
+    """
+    _STATE_TYPES[f"{cls.__module__}.{cls.__qualname__}"] = cls
+    return cls
+
+
+def _encode(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, tuple):
+        return {"__tuple__": [_encode(v) for v in value]}
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": [_encode(v) for v in value]}
+    if isinstance(value, dict):
+        if all(isinstance(k, str) and not k.startswith("__") for k in value):
+            return {k: _encode(v) for k, v in value.items()}
+        return {"__items__": [[_encode(k), _encode(v)] for k, v in value.items()]}
+    name = f"{type(value).__module__}.{type(value).__qualname__}"
+    if _STATE_TYPES.get(name) is type(value):
+        return {"__type__": name, "state": _encode(vars(value))}
+    raise TypeError(f"{name} is not registered with register_state_type")
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if "__tuple__" in value:
+        return tuple(_decode(v) for v in value["__tuple__"])
+    if "__set__" in value:
+        return {_decode(v) for v in value["__set__"]}
+    if "__items__" in value:
+        return {_decode(k): _decode(v) for k, v in value["__items__"]}
+    if "__type__" in value:
+        cls = _STATE_TYPES.get(value["__type__"])
+        if cls is None:
+            raise ValueError(f"unknown stored type {value['__type__']}")
+        obj = cls.__new__(cls)
+        state = _decode(value["state"])
+        if hasattr(obj, "__setstate__"):
+            obj.__setstate__(state)
+        else:
+            obj.__dict__.update(state)
+        return obj
+    return {k: _decode(v) for k, v in value.items()}
+
+
+def dumps(value: Any) -> bytes:
+    return json.dumps(_encode(value), separators=(",", ":")).encode()
+
+
+def loads(data) -> Any:
+    return _decode(json.loads(bytes(data)))
+
+
+class StateStore(abc.ABC):
+    """Namespaced key/value store with versions and TTL expiry."""
+
+    # True when calls do I/O and must be kept off the event loop
+    blocking = False
+
+    @abc.abstractmethod
+    def get_versioned(self, ns: str, key: Any) -> Tuple[Any, int]:
+        """Return ``(value, version)``; version ``0`` means missing."""
+
+    @abc.abstractmethod
+    def set(self, ns: str, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        """Store ``value`` under ``key``, replacing any previous value."""
+
+    @abc.abstractmethod
+    def delete(self, ns: str, key: Any) -> Any:
+        """Remove ``key`` and return its value or ``None``."""
+
+    @abc.abstractmethod
+    def compare_and_set(self, ns: str, key: Any, version: int, value: Any, ttl: Optional[float] = None) -> bool:
+        """Store ``value`` only if the current version equals ``version``."""
+
+    @abc.abstractmethod
+    def items(self, ns: str) -> List[Tuple[Any, Any]]:
+        """Return live ``(key, value)`` pairs of namespace ``ns``."""
+
+    @abc.abstractmethod
+    def purge_expired(self) -> int:
+        """Drop expired entries and return how many were removed."""
+
+    def setup(self) -> None:
+        """Prepare backend storage."""
+
+    def get(self, ns: str, key: Any, default: Any = None) -> Any:
+        value, version = self.get_versioned(ns, key)
+        return value if version else default
+
+    def update(
+        self,
+        ns: str,
+        key: Any,
+        fn: Callable[[Any], Any],
+        ttl: Optional[float] = None,
+        retries: int = 20,
+    ) -> Any:
+        """Atomically replace the value with ``fn(value)`` and return it.
+
+        ``fn`` receives ``None`` when the key is missing.  Returning ``None``
+        leaves the stored value untouched.
+        """
+        for _ in range(retries):
+            value, version = self.get_versioned(ns, key)
+            new = fn(value if version else None)
+            if new is None:
+                return value if version else None
+            if self.compare_and_set(ns, key, version, new, ttl):
+                return new
+        raise RuntimeError(f"state update for {ns}:{key!r} kept conflicting")
+
+    async def run(self, fn: Callable, *args: Any) -> Any:
+        """Call ``fn(*args)`` from a coroutine, in a thread if the store blocks."""
+        if self.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    def namespace(self, ns: str, ttl: Optional[float] = None) -> "StateMapping":
+        return StateMapping(self, ns, ttl)
+
+
+class MemoryStateStore(StateStore):
+    """Process-local backend."""
+
+    def __init__(self) -> None:
+        self._data: Dict[str, Dict[Any, Tuple[Any, int, Optional[float]]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _alive(record, now: float) -> bool:
+        return record[2] is None or record[2] > now
+
+    def get_versioned(self, ns, key):
+        record = self._data.get(ns, {}).get(key)
+        if record is None or not self._alive(record, time.time()):
+            return None, 0
+        return record[0], record[1]
+
+    def set(self, ns, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            bucket = self._data.setdefault(ns, {})
+            old = bucket.get(key)
+            bucket[key] = (value, (old[1] if old else 0) + 1, expires)
+
+    def delete(self, ns, key):
+        with self._lock:
+            record = self._data.get(ns, {}).pop(key, None)
+        if record is None or not self._alive(record, time.time()):
+            return None
+        return record[0]
+
+    def compare_and_set(self, ns, key, version, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            bucket = self._data.setdefault(ns, {})
+            old = bucket.get(key)
+            if old is not None and not self._alive(old, now):
+                old = None
+            current = old[1] if old else 0
+            if current != version:
+                return False
+            bucket[key] = (value, version + 1, now + ttl if ttl else None)
+            return True
+
+    def items(self, ns):
+        now = time.time()
+        return [(k, r[0]) for k, r in list(self._data.get(ns, {}).items()) if self._alive(r, now)]
+
+    def purge_expired(self):
+        now = time.time()
+        removed = 0
+        with self._lock:
+            for bucket in self._data.values():
+                for key in [k for k, r in bucket.items() if not self._alive(r, now)]:
+                    del bucket[key]
+                    removed += 1
+        return removed
+
+
+class SQLStateStore(StateStore):
+    """Backend storing JSON-encoded values in a ``state_kv`` table.
+
+    ``connect`` is a ``get_db``-style factory from :mod:`db_pg` or :mod:`db`.
+    """
+
+    blocking = True
+
+    def __init__(self, connect: Callable[[], Any]) -> None:
+        self._connect = connect
+
+    @staticmethod
+    def _key(key: Any) -> str:
+        return repr(key)
+
+    @staticmethod
+    def _expires(ttl: Optional[float]) -> Optional[float]:
+        return time.time() + ttl if ttl else None
+
+    def setup(self):
+        conn = self._connect()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS state_kv (
+                ns TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BYTEA,
+                version INTEGER NOT NULL,
+                expires_at DOUBLE PRECISION,
+                PRIMARY KEY (ns, key)
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_state_kv_expires ON state_kv (expires_at)")
+        conn.commit()
+        conn.close()
+
+    def get_versioned(self, ns, key):
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT value, version FROM state_kv WHERE ns=? AND key=? "
+            "AND (expires_at IS NULL OR expires_at > ?)",
+            (ns, self._key(key), time.time()),
+        )
+        row = cur.fetchone()
+        conn.close()
+        if not row:
+            return None, 0
+        return loads(row[0]), row[1]
+
+    def set(self, ns, key, value, ttl=None):
+        conn = self._connect()
+        conn.execute(
+            "INSERT INTO state_kv (ns, key, value, version, expires_at) VALUES (?, ?, ?, 1, ?) "
+            "ON CONFLICT (ns, key) DO UPDATE SET value=EXCLUDED.value, "
+            "version=state_kv.version + 1, expires_at=EXCLUDED.expires_at",
+            (ns, self._key(key), dumps(value), self._expires(ttl)),
+        )
+        conn.commit()
+        conn.close()
+
+    def delete(self, ns, key):
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute(
+            "DELETE FROM state_kv WHERE ns=? AND key=? RETURNING value, expires_at",
+            (ns, self._key(key)),
+        )
+        row = cur.fetchone()
+        conn.commit()
+        conn.close()
+        if not row or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return loads(row[0])
+
+    def compare_and_set(self, ns, key, version, value, ttl=None):
+        now = time.time()
+        conn = self._connect()
+        cur = conn.cursor()
+        if version == 0:
+            # an expired row counts as missing
+            cur.execute(
+                "DELETE FROM state_kv WHERE ns=? AND key=? AND expires_at <= ?",
+                (ns, self._key(key), now),
+            )
+            cur.execute(
+                "INSERT INTO state_kv (ns, key, value, version, expires_at) VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT (ns, key) DO NOTHING",
+                (ns, self._key(key), dumps(value), self._expires(ttl)),
+            )
+        else:
+            cur.execute(
+                "UPDATE state_kv SET value=?, version=version + 1, expires_at=? "
+                "WHERE ns=? AND key=? AND version=? AND (expires_at IS NULL OR expires_at > ?)",
+                (dumps(value), self._expires(ttl), ns, self._key(key), version, now),
+            )
+        ok = cur.rowcount == 1
+        conn.commit()
+        conn.close()
+        return ok
+
+    def items(self, ns):
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT key, value FROM state_kv WHERE ns=? AND (expires_at IS NULL OR expires_at > ?)",
+            (ns, time.time()),
+        )
+        rows = cur.fetchall()
+        conn.close()
+        return [(ast.literal_eval(k), loads(v)) for k, v in rows]
+
+    def purge_expired(self):
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute("DELETE FROM state_kv WHERE expires_at <= ?", (time.time(),))
+        removed = cur.rowcount
+        conn.commit()
+        conn.close()
+        return removed
+
+
+class StateMapping:
+    """Dict-like view over one namespace of a :class:`StateStore`."""
+
+    def __init__(self, store: StateStore, ns: str, ttl: Optional[float] = None) -> None:
+        self.store = store
+        self.ns = ns
+        self.ttl = ttl
+
+    def __getitem__(self, key):
+        value, version = self.store.get_versioned(self.ns, key)
+        if not version:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.store.set(self.ns, key, value, self.ttl)
+
+    def __delitem__(self, key):
+        self.store.delete(self.ns, key)
+
+    def __contains__(self, key):
+        return self.store.get_versioned(self.ns, key)[1] > 0
+
+    def __iter__(self) -> Iterator:
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.store.items(self.ns))
+
+    def get(self, key, default=None):
+        return self.store.get(self.ns, key, default)
+
+    def pop(self, key, default=_MISSING):
+        value = self.store.delete(self.ns, key)
+        if value is None:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        return value
+
+    def update(self, key, fn):
+        return self.store.update(self.ns, key, fn, self.ttl)
+
+    def keys(self):
+        return [k for k, _ in self.store.items(self.ns)]
+
+    def items(self):
+        return self.store.items(self.ns)
+
+    def values(self):
+        return [v for _, v in self.store.items(self.ns)]
+
+    def clear(self):
+        for key in self.keys():
+            self.store.delete(self.ns, key)
+
+    async def aget(self, key, default=None):
+        return await self.store.run(self.get, key, default)
+
+    async def acontains(self, key) -> bool:
+        return await self.store.run(self.__contains__, key)
+
+    async def aset(self, key, value) -> None:
+        await self.store.run(self.__setitem__, key, value)
+
+    async def apop(self, key, default=None):
+        return await self.store.run(self.pop, key, default)
+
+    async def aupdate(self, key, fn):
+        return await self.store.run(self.update, key, fn)
+
+
+def create_store(kind: str | None = None) -> StateStore:
+    """Build the backend selected by ``STATE_STORE`` (``memory`` or ``sql``)."""
+    kind = (kind or os.getenv("STATE_STORE") or "memory").lower()
+    if kind == "sql":
+        import db_pg
+
+        return SQLStateStore(db_pg.get_db)
+    return MemoryStateStore()
+
+
+STORE = create_store()
@@ -0,0 +1,111 @@
+"""Username directory: ``user_id -> username`` with batched lookups.
+
+Lists of players (admin logs, online users, leaderboard heads) resolve all
+their names with one ``id IN (...)`` / ``id = ANY(?)`` query through
+:meth:`UsernameDirectory.resolve`.  Results are kept in a bounded LRU
+cache.  Incoming updates feed :meth:`UsernameDirectory.observe` with the
+sender's current username; changes are held in memory and written back in
+one batch by :meth:`UsernameDirectory.flush`.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+_MISSING = object()
+
+
+class UsernameDirectory:
+    """Bounded LRU cache of usernames in front of the ``users`` table.
+
+    ``in_clause(column, values)`` builds the dialect-specific membership
+    test, as :func:`db_pg.in_clause` does.  Users without a username (or
+    without a row) are cached as ``None`` so they are not looked up again.
+    """
+
+    def __init__(
+        self,
+        get_db: Callable,
+        in_clause: Callable[[str, Iterable], Tuple[str, tuple]],
+        max_size: int = 10000,
+    ) -> None:
+        self._get_db = get_db
+        self._in_clause = in_clause
+        self.max_size = max_size
+        self._cache: "OrderedDict[int, Optional[str]]" = OrderedDict()
+        self._dirty: Dict[int, Optional[str]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _put(self, user_id: int, username: Optional[str]) -> None:
+        self._cache[user_id] = username
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def observe(self, user_id: int, username: Optional[str]) -> bool:
+        """Record the name seen on an update; return ``True`` if it changed."""
+        username = username or None
+        with self._lock:
+            cached = self._cache.get(user_id, _MISSING)
+            self._put(user_id, username)
+            if cached == username:
+                return False
+            self._dirty[user_id] = username
+            return True
+
+    def resolve(self, user_ids: Iterable[int]) -> Dict[int, Optional[str]]:
+        """Return ``{user_id: username}`` for ``user_ids``, one query for misses."""
+        names: Dict[int, Optional[str]] = {}
+        missing = []
+        with self._lock:
+            for uid in dict.fromkeys(user_ids):
+                cached = self._cache.get(uid, _MISSING)
+                if cached is _MISSING:
+                    missing.append(uid)
+                else:
+                    self._cache.move_to_end(uid)
+                    names[uid] = cached
+        if not missing:
+            return names
+        clause, params = self._in_clause("id", missing)
+        conn = self._get_db()
+        c = conn.cursor()
+        c.execute(f"SELECT id, username FROM users WHERE {clause}", params)
+        found = {uid: uname or None for uid, uname in c.fetchall()}
+        conn.close()
+        with self._lock:
+            for uid in missing:
+                # a name observed while the query ran is newer than the row
+                username = self._cache.get(uid, found.get(uid))
+                self._put(uid, username)
+                names[uid] = username
+        return names
+
+    def get(self, user_id: int) -> Optional[str]:
+        return self.resolve((user_id,)).get(user_id)
+
+    def flush(self) -> int:
+        """Write observed name changes to ``users``; return how many."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        conn = self._get_db()
+        c = conn.cursor()
+        c.executemany(
+            "UPDATE users SET username=? WHERE id=?",
+            [(uname or "", uid) for uid, uname in dirty.items()],
+        )
+        conn.commit()
+        conn.close()
+        return len(dirty)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._dirty.clear()
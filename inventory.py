@@ -0,0 +1,782 @@
+"""Card inventory mutations and the per-user counters they maintain.
+
+Every change to ``inventory`` made through this module also updates three
+counter tables in the same transaction:
+
+* ``user_cards`` – copies of every card a user owns,
+* ``user_stats`` – unique cards and total copies per user,
+* ``user_group_counts`` – the same numbers per rarity and per club.
+
+Readers get collection totals with a single primary-key lookup.
+:func:`check_counters_sync` compares the counters with ``inventory`` and
+rebuilds any user that drifted.
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import db_pg as db
+from cards import CARD_FIELDS, RARITY_ORDER
+
+_COLUMNS = ", ".join(CARD_FIELDS)
+
+# club key of a card, the same as ``card.get("team_en") or card.get("team_ru")``
+_CLUB_SQL = "COALESCE(NULLIF(c.team_en, ''), c.team_ru)"
+
+COUNTER_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS user_cards (
+        user_id BIGINT NOT NULL,
+        card_id INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (user_id, card_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id BIGINT PRIMARY KEY,
+        uniq INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_group_counts (
+        user_id BIGINT NOT NULL,
+        kind TEXT NOT NULL,
+        grp TEXT NOT NULL,
+        uniq INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, kind, grp)
+    )
+    """,
+]
+
+# callbacks ``fn(user_id, cards)`` run after cards were added to an inventory
+_grant_listeners: List[Callable[[int, List[Dict]], None]] = []
+
+
+def add_grant_listener(fn: Callable[[int, List[Dict]], None]) -> None:
+    """Register ``fn`` to be told about every successful grant."""
+    _grant_listeners.append(fn)
+
+
+# callbacks ``fn(user_id, cards)`` run after cards left an inventory
+_remove_listeners: List[Callable[[int, List[Dict]], None]] = []
+
+
+def add_remove_listener(fn: Callable[[int, List[Dict]], None]) -> None:
+    """Register ``fn`` to be told about every removal and traded-away card."""
+    _remove_listeners.append(fn)
+
+
+def _notify(user_id: int, cards: List[Dict], listeners=None) -> None:
+    if not cards:
+        return
+    for fn in _grant_listeners if listeners is None else listeners:
+        fn(user_id, cards)
+
+
+def setup_counters() -> None:
+    """Create counter tables and fill them if they were just added."""
+    conn = db.get_db()
+    for stmt in COUNTER_SCHEMA:
+        conn.execute(stmt)
+    conn.commit()
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM user_stats LIMIT 1")
+    empty = cur.fetchone() is None
+    conn.close()
+    if empty:
+        rebuild_counters_sync()
+
+
+# rows per multi-row INSERT, keeps SQLite under its bound-parameter limit
+INSERT_CHUNK = 500
+
+
+def _insert_cards(cur, user_id: int, card_ids: List[int], now: int) -> None:
+    for start in range(0, len(card_ids), INSERT_CHUNK):
+        chunk = card_ids[start:start + INSERT_CHUNK]
+        values = ", ".join(["(?, ?, ?)"] * len(chunk))
+        params = []
+        for cid in chunk:
+            params.extend((user_id, cid, now))
+        cur.execute(f"INSERT INTO inventory (user_id, card_id, time_got) VALUES {values}", params)
+
+
+def _fetch_cards(cur, card_ids: Iterable[int]) -> Dict[int, Dict]:
+    clause, params = db.in_clause("id", set(card_ids))
+    cur.execute(f"SELECT {_COLUMNS} FROM cards WHERE {clause}", params)
+    return {row[0]: dict(zip(CARD_FIELDS, row)) for row in cur.fetchall()}
+
+
+def _bump_counters(cur, user_id: int, deltas: Dict[int, int], cards: Dict[int, Dict]) -> Tuple[int, int]:
+    """Apply per-card ``deltas`` to the counters and return ``(uniq, total)``.
+
+    Cards missing from ``cards`` (deleted from the catalog) are not counted,
+    matching how collection screens join ``inventory`` with ``cards``.
+    """
+    uniq = total = 0
+    groups: Dict[Tuple[str, str], List[int]] = {}
+    emptied = False
+    for cid, delta in deltas.items():
+        card = cards.get(cid)
+        if not delta or card is None:
+            continue
+        cur.execute(
+            "INSERT INTO user_cards (user_id, card_id, count) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, card_id) DO UPDATE SET count = user_cards.count + EXCLUDED.count "
+            "RETURNING count",
+            (user_id, cid, delta),
+        )
+        new = cur.fetchone()[0]
+        old = new - delta
+        d_uniq = (new > 0) - (old > 0)
+        emptied = emptied or new <= 0
+        uniq += d_uniq
+        total += delta
+        club = card.get("team_en") or card.get("team_ru")
+        for key in (("rarity", card.get("rarity")), ("club", club)):
+            if key[1]:
+                acc = groups.setdefault(key, [0, 0])
+                acc[0] += d_uniq
+                acc[1] += delta
+    if emptied:
+        cur.execute("DELETE FROM user_cards WHERE user_id=? AND count <= 0", (user_id,))
+    for (kind, grp), (d_uniq, d_total) in groups.items():
+        cur.execute(
+            "INSERT INTO user_group_counts (user_id, kind, grp, uniq, total) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id, kind, grp) DO UPDATE SET "
+            "uniq = user_group_counts.uniq + EXCLUDED.uniq, total = user_group_counts.total + EXCLUDED.total",
+            (user_id, kind, grp, d_uniq, d_total),
+        )
+    cur.execute(
+        "INSERT INTO user_stats (user_id, uniq, total) VALUES (?, ?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET "
+        "uniq = user_stats.uniq + EXCLUDED.uniq, total = user_stats.total + EXCLUDED.total "
+        "RETURNING uniq, total",
+        (user_id, uniq, total),
+    )
+    row = cur.fetchone()
+    return row[0], row[1]
+
+
+def _grant(cur, user_id: int, card_ids: List[int], now: int, cards: Dict[int, Dict] | None = None):
+    if cards is None:
+        cards = _fetch_cards(cur, card_ids)
+    _insert_cards(cur, user_id, card_ids, now)
+    counts = _bump_counters(cur, user_id, Counter(card_ids), cards)
+    granted = [cards[cid] for cid in card_ids if cid in cards]
+    return granted, counts
+
+
+def grant_cards_sync(user_id: int, card_ids: Iterable[int], now: int | None = None) -> List[Dict]:
+    """Add cards by id with one multi-row ``INSERT`` and return them."""
+    card_ids = list(card_ids)
+    if not card_ids:
+        return []
+    now = int(time.time()) if now is None else now
+    conn = db.get_db()
+    cur = conn.cursor()
+    granted, _ = _grant(cur, user_id, card_ids, now)
+    conn.commit()
+    conn.close()
+    _notify(user_id, granted)
+    return granted
+
+
+def grant_random_cards_sync(user_id: int, k: int) -> List[Dict]:
+    """Draw ``k`` distinct random cards and grant them in one transaction."""
+    if k <= 0:
+        return []
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(f"SELECT {_COLUMNS} FROM cards ORDER BY RANDOM() LIMIT ?", (k,))
+    drawn = {row[0]: dict(zip(CARD_FIELDS, row)) for row in cur.fetchall()}
+    cards: List[Dict] = []
+    if drawn:
+        cards, _ = _grant(cur, user_id, list(drawn), int(time.time()), drawn)
+        conn.commit()
+    conn.close()
+    _notify(user_id, cards)
+    return cards
+
+
+def _bulk_grant(cur, where: List[str], params: List, now: int) -> Dict[int, List[Dict]]:
+    """Grant the missing pairs selected by ``where``; return ``{user_id: cards}``."""
+    cur.execute(
+        f"""
+        CREATE TEMP TABLE bulk_grant AS
+        SELECT u.id AS user_id, c.id AS card_id
+          FROM users u CROSS JOIN cards c
+         WHERE {' AND '.join(where)}
+           AND NOT EXISTS (SELECT 1 FROM user_cards uc WHERE uc.user_id = u.id AND uc.card_id = c.id)
+        """,
+        params,
+    )
+    # ``WHERE 1=1`` keeps SQLite from reading ON CONFLICT as a join constraint
+    cur.execute(
+        "INSERT INTO user_cards (user_id, card_id, count) SELECT user_id, card_id, 1 FROM bulk_grant WHERE 1=1 "
+        "ON CONFLICT (user_id, card_id) DO NOTHING RETURNING user_id, card_id"
+    )
+    added = cur.fetchall()
+    cur.execute("SELECT COUNT(*) FROM bulk_grant")
+    if cur.fetchone()[0] != len(added):
+        # a concurrent /card or trade gave some of these cards first
+        cur.execute("DELETE FROM bulk_grant")
+        cur.executemany("INSERT INTO bulk_grant (user_id, card_id) VALUES (?, ?)", [tuple(r) for r in added])
+    cur.execute("INSERT INTO inventory (user_id, card_id, time_got) SELECT user_id, card_id, ? FROM bulk_grant", (now,))
+    cur.execute(
+        "INSERT INTO user_stats (user_id, uniq, total) "
+        "SELECT user_id, COUNT(*), COUNT(*) FROM bulk_grant WHERE 1=1 GROUP BY user_id "
+        "ON CONFLICT (user_id) DO UPDATE SET "
+        "uniq = user_stats.uniq + EXCLUDED.uniq, total = user_stats.total + EXCLUDED.total"
+    )
+    for kind, expr in (("rarity", "c.rarity"), ("club", _CLUB_SQL)):
+        cur.execute(
+            f"""
+            INSERT INTO user_group_counts (user_id, kind, grp, uniq, total)
+            SELECT g.user_id, '{kind}', {expr}, COUNT(*), COUNT(*)
+              FROM bulk_grant g JOIN cards c ON c.id = g.card_id
+             WHERE {expr} IS NOT NULL AND {expr} != ''
+          GROUP BY g.user_id, {expr}
+            ON CONFLICT (user_id, kind, grp) DO UPDATE SET
+                uniq = user_group_counts.uniq + EXCLUDED.uniq,
+                total = user_group_counts.total + EXCLUDED.total
+            """
+        )
+    columns = ", ".join(f"c.{field}" for field in CARD_FIELDS)
+    cur.execute(f"SELECT g.user_id, {columns} FROM bulk_grant g JOIN cards c ON c.id = g.card_id")
+    granted: Dict[int, List[Dict]] = {}
+    for row in cur.fetchall():
+        granted.setdefault(row[0], []).append(dict(zip(CARD_FIELDS, row[1:])))
+    cur.execute("DROP TABLE bulk_grant")
+    return granted
+
+
+def bulk_grant_sync(
+    user_ids: Iterable[int],
+    *,
+    rarity: str | None = None,
+    club: str | None = None,
+    now: int | None = None,
+) -> Dict[int, int]:
+    """Give each user one copy of every matching card they do not own yet.
+
+    ``rarity`` and ``club`` narrow the catalog; without them every card is
+    granted.  Users missing from ``users`` are skipped.  The missing
+    ``(user, card)`` pairs are computed once in SQL into a temporary table,
+    which then feeds ``inventory`` and all three counter tables with one
+    statement each, whatever the catalog size.  Pairs another grant added
+    in the meantime are dropped at the ``user_cards`` insert instead of
+    failing the whole grant.  Returns ``{user_id: cards added}`` for users
+    that got anything.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    now = int(time.time()) if now is None else now
+    users_clause, params = db.in_clause("u.id", user_ids)
+    where = [users_clause]
+    params = list(params)
+    if rarity:
+        where.append("c.rarity=?")
+        params.append(rarity)
+    if club:
+        where.append(f"{_CLUB_SQL}=?")
+        params.append(club)
+    conn = db.get_db()
+    db.begin_write(conn)
+    cur = conn.cursor()
+    try:
+        granted = _bulk_grant(cur, where, params, now)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    for uid, cards in granted.items():
+        _notify(uid, cards)
+    return {uid: len(cards) for uid, cards in granted.items()}
+
+
+def remove_card_sync(user_id: int, card_id: int) -> bool:
+    """Remove one copy of ``card_id``. Return ``False`` if none was owned."""
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(
+        f"DELETE FROM inventory WHERE {db.ROW_ID} IN "
+        f"(SELECT {db.ROW_ID} FROM inventory WHERE user_id=? AND card_id=? LIMIT 1)",
+        (user_id, card_id),
+    )
+    removed = cur.rowcount > 0
+    cards: Dict[int, Dict] = {}
+    if removed:
+        cards = _fetch_cards(cur, [card_id])
+        _bump_counters(cur, user_id, {card_id: -1}, cards)
+    conn.commit()
+    conn.close()
+    _notify(user_id, list(cards.values()), _remove_listeners)
+    return removed
+
+
+def _take_cards(cur, user_id: int, wanted: Counter) -> int:
+    """Delete ``wanted[card_id]`` copies of each card with one statement."""
+    clause, params = db.in_clause("card_id", wanted)
+    quota = " ".join("WHEN ? THEN ?" for _ in wanted)
+    quota_params = [v for item in wanted.items() for v in item]
+    cur.execute(
+        f"DELETE FROM inventory WHERE {db.ROW_ID} IN ("
+        f"SELECT rid FROM (SELECT {db.ROW_ID} AS rid, card_id, "
+        "ROW_NUMBER() OVER (PARTITION BY card_id) AS rn "
+        f"FROM inventory WHERE user_id=? AND {clause}) picked "
+        f"WHERE rn <= CASE card_id {quota} END)",
+        [user_id, *params, *quota_params],
+    )
+    return cur.rowcount
+
+
+def trade_cards_sync(
+    first_id: int,
+    first_cards: Iterable[int],
+    second_id: int,
+    second_cards: Iterable[int],
+    now: int | None = None,
+) -> Dict | None:
+    """Swap ``first_cards`` of ``first_id`` for ``second_cards`` of ``second_id``.
+
+    Ownership is checked on locked counter rows and every card moves in the
+    same transaction, so a trade either happens completely or not at all.
+    Returns ``None`` when a side no longer owns what it offered, otherwise a
+    receipt ``{"time", "users", "gave": {uid: cards}, "counts": {uid: (uniq, total)}}``.
+    """
+    give = {first_id: Counter(first_cards), second_id: Counter(second_cards)}
+    if first_id == second_id:
+        return None
+    now = int(time.time()) if now is None else now
+    conn = db.get_db()
+    db.begin_write(conn)
+    cur = conn.cursor()
+    all_ids = set(give[first_id]) | set(give[second_id])
+    clause, params = db.in_clause("card_id", all_ids)
+    # a fixed lock order keeps crossing trades from deadlocking
+    cur.execute(
+        f"SELECT user_id, card_id, count FROM user_cards WHERE user_id IN (?, ?) AND {clause} "
+        f"ORDER BY user_id, card_id{db.FOR_UPDATE}",
+        (first_id, second_id, *params),
+    )
+    owned = {(uid, cid): cnt for uid, cid, cnt in cur.fetchall()}
+    ok = all(
+        owned.get((uid, cid), 0) >= n for uid, wanted in give.items() for cid, n in wanted.items()
+    )
+    if ok:
+        ok = all(
+            not wanted or _take_cards(cur, uid, wanted) == sum(wanted.values())
+            for uid, wanted in give.items()
+        )
+    if not ok:
+        conn.rollback()
+        conn.close()
+        return None
+
+    cards = _fetch_cards(cur, all_ids)
+    counts = {}
+    for uid, other in ((first_id, second_id), (second_id, first_id)):
+        _insert_cards(cur, other, list(give[uid].elements()), now)
+        deltas = dict(give[other])
+        for cid, n in give[uid].items():
+            deltas[cid] = deltas.get(cid, 0) - n
+        counts[uid] = _bump_counters(cur, uid, deltas, cards)
+    conn.commit()
+    conn.close()
+
+    gave = {
+        uid: [cards[cid] for cid in wanted.elements() if cid in cards] for uid, wanted in give.items()
+    }
+    for uid, other in ((first_id, second_id), (second_id, first_id)):
+        _notify(uid, gave[uid], _remove_listeners)
+        _notify(uid, gave[other])
+    return {"time": now, "users": (first_id, second_id), "gave": gave, "counts": counts}
+
+
+# cards without a real photo, or whose photo Telegram cannot fetch
+# (``img_dead``, see :func:`cards.mark_image_dead`), are never handed out by /card
+_DRAWABLE = (
+    "img NOT LIKE '%default-skater.png%' "
+    "AND img NOT LIKE '%default-goalie.png%' "
+    "AND img != '' AND img IS NOT NULL "
+    "AND COALESCE(img_dead, 0) = 0"
+)
+
+
+def draw_card(cur, rarity: str) -> Dict | None:
+    """Pick a random card with a photo of the given ``rarity``."""
+    cur.execute(
+        f"SELECT {_COLUMNS} FROM cards WHERE rarity=? AND {_DRAWABLE} ORDER BY RANDOM() LIMIT 1",
+        (rarity,),
+    )
+    row = cur.fetchone()
+    return dict(zip(CARD_FIELDS, row)) if row else None
+
+
+def claim_card_sync(user_id: int, rarity: str, cooldown: int, now: int | None = None):
+    """Atomically claim the ``/card`` drop for ``user_id``.
+
+    The cooldown check, the card insert and the collection count run in one
+    transaction, so a double tap can never claim twice.  Returns
+    ``(card, total_cards, wait)``: on success ``wait`` is ``0``; while the
+    cooldown runs ``card`` is ``None`` and ``wait`` is the seconds left; if
+    no card of ``rarity`` exists both are empty and nothing is written.
+    """
+    now = int(time.time()) if now is None else now
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO users (id, last_card_time) VALUES (?, ?) "
+        "ON CONFLICT (id) DO UPDATE SET last_card_time=EXCLUDED.last_card_time "
+        "WHERE COALESCE(users.last_card_time, 0) <= ? "
+        "RETURNING id",
+        (user_id, now, now - cooldown),
+    )
+    if cur.fetchone() is None:
+        cur.execute("SELECT last_card_time FROM users WHERE id=?", (user_id,))
+        row = cur.fetchone()
+        conn.rollback()
+        conn.close()
+        last = row[0] if row and row[0] else 0
+        return None, 0, max(1, cooldown - (now - last))
+    card = draw_card(cur, rarity)
+    if card is None:
+        conn.rollback()
+        conn.close()
+        return None, 0, 0
+    _, (_, total) = _grant(cur, user_id, [card["id"]], now, {card["id"]: card})
+    conn.commit()
+    conn.close()
+    _notify(user_id, [card])
+    return card, total, 0
+
+
+def get_counts(user_id: int) -> Tuple[int, int]:
+    """Return ``(unique_cards, total_copies)`` for ``user_id``."""
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT uniq, total FROM user_stats WHERE user_id=?", (user_id,))
+    row = cur.fetchone()
+    conn.close()
+    return (row[0], row[1]) if row else (0, 0)
+
+
+def get_group_counts(user_id: int, kind: str) -> Dict[str, Tuple[int, int]]:
+    """Return ``{group: (unique, total)}`` for ``kind`` ``rarity`` or ``club``."""
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT grp, uniq, total FROM user_group_counts WHERE user_id=? AND kind=? AND total > 0",
+        (user_id, kind),
+    )
+    data = {grp: (uniq, total) for grp, uniq, total in cur.fetchall()}
+    conn.close()
+    return data
+
+
+def _user_filter(column: str, user_ids) -> Tuple[str, tuple]:
+    if user_ids is None:
+        return "1=1", ()
+    return db.in_clause(column, user_ids)
+
+
+def rebuild_counters_sync(user_ids: Iterable[int] | None = None) -> None:
+    """Recompute counters from ``inventory`` for ``user_ids`` (all if ``None``)."""
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+    conn = db.get_db()
+    _rebuild_counters(conn.cursor(), user_ids)
+    conn.commit()
+    conn.close()
+
+
+def _rebuild_counters(cur, user_ids: List[int] | None) -> None:
+    for table in ("user_cards", "user_stats", "user_group_counts"):
+        where, params = _user_filter("user_id", user_ids)
+        cur.execute(f"DELETE FROM {table} WHERE {where}", params)
+    where, params = _user_filter("inventory.user_id", user_ids)
+    cur.execute(
+        f"""
+        INSERT INTO user_cards (user_id, card_id, count)
+        SELECT inventory.user_id, inventory.card_id, COUNT(*)
+          FROM inventory JOIN cards ON cards.id = inventory.card_id
+         WHERE {where}
+      GROUP BY inventory.user_id, inventory.card_id
+        """,
+        params,
+    )
+    where, params = _user_filter("user_id", user_ids)
+    cur.execute(
+        f"""
+        INSERT INTO user_stats (user_id, uniq, total)
+        SELECT user_id, COUNT(*), SUM(count) FROM user_cards WHERE {where} GROUP BY user_id
+        """,
+        params,
+    )
+    where, params = _user_filter("uc.user_id", user_ids)
+    for kind, expr in (("rarity", "c.rarity"), ("club", _CLUB_SQL)):
+        cur.execute(
+            f"""
+            INSERT INTO user_group_counts (user_id, kind, grp, uniq, total)
+            SELECT uc.user_id, '{kind}', {expr}, COUNT(*), SUM(uc.count)
+              FROM user_cards uc JOIN cards c ON c.id = uc.card_id
+             WHERE {where} AND {expr} IS NOT NULL AND {expr} != ''
+          GROUP BY uc.user_id, {expr}
+            """,
+            params,
+        )
+
+
+def delete_card_sync(card_id: int) -> List[int]:
+    """Delete ``card_id`` from the catalog and recount everyone who held it.
+
+    ``inventory`` rows stay, like for any card missing from ``cards``; the
+    holders' counters are rebuilt in the same transaction.  Returns the
+    holders.
+    """
+    conn = db.get_db()
+    db.begin_write(conn)
+    cur = conn.cursor()
+    cur.execute("SELECT user_id FROM user_cards WHERE card_id=?", (card_id,))
+    holders = [row[0] for row in cur.fetchall()]
+    cur.execute("DELETE FROM cards WHERE id=?", (card_id,))
+    if holders:
+        _rebuild_counters(cur, holders)
+    conn.commit()
+    conn.close()
+    return holders
+
+
+def check_counters_sync(fix: bool = True) -> List[int]:
+    """Return users whose counters disagree with ``inventory``.
+
+    All three counter tables are compared.  With ``fix`` those users are
+    rebuilt from scratch.
+    """
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT inventory.user_id, inventory.card_id, COUNT(*)
+          FROM inventory JOIN cards ON cards.id = inventory.card_id
+      GROUP BY inventory.user_id, inventory.card_id
+        """
+    )
+    expected: Dict[int, Dict[int, int]] = {}
+    for uid, cid, cnt in cur.fetchall():
+        expected.setdefault(uid, {})[cid] = cnt
+    cur.execute("SELECT user_id, card_id, count FROM user_cards WHERE count > 0")
+    actual: Dict[int, Dict[int, int]] = {}
+    for uid, cid, cnt in cur.fetchall():
+        actual.setdefault(uid, {})[cid] = cnt
+    cur.execute("SELECT user_id, uniq, total FROM user_stats")
+    stats = {uid: (uniq, total) for uid, uniq, total in cur.fetchall()}
+    expected_groups: Dict[int, Dict[Tuple[str, str], Tuple[int, int]]] = {}
+    for kind, expr in (("rarity", "c.rarity"), ("club", _CLUB_SQL)):
+        cur.execute(
+            f"""
+            SELECT inventory.user_id, {expr}, COUNT(DISTINCT inventory.card_id), COUNT(*)
+              FROM inventory JOIN cards c ON c.id = inventory.card_id
+             WHERE {expr} IS NOT NULL AND {expr} != ''
+          GROUP BY inventory.user_id, {expr}
+            """
+        )
+        for uid, grp, uniq, total in cur.fetchall():
+            expected_groups.setdefault(uid, {})[(kind, grp)] = (uniq, total)
+    # emptied groups keep a zero row
+    cur.execute("SELECT user_id, kind, grp, uniq, total FROM user_group_counts WHERE uniq != 0 OR total != 0")
+    groups: Dict[int, Dict[Tuple[str, str], Tuple[int, int]]] = {}
+    for uid, kind, grp, uniq, total in cur.fetchall():
+        groups.setdefault(uid, {})[(kind, grp)] = (uniq, total)
+    conn.close()
+
+    drifted = []
+    for uid in set(expected) | set(actual) | set(stats) | set(groups):
+        cards = expected.get(uid, {})
+        if (
+            actual.get(uid, {}) != cards
+            or stats.get(uid, (0, 0)) != (len(cards), sum(cards.values()))
+            or groups.get(uid, {}) != expected_groups.get(uid, {})
+        ):
+            drifted.append(uid)
+    if drifted:
+        logging.warning("Inventory counters drifted for %d users", len(drifted))
+        if fix:
+            rebuild_counters_sync(drifted)
+    return drifted
+
+
+# cards granted within this many seconds count as "new"
+NEW_CARD_WINDOW = 24 * 3600
+
+
+def _rank_sql(column: str) -> str:
+    whens = " ".join(f"WHEN '{rarity}' THEN {rank}" for rarity, rank in RARITY_ORDER.items())
+    return f"CASE {column} {whens} ELSE 99 END"
+
+
+# rarity position of ``c``; computed per row so new or re-rated cards sort right
+_RANK_SQL = _rank_sql("c.rarity")
+
+
+def setup_collection_index() -> None:
+    """Index the collection sort key ``(rarity rank, name, id)``.
+
+    The rank is an expression over ``rarity``, so cards added or re-rated
+    later sort correctly without a stored column to keep in step.
+    """
+    conn = db.get_db()
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_cards_rank_sort ON cards (({_rank_sql('rarity')}), name, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_inventory_user_time ON inventory (user_id, time_got)")
+    conn.commit()
+    conn.close()
+
+
+def _collection_query(user_id: int, flt: Dict) -> Tuple[str, List]:
+    """Return ``FROM ... WHERE`` selecting a user's cards matching ``flt``.
+
+    ``flt`` may hold ``rarity``, ``club``, ``duplicates`` and ``new_only``.
+    The alias ``uc`` exposes ``card_id`` and ``cnt``, ``c`` is ``cards``.
+    """
+    if flt.get("new_only"):
+        having = " HAVING COUNT(*) > 1" if flt.get("duplicates") else ""
+        src = (
+            "(SELECT card_id, COUNT(*) AS cnt FROM inventory "
+            f"WHERE user_id=? AND time_got >= ? GROUP BY card_id{having}) uc"
+        )
+        params: List = [user_id, int(time.time()) - NEW_CARD_WINDOW]
+    else:
+        dupes = " AND count > 1" if flt.get("duplicates") else ""
+        src = f"(SELECT card_id, count AS cnt FROM user_cards WHERE user_id=?{dupes}) uc"
+        params = [user_id]
+    where = ["1=1"]
+    if flt.get("rarity"):
+        where.append("c.rarity=?")
+        params.append(flt["rarity"])
+    if flt.get("club"):
+        where.append(f"{_CLUB_SQL}=?")
+        params.append(flt["club"])
+    return f"FROM {src} JOIN cards c ON c.id = uc.card_id WHERE {' AND '.join(where)}", params
+
+
+def page_user_cards(
+    user_id: int,
+    flt: Dict,
+    *,
+    after=None,
+    before=None,
+    offset: int = 0,
+    limit: int = 20,
+) -> List[Tuple[int, int, Tuple]]:
+    """Return one page of ``(card_id, count, sort_key)`` rows.
+
+    Pages are addressed by the sort key of a neighbouring row: ``after``
+    returns the rows following it, ``before`` the rows preceding it.
+    ``offset`` is only used when no key is known yet.
+    """
+    body, params = _collection_query(user_id, flt)
+    order = "ASC"
+    if after is not None:
+        body += f" AND ({_RANK_SQL}, c.name, c.id) > (?, ?, ?)"
+        params.extend(after)
+    elif before is not None:
+        body += f" AND ({_RANK_SQL}, c.name, c.id) < (?, ?, ?)"
+        params.extend(before)
+        order = "DESC"
+    sql = (
+        f"SELECT c.id, uc.cnt, {_RANK_SQL} AS rarity_rank, c.name {body} "
+        f"ORDER BY rarity_rank {order}, c.name {order}, c.id {order} LIMIT ?"
+    )
+    params.append(limit)
+    if after is None and before is None and offset:
+        sql += " OFFSET ?"
+        params.append(offset)
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    rows = [(cid, cnt, (rank, name, cid)) for cid, cnt, rank, name in cur.fetchall()]
+    conn.close()
+    if order == "DESC":
+        rows.reverse()
+    return rows
+
+
+def count_user_cards(user_id: int, flt: Dict) -> Tuple[int, int]:
+    """Return ``(unique, total)`` for cards matching ``flt``."""
+    if not any(flt.get(k) for k in ("rarity", "club", "duplicates", "new_only")):
+        return get_counts(user_id)
+    body, params = _collection_query(user_id, flt)
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*), COALESCE(SUM(uc.cnt), 0) {body}", params)
+    row = cur.fetchone()
+    conn.close()
+    return row[0], row[1]
+
+
+def page_trade_cards(user_id: int, page: int, per_page: int) -> Tuple[List[Tuple[int, int, str, str]], int]:
+    """Return ``([(card_id, count, name, rarity)], total_pages)`` for one page.
+
+    Rows come ordered by ``card_id`` together with the number of owned
+    cards in one query.  An empty page past the end still reports the
+    total.
+    """
+    conn = db.get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT uc.card_id, uc.count, c.name, c.rarity, COUNT(*) OVER () "
+        "FROM user_cards uc JOIN cards c ON c.id = uc.card_id "
+        "WHERE uc.user_id=? ORDER BY uc.card_id LIMIT ? OFFSET ?",
+        (user_id, per_page, page * per_page),
+    )
+    rows = cur.fetchall()
+    if rows:
+        owned = rows[0][4]
+    else:
+        cur.execute(
+            "SELECT COUNT(*) FROM user_cards uc JOIN cards c ON c.id = uc.card_id WHERE uc.user_id=?",
+            (user_id,),
+        )
+        owned = cur.fetchone()[0]
+    conn.close()
+    return [row[:4] for row in rows], (owned + per_page - 1) // per_page
+
+
+async def claim_card(*args, **kwargs):
+    return await asyncio.to_thread(claim_card_sync, *args, **kwargs)
+
+
+async def grant_cards(*args, **kwargs) -> List[Dict]:
+    return await asyncio.to_thread(grant_cards_sync, *args, **kwargs)
+
+
+async def grant_random_cards(*args, **kwargs) -> List[Dict]:
+    return await asyncio.to_thread(grant_random_cards_sync, *args, **kwargs)
+
+
+async def bulk_grant(*args, **kwargs) -> Dict[int, int]:
+    return await asyncio.to_thread(bulk_grant_sync, *args, **kwargs)
+
+
+async def trade_cards(*args, **kwargs) -> Dict | None:
+    return await asyncio.to_thread(trade_cards_sync, *args, **kwargs)
+
+
+async def delete_card(*args, **kwargs) -> List[int]:
+    return await asyncio.to_thread(delete_card_sync, *args, **kwargs)
+
+
+async def check_counters(*args, **kwargs) -> List[int]:
+    return await asyncio.to_thread(check_counters_sync, *args, **kwargs)
@@ -0,0 +1,7 @@
+"""End-to-end load test for the bot.
+
+The real application from :func:`bot.build_application` is pointed at a
+local Bot API stand-in (:mod:`loadtest.fake_api`) and a seeded database
+(:mod:`loadtest.seed`), then fed synthetic traffic from many virtual users
+(:mod:`loadtest.traffic`).  Run it with ``python -m loadtest --help``.
+"""
@@ -0,0 +1,78 @@
+"""Command line entry: ``python -m loadtest --users 2000 --sessions 5000``."""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loadtest import runner, seed, traffic  # noqa: E402
+
+
+def _ms(seconds: float) -> str:
+    return "inf" if seconds == float("inf") else f"{seconds * 1000:.0f}"
+
+
+def print_report(report: dict) -> None:
+    print(f"updates: {report['updates']} in {report['seconds']:.1f}s, "
+          f"{report['updates_per_sec']:.1f} updates/s")
+    print("\nper command (end to end), ms:")
+    print(f"{'command':<24}{'n':>7}{'p50':>8}{'p95':>8}{'p99':>8}")
+    for label, n, p50, p95, p99 in report["commands"]:
+        print(f"{label:<24}{n:>7}{_ms(p50):>8}{_ms(p95):>8}{_ms(p99):>8}")
+    print("\nDB queries per handler:")
+    print(f"{'handler':<40}{'calls':>7}{'avg':>7}{'max':>6}")
+    for name, calls, avg, mx, _ in report["queries"]:
+        print(f"{name:<40}{calls:>7}{avg:>7.1f}{mx:>6}")
+    if report["errors"]:
+        print("\nhandler errors:", report["errors"])
+    print("\nBot API calls:", report["api_calls"])
+    if report["throttled"]:
+        print("429 responses:", report["throttled"])
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m loadtest", description=__doc__)
+    parser.add_argument("--users", type=int, default=1000, help="virtual users")
+    parser.add_argument("--sessions", type=int, default=3000, help="scenario runs across all users")
+    parser.add_argument("--concurrency", type=int, default=100, help="users active at once")
+    parser.add_argument("--mix", default="default",
+                        help=f"one of {', '.join(traffic.MIXES)} or scenario=weight,... "
+                             f"from {', '.join(traffic.SCENARIOS)}")
+    parser.add_argument("--cards", type=int, default=500, help="catalog size")
+    parser.add_argument("--per-user", type=int, default=40, help="cards in each inventory")
+    parser.add_argument("--db", choices=("sqlite", "pg"), default="sqlite",
+                        help="seeded SQLite file or the Postgres from PG* env vars")
+    parser.add_argument("--db-path", help="SQLite file (default: a temporary one)")
+    parser.add_argument("--no-seed", action="store_true", help="use the database as is")
+    parser.add_argument("--no-flood", action="store_true", help="never answer 429")
+    parser.add_argument("--per-chat", type=int, default=20, help="sends per chat per second")
+    parser.add_argument("--global-limit", type=int, default=30, help="sends per second overall")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.db == "sqlite":
+        path = args.db_path or os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "load.sqlite")
+        module = runner.use_sqlite(path)
+    else:
+        module = runner.use_postgres()
+    users = seed.user_ids(args.users)
+    owned = {} if args.no_seed else seed.seed(module, args.users, args.cards, args.per_user, args.seed)
+    sessions = traffic.sessions(users, owned, traffic.parse_mix(args.mix), args.sessions, args.seed)
+    report = runner.run(
+        sessions,
+        concurrency=args.concurrency,
+        flood=not args.no_flood,
+        per_chat=args.per_chat,
+        global_limit=args.global_limit,
+    )
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
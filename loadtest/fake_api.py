@@ -0,0 +1,171 @@
+"""Local Bot API stand-in that records calls and simulates flood limits.
+
+Every ``POST /bot<token>/<method>`` is answered like Telegram would for the
+methods the bot uses: sends and edits return a message, ``getChatMember``
+reports a subscriber and everything else returns ``True``.  Sends beyond
+``per_chat`` per second to one chat or ``global_limit`` per second overall
+get a 429 with ``retry_after``, as the real server does.
+"""
+
+from __future__ import annotations
+
+import collections
+import email.parser
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qsl
+
+# methods that count towards the flood limits
+SEND_METHODS = {
+    "sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument", "sendAnimation",
+    "editMessageText", "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup",
+}
+
+
+def parse_body(content_type: str, body: bytes) -> Dict[str, str]:
+    """Decode a urlencoded, multipart or JSON request body into a dict."""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        msg = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        params = {}
+        for part in msg.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                params[name] = "<file>"
+            else:
+                params[name] = part.get_payload(decode=True).decode()
+        return params
+    return dict(parse_qsl(body.decode()))
+
+
+class FloodLimiter:
+    """Sliding one-second windows per chat and overall."""
+
+    def __init__(self, per_chat: int = 20, global_limit: int = 30) -> None:
+        self.per_chat = per_chat
+        self.global_limit = global_limit
+        self._chats: Dict[str, collections.deque] = collections.defaultdict(collections.deque)
+        self._all: collections.deque = collections.deque()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _trim(window: collections.deque, now: float) -> None:
+        while window and now - window[0] >= 1.0:
+            window.popleft()
+
+    def allow(self, chat_id: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            chat = self._chats[chat_id]
+            self._trim(chat, now)
+            self._trim(self._all, now)
+            if len(chat) >= self.per_chat or len(self._all) >= self.global_limit:
+                return False
+            chat.append(now)
+            self._all.append(now)
+            return True
+
+
+class FakeBotAPI:
+    """Threaded HTTP server answering Bot API calls on ``host:port``.
+
+    ``port=0`` picks a free port; :attr:`base_url` is what to pass to
+    :func:`bot.build_application`.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, limiter: Optional[FloodLimiter] = None) -> None:
+        self.limiter = limiter
+        self.calls: collections.Counter = collections.Counter()
+        self.throttled: collections.Counter = collections.Counter()
+        self.sent_to: collections.Counter = collections.Counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        api = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                params = parse_body(self.headers.get("Content-Type", ""), body)
+                status, payload = api.handle(method, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self) -> "FakeBotAPI":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _message(self, params: Dict[str, str], method: str) -> dict:
+        chat_id = params.get("chat_id", "0")
+        message = {
+            "message_id": int(params.get("message_id") or next(self._ids)),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+        }
+        if method in ("sendPhoto", "editMessageMedia"):
+            message["photo"] = [{"file_id": f"photo-{message['message_id']}", "file_unique_id": "u", "width": 1, "height": 1}]
+            message["caption"] = params.get("caption", "")
+        else:
+            message["text"] = params.get("text") or params.get("caption") or ""
+        return message
+
+    def handle(self, method: str, params: Dict[str, str]):
+        """Return ``(http status, response body)`` for one API call."""
+        with self._lock:
+            self.calls[method] += 1
+        if method in SEND_METHODS:
+            chat_id = str(params.get("chat_id", ""))
+            if self.limiter and not self.limiter.allow(chat_id):
+                with self._lock:
+                    self.throttled[method] += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }
+            with self._lock:
+                self.sent_to[chat_id] += 1
+            return 200, {"ok": True, "result": self._message(params, method)}
+        if method == "getMe":
+            result = {
+                "id": 1, "is_bot": True, "first_name": "Load", "username": "load_test_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False,
+                "supports_inline_queries": False,
+            }
+        elif method == "getChatMember":
+            user_id = int(params.get("user_id", 0))
+            result = {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": str(user_id)}}
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
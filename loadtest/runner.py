@@ -0,0 +1,152 @@
+"""Drive the real application with synthetic sessions and collect a report."""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import time
+from typing import Dict, List, Optional
+
+from telegram import Update
+
+from helpers import metrics, query_profiler
+from loadtest.fake_api import FakeBotAPI, FloodLimiter
+from loadtest.traffic import Step, UpdateFactory
+
+
+def use_sqlite(path: str, trace: bool = True):
+    """Point the bot modules at the SQLite stand-in stored at ``path``.
+
+    The bot talks to :mod:`db_pg`; :mod:`db` has the same API.  With
+    ``trace`` SQLite statements are counted for the query profiler through
+    a trace callback (durations are not available there, only counts).
+    """
+    import db
+    import bot
+    import cards
+    import handlers
+    import inventory
+
+    db.DB_PATH = path
+    connect = db.get_db
+
+    def traced_connect():
+        conn = connect()
+        conn.set_trace_callback(lambda sql: query_profiler.record(sql, 0.0))
+        return conn
+
+    if trace:
+        db.get_db = traced_connect
+    conn = connect()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.close()
+    for module in (bot, cards, handlers, inventory):
+        module.db = db
+    return db
+
+
+def use_postgres():
+    """Keep :mod:`db_pg`; the ``PG*`` environment picks the database."""
+    import db_pg
+
+    return db_pg
+
+
+def step_label(step: Step) -> str:
+    kind, payload = step
+    if kind == "text":
+        return payload.split()[0]
+    return metrics.callback_prefix(payload)
+
+
+class LoadRun:
+    """Feed ``sessions`` through ``application.process_update``.
+
+    Sessions of one user run one after another, like a person tapping
+    through the bot; up to ``concurrency`` users are active at once.
+    """
+
+    def __init__(self, application, sessions, concurrency: int = 100) -> None:
+        self.application = application
+        self.sessions = sessions
+        self.concurrency = concurrency
+        self.factory = UpdateFactory()
+        self.latency: Dict[str, metrics.Histogram] = collections.defaultdict(metrics.Histogram)
+        self.errors: collections.Counter = collections.Counter()
+        self.updates = 0
+        self.seconds = 0.0
+        self._user_locks: Dict[int, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+        self._current: Optional[str] = None
+
+    async def _on_error(self, update, context) -> None:
+        self.errors[type(context.error).__name__] += 1
+
+    async def _session(self, sem: asyncio.Semaphore, uid: int, steps: List[Step]) -> None:
+        async with sem, self._user_locks[uid]:
+            for step in steps:
+                update = Update.de_json(self.factory.build(uid, step), self.application.bot)
+                start = time.perf_counter()
+                await self.application.process_update(update)
+                self.latency[step_label(step)].observe(time.perf_counter() - start)
+                self.updates += 1
+
+    async def run(self) -> dict:
+        app = self.application
+        app.add_error_handler(self._on_error)
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        sem = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*(self._session(sem, uid, steps) for uid, _, steps in self.sessions))
+        finally:
+            self.seconds = time.perf_counter() - start
+            await app.stop()
+            await app.shutdown()
+        return self.report()
+
+    def report(self) -> dict:
+        commands = sorted(
+            (
+                (label, h.n, h.percentile(0.5), h.percentile(0.95), h.percentile(0.99))
+                for label, h in self.latency.items()
+            ),
+            key=lambda r: r[3],
+            reverse=True,
+        )
+        return {
+            "updates": self.updates,
+            "seconds": self.seconds,
+            "updates_per_sec": self.updates / self.seconds if self.seconds else 0.0,
+            "commands": commands,
+            "errors": dict(self.errors),
+            "handlers": metrics.summary(limit=50),
+            "queries": query_profiler.handler_report(limit=50),
+        }
+
+
+def run(sessions, *, concurrency: int = 100, flood: bool = True, per_chat: int = 20, global_limit: int = 30) -> dict:
+    """Start the fake Bot API, build the bot against it and replay ``sessions``.
+
+    The database must already be selected with :func:`use_sqlite` or
+    :func:`use_postgres` and seeded.
+    """
+    import bot
+
+    metrics.ENABLED = True
+    query_profiler.ENABLED = True
+    limiter = FloodLimiter(per_chat, global_limit) if flood else None
+    api = FakeBotAPI(limiter=limiter).start()
+    try:
+        bot.setup_storage()
+        application = bot.build_application(token="1:load", base_url=api.base_url)
+        logging.getLogger("telegram").setLevel(logging.WARNING)
+        result = asyncio.run(LoadRun(application, sessions, concurrency).run())
+    finally:
+        api.stop()
+    result["api_calls"] = dict(api.calls)
+    result["throttled"] = dict(api.throttled)
+    return result
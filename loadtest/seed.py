@@ -0,0 +1,75 @@
+"""Seed a stand-in database with users, a card catalog and inventories."""
+
+from __future__ import annotations
+
+import random
+import time
+from typing import Dict, List
+
+RARITIES = ["legendary", "mythic", "epic", "rare", "common"]
+RARITY_WEIGHTS = [1, 3, 10, 25, 61]
+CLUBS = ["Boston", "Toronto", "Dallas", "Edmonton", "Colorado", "Florida", "Vegas", "Rangers"]
+
+# first virtual user id; far from real Telegram ids used in tests
+FIRST_USER_ID = 9_000_000
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS users (
+        id BIGINT PRIMARY KEY, username TEXT, last_card_time INTEGER,
+        last_week_score INTEGER DEFAULT 0, referrals_count INTEGER DEFAULT 0,
+        invited_by BIGINT DEFAULT NULL, xp INTEGER DEFAULT 0, level INTEGER DEFAULT 1,
+        xp_daily INTEGER DEFAULT 0, last_xp_reset DATE, win_streak INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS cards (
+        id INTEGER PRIMARY KEY, name TEXT, img TEXT, pos TEXT, country TEXT,
+        born TEXT, height TEXT, weight TEXT, rarity TEXT, stats TEXT,
+        team_en TEXT, team_ru TEXT, points REAL
+    )""",
+    "CREATE TABLE IF NOT EXISTS inventory (user_id BIGINT, card_id INTEGER, time_got INTEGER)",
+    "CREATE INDEX IF NOT EXISTS idx_inventory_user ON inventory(user_id)",
+]
+
+
+def user_ids(users: int) -> List[int]:
+    return list(range(FIRST_USER_ID, FIRST_USER_ID + users))
+
+
+def seed(db_module, users: int = 1000, cards: int = 500, per_user: int = 40, rng_seed: int = 1) -> Dict[int, List[int]]:
+    """Fill ``db_module``'s database and return each user's card ids.
+
+    ``db_module`` is :mod:`db` or :mod:`db_pg`; the statements are plain
+    enough for both.  Seed an empty database before :func:`bot.setup_storage`
+    so the inventory counters are backfilled from these rows.
+    """
+    rng = random.Random(rng_seed)
+    conn = db_module.get_db()
+    cur = conn.cursor()
+    for stmt in SCHEMA:
+        cur.execute(stmt)
+    catalog = []
+    for i in range(1, cards + 1):
+        pos = "G" if i % 6 == 0 else ("D" if i % 3 == 0 else "C")
+        stats = f"Поб {i % 40} КН 2.5" if pos == "G" else f"Очки {i % 90}"
+        club = CLUBS[i % len(CLUBS)]
+        catalog.append((i, f"Player {i:04d}", f"https://img.example/{i}.png", pos,
+                        rng.choices(RARITIES, RARITY_WEIGHTS)[0], stats, club, club))
+    cur.executemany(
+        "INSERT INTO cards (id, name, img, pos, country, born, height, weight, rarity, stats, team_en, team_ru) "
+        "VALUES (?, ?, ?, ?, 'CAN', '1995', '185', '90', ?, ?, ?, ?)",
+        catalog,
+    )
+    now = int(time.time())
+    owned: Dict[int, List[int]] = {}
+    users_rows = []
+    inventory_rows = []
+    for uid in user_ids(users):
+        users_rows.append((uid, f"load{uid - FIRST_USER_ID}"))
+        picks = [rng.randint(1, cards) for _ in range(per_user)]
+        owned[uid] = picks
+        # spread acquisition over the last month so the "new" filter matches some
+        inventory_rows.extend((uid, cid, now - rng.randint(0, 30 * 86400)) for cid in picks)
+    cur.executemany("INSERT INTO users (id, username, last_card_time) VALUES (?, ?, 0)", users_rows)
+    cur.executemany("INSERT INTO inventory (user_id, card_id, time_got) VALUES (?, ?, ?)", inventory_rows)
+    conn.commit()
+    conn.close()
+    return owned
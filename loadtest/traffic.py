@@ -0,0 +1,149 @@
+"""Synthetic update streams for virtual users.
+
+Each scenario is a short script of commands and button presses as one
+user would send them.  :class:`UpdateFactory` turns steps into Bot API
+update dicts that :meth:`telegram.Update.de_json` accepts.
+"""
+
+from __future__ import annotations
+
+import itertools
+import random
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# (kind, payload): kind is "text" for messages and "press" for button presses
+Step = Tuple[str, str]
+
+
+def _card(rng, uid, owned, peers) -> List[Step]:
+    return [("text", "/card")]
+
+
+def _top(rng, uid, owned, peers) -> List[Step]:
+    return [("text", "/rank"), ("press", rng.choice(["rank_top", "rank_xp", "rank_ref", "rank_week"]))]
+
+
+def _collection(rng, uid, owned, peers) -> List[Step]:
+    steps = [("text", "/collection"), ("press", "coll_all")]
+    steps += [("press", "coll_next")] * rng.randint(1, 4)
+    steps += [("press", "coll_back"), ("press", "coll_filter_rarity"), ("press", "coll_rarity_rare")]
+    steps += [("press", "coll_next")] * rng.randint(0, 2)
+    steps += [("press", "coll_back"), ("press", "coll_filter_club"), ("press", "coll_back")]
+    return steps
+
+
+def _pve(rng, uid, owned, peers) -> List[Step]:
+    tactics = ["battle_aggressive", "battle_defensive", "battle_balanced"]
+    return [("text", "/fight")] + [("press", rng.choice(tactics)) for _ in range(3)]
+
+
+def _pvp(rng, uid, owned, peers) -> List[Step]:
+    return [("text", "/duel"), ("text", "/duel_list")]
+
+
+def _trade(rng, uid, owned, peers) -> List[Step]:
+    partner = rng.choice(peers)
+    cards = owned.get(uid) or [1]
+    steps = [("text", f"/trade {partner}")]
+    steps += [("press", f"trade_select_{cid}") for cid in rng.sample(cards, min(2, len(cards)))]
+    steps += [("press", "trade_page_next"), ("press", "trade_page_prev"), ("press", "trade_cancel")]
+    return steps
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "card": _card,
+    "top": _top,
+    "collection": _collection,
+    "pve": _pve,
+    "pvp": _pvp,
+    "trade": _trade,
+}
+
+# relative weights of scenarios per named mix
+MIXES: Dict[str, Dict[str, int]] = {
+    "default": {"card": 25, "top": 15, "collection": 25, "pve": 20, "pvp": 5, "trade": 10},
+    "browse": {"collection": 70, "top": 30},
+    "fights": {"pve": 70, "pvp": 30},
+    "cards": {"card": 60, "trade": 40},
+}
+
+
+def parse_mix(spec: str) -> Dict[str, int]:
+    """Return weights for a mix name or ``scenario=weight,...`` string."""
+    if spec in MIXES:
+        return MIXES[spec]
+    weights = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"unknown scenario: {name}")
+        weights[name] = int(weight or 1)
+    return weights
+
+
+class UpdateFactory:
+    """Build private-chat update dicts with increasing ids."""
+
+    def __init__(self) -> None:
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"Load {uid}", "username": f"load{uid}"}
+
+    def message(self, uid: int, text: str) -> dict:
+        msg = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": self._user(uid),
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": next(self._update_ids), "message": msg}
+
+    def press(self, uid: int, data: str) -> dict:
+        update_id = next(self._update_ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(uid),
+                "chat_instance": str(uid),
+                "data": data,
+                "message": {
+                    "message_id": next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"},
+                    "text": "…",
+                },
+            },
+        }
+
+    def build(self, uid: int, step: Step) -> dict:
+        kind, payload = step
+        return self.message(uid, payload) if kind == "text" else self.press(uid, payload)
+
+
+def sessions(
+    users: Sequence[int],
+    owned: Dict[int, List[int]],
+    mix: Dict[str, int],
+    count: int,
+    rng_seed: int = 1,
+) -> List[Tuple[int, str, List[Step]]]:
+    """Pick ``count`` ``(user_id, scenario, steps)`` sessions from ``mix``."""
+    rng = random.Random(rng_seed)
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    result = []
+    for _ in range(count):
+        uid = rng.choice(users)
+        name = rng.choices(names, weights)[0]
+        result.append((uid, name, SCENARIOS[name](rng, uid, owned, users)))
+    return result
@@ -0,0 +1,71 @@
+import os, sys
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import db
+
+
+SCHEMA = [
+    """CREATE TABLE users (
+        id INTEGER PRIMARY KEY, username TEXT, last_card_time INTEGER,
+        last_week_score INTEGER DEFAULT 0, referrals_count INTEGER DEFAULT 0,
+        invited_by INTEGER DEFAULT NULL, xp INTEGER DEFAULT 0, level INTEGER DEFAULT 1,
+        xp_daily INTEGER DEFAULT 0, last_xp_reset DATE, win_streak INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE cards (
+        id INTEGER PRIMARY KEY, name TEXT, img TEXT, pos TEXT, country TEXT,
+        born TEXT, height TEXT, weight TEXT, rarity TEXT, stats TEXT,
+        team_en TEXT, team_ru TEXT, points REAL, tg_file_id TEXT, img_dead INTEGER DEFAULT 0,
+        img_failed_at BIGINT
+    )""",
+    "CREATE TABLE inventory (user_id INTEGER, card_id INTEGER, time_got INTEGER)",
+    "CREATE INDEX idx_inventory_user ON inventory(user_id)",
+]
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """Point the SQLite stand-in at a fresh database with a small catalog."""
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "test.sqlite"))
+    conn = db.get_db()
+    for stmt in SCHEMA:
+        conn.execute(stmt)
+    rarities = ["legendary", "mythic", "epic", "rare", "common"]
+    clubs = ["Boston", "Toronto", "Dallas"]
+    for i in range(1, 31):
+        pos = "G" if i % 6 == 0 else ("D" if i % 3 == 0 else "C")
+        stats = f"Поб {i} КН 2.5" if pos == "G" else f"Очки {i * 3}"
+        conn.execute(
+            "INSERT INTO cards (id, name, img, pos, country, born, height, weight, rarity, stats, team_en, team_ru) "
+            "VALUES (?, ?, ?, ?, 'CAN', '1995', '185', '90', ?, ?, ?, ?)",
+            (i, f"Player {i:02d}", f"https://img/{i}.png", pos, rarities[i % 5], stats, clubs[i % 3], clubs[i % 3]),
+        )
+    conn.commit()
+    conn.close()
+    return db
+
+
+@pytest.fixture
+def bot_sqlite(tmp_path, monkeypatch):
+    """Run the whole bot on an empty SQLite database; return the ``bot`` module.
+
+    Process-wide caches are reset here so they are filled from this
+    database and do not leak into other tests.
+    """
+    pytest.importorskip("apscheduler")
+    import bot
+    import cards
+    import handlers
+    import inventory
+    from helpers.admin_audit import AdminAudit
+    from helpers.usernames import UsernameDirectory
+
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "bot.sqlite"))
+    for module in (bot, cards, handlers, inventory):
+        monkeypatch.setattr(module, "db", db)
+    monkeypatch.setattr(cards, "_FILE_IDS", None)
+    monkeypatch.setattr(cards, "_CLUB_INDEX", None)
+    monkeypatch.setattr(bot, "USERNAMES", UsernameDirectory(bot.get_db, db.in_clause))
+    monkeypatch.setattr(bot, "admin_audit", AdminAudit())
+    monkeypatch.setattr(bot, "_CACHE_LOOP", None)
+    return bot
@@ -0,0 +1,99 @@
+import os, sys
+import asyncio
+import types
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pytest
+from helpers.admin_audit import AdminAudit
+
+
+def _audit(db_module, **kw):
+    db_module.setup_admin_audit()
+    audit = AdminAudit(**kw)
+    audit.open(db_module.get_db)
+    return audit
+
+
+def test_records_stay_in_memory_until_flush(sqlite_db):
+    audit = _audit(sqlite_db)
+    audit.record(1, "/stats", ts=100)
+    audit.record(1, "/stats", ts=110)
+    audit.record(2, "/logadmin", ts=120)
+    assert audit.recent(2) == [(120, 2, "/logadmin"), (110, 1, "/stats")]
+    assert audit.totals() == {1: 2, 2: 1}
+
+    conn = sqlite_db.get_db()
+    assert conn.execute("SELECT COUNT(*) FROM admin_audit").fetchone()[0] == 0
+    conn.close()
+    assert audit.flush() == 3
+    assert audit.flush() == 0
+    conn = sqlite_db.get_db()
+    counts = conn.execute("SELECT admin_id, command, calls, last_ts FROM admin_audit_counts ORDER BY admin_id").fetchall()
+    conn.close()
+    assert counts == [(1, "/stats", 2, 110), (2, "/logadmin", 1, 120)]
+
+
+def test_counters_and_ring_survive_restart(sqlite_db):
+    audit = _audit(sqlite_db, ring_size=3)
+    for ts in range(5):
+        audit.record(7, "/stats", ts=ts)
+    assert len(audit.recent(10)) == 3
+    audit.flush()
+    audit.record(7, "/stats", ts=10)
+    audit.flush()
+
+    # an entry logged before the database was attached is not lost
+    restarted = AdminAudit(ring_size=3)
+    restarted.record(8, "/whoonline", ts=20)
+    restarted.open(sqlite_db.get_db)
+    assert restarted.commands(7) == {"/stats": 6}
+    assert restarted.admins() == [7, 8]
+    assert [e[0] for e in restarted.recent(10)] == [20, 10, 4]
+    restarted.flush()
+    assert AdminAudit().history() == []
+    assert len(restarted.history(limit=100)) == 7
+
+
+def test_history_filters(sqlite_db):
+    audit = _audit(sqlite_db)
+    audit.record(1, "/stats", ts=100)
+    audit.record(2, "/stats", ts=200)
+    audit.record(1, "/logadmin", ts=300)
+    # history flushes pending entries first
+    assert audit.history(admin_id=1) == [(300, 1, "/logadmin"), (100, 1, "/stats")]
+    assert audit.history(command="/stats") == [(200, 2, "/stats"), (100, 1, "/stats")]
+    assert audit.history(since=150, until=300) == [(200, 2, "/stats")]
+    assert audit.history(admin_id=1, command="/stats", since=50) == [(100, 1, "/stats")]
+
+    conn = sqlite_db.get_db()
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT ts FROM admin_audit WHERE command=? ORDER BY ts DESC", ("/x",)).fetchall()
+    conn.close()
+    assert "idx_admin_audit_command" in str(plan)
+
+
+def test_logadmin_filters(sqlite_db, monkeypatch):
+    bot = pytest.importorskip("bot")
+    from helpers import admin_utils
+    from helpers.usernames import UsernameDirectory
+
+    monkeypatch.setattr(bot, "db", sqlite_db)
+    monkeypatch.setattr(bot, "USERNAMES", UsernameDirectory(bot.get_db, sqlite_db.in_clause))
+    audit = _audit(sqlite_db)
+    monkeypatch.setattr(bot, "admin_audit", audit)
+    monkeypatch.setattr(admin_utils, "admin_audit", audit)
+    admin = bot.ADMINS[0]
+    audit.record(5, "/stats", ts=int(bot.time.time()) - 3 * 86400)
+    audit.record(5, "/whoonline")
+
+    sent = []
+    def run(*args):
+        update = types.SimpleNamespace(
+            effective_user=types.SimpleNamespace(id=admin),
+            message=types.SimpleNamespace(reply_text=lambda text, **kw: asyncio.sleep(0, sent.append(text))),
+        )
+        asyncio.run(bot.logadmin(update, types.SimpleNamespace(args=list(args))))
+        return sent[-1]
+
+    assert bot.parse_audit_filters(["5", "/stats"]) == {"admin_id": 5, "command": "/stats"}
+    assert run().splitlines()[0].endswith("→ /logadmin")
+    assert "/stats" in run("5") and "/stats" not in run("5", "1d")
+    assert run("x").startswith("Используй")
@@ -0,0 +1,32 @@
+from benchmarks import harness
+
+
+def _result(seconds, peak):
+    return {"seconds": seconds, "min_seconds": seconds, "peak_kib": peak}
+
+
+def test_compare_flags_slowdown_and_memory_growth():
+    base = {"a": _result(1.0, 10), "b": _result(1.0, 10), "c": _result(1.0, 10), "gone": _result(1.0, 1)}
+    new = {"a": _result(1.1, 10), "b": _result(1.3, 10), "c": _result(1.0, 20), "added": _result(1.0, 1)}
+    rows = {name: bad for name, _, _, bad in harness.compare(base, new, threshold=0.15, mem_threshold=0.25)}
+    assert rows == {"a": False, "b": True, "c": True}
+
+
+def test_measure_and_roundtrip(tmp_path, monkeypatch):
+    monkeypatch.setattr(harness, "BENCHMARKS", {})
+    calls = []
+
+    @harness.benchmark("append", number=10, repeat=2)
+    def setup(env):
+        return lambda: calls.append(bytearray(4096))
+
+    results = harness.run(None, env=None, log=lambda line: None)
+    assert set(results) == {"append"}
+    assert results["append"]["peak_kib"] >= 4
+    # one warm-up call, 2 repeats of 10 and one traced call
+    assert len(calls) == 22
+
+    path = tmp_path / "base.json"
+    harness.save(str(path), harness.metadata(users=1), results)
+    meta, loaded = harness.load(str(path))
+    assert meta["users"] == 1 and loaded == results
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+import cards
+import inventory
+
+
+@pytest.fixture
+def catalog(sqlite_db, monkeypatch):
+    monkeypatch.setattr(cards, "db", sqlite_db)
+    monkeypatch.setattr(inventory, "db", sqlite_db)
+    monkeypatch.setattr(cards, "_FILE_IDS", None)
+    return sqlite_db
+
+
+def test_file_id_is_persisted_and_reused(catalog):
+    card = cards.get_card(1)
+    assert cards.card_photo(card) == "https://img/1.png"
+    cards.remember_file_id(1, "F1")
+    assert cards.card_photo(card) == "F1"
+    # a new process reads it back from cards.tg_file_id
+    cards._FILE_IDS = None
+    assert cards.card_photo(card) == "F1"
+    cards.forget_file_id(1)
+    cards._FILE_IDS = None
+    assert cards.card_photo(card) == "https://img/1.png"
+
+
+def test_sampler_skips_dead_images(catalog):
+    epic = [i for i in range(1, 31) if i % 5 == 2]
+    for cid in epic[1:]:
+        cards.mark_image_dead(cid)
+    conn = catalog.get_db()
+    cur = conn.cursor()
+    assert {inventory.draw_card(cur, "epic")["id"] for _ in range(10)} == {epic[0]}
+    cards.mark_image_dead(epic[0])
+    assert inventory.draw_card(cur, "epic") is None
+    conn.close()
+    assert all(cid not in epic for cid, _ in cards.cards_without_file_id(100))
+
+
+def test_preload_job_caches_and_flags(catalog, monkeypatch):
+    import bot
+
+    monkeypatch.setattr(bot, "IMAGE_CACHE_CHAT_ID", "-100")
+    monkeypatch.setattr(bot, "IMAGE_PRELOAD_BATCH", 6)
+    sent = []
+
+    async def send_photo(chat_id, photo, **kwargs):
+        sent.append(photo)
+        if photo.endswith("/2.png"):
+            raise BadRequest("Wrong file identifier/HTTP URL specified")
+        if photo.endswith("/5.png"):
+            raise RetryAfter(3)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f"id-{photo}")])
+
+    context = SimpleNamespace(bot=SimpleNamespace(send_photo=send_photo))
+    asyncio.run(bot.preload_card_images(context))
+
+    assert sent == [f"https://img/{i}.png" for i in (1, 2, 3, 4, 5)]
+    assert cards.file_ids() == {1: "id-https://img/1.png", 3: "id-https://img/3.png", 4: "id-https://img/4.png"}
+    # the dead card is not retried; the throttled one is next in line
+    assert [cid for cid, _ in cards.cards_without_file_id(2)] == [5, 6]
+
+
+def test_dead_image_is_retried_after_cooldown(catalog, monkeypatch):
+    import bot
+
+    now = int(time.time())
+    cards.mark_image_dead(2, now=now - bot.IMAGE_RETRY_COOLDOWN - 1)
+    cards.mark_image_dead(7, now=now)
+    for cid in range(1, 31):
+        if cid not in (2, 7):
+            cards.remember_file_id(cid, f"F{cid}")
+    monkeypatch.setattr(bot, "IMAGE_CACHE_CHAT_ID", "-100")
+    sent = []
+
+    async def send_photo(chat_id, photo, **kwargs):
+        sent.append(photo)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id="F2")])
+
+    context = SimpleNamespace(bot=SimpleNamespace(send_photo=send_photo))
+    asyncio.run(bot.preload_card_images(context))
+
+    # only the image that failed a day ago is tried again
+    assert sent == ["https://img/2.png"]
+    assert cards.dead_images_due(bot.IMAGE_RETRY_COOLDOWN, 10) == []
+    conn = catalog.get_db()
+    cur = conn.cursor()
+    assert {inventory.draw_card(cur, "epic")["id"] for _ in range(30)} >= {2}
+    conn.close()
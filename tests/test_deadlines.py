@@ -0,0 +1,32 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from helpers.deadlines import DeadlineScheduler
+
+
+def test_pop_due_returns_expired_in_order():
+    s = DeadlineScheduler()
+    s.schedule("b", 20)
+    s.schedule("a", 10)
+    s.schedule("c", 30)
+    assert s.pop_due(now=25) == ["a", "b"]
+    assert len(s) == 1
+    assert s.pop_due(now=25) == []
+
+
+def test_cancel_and_reschedule():
+    s = DeadlineScheduler()
+    s.schedule("a", 10)
+    s.schedule("b", 10)
+    assert s.cancel("a")
+    assert not s.cancel("a")
+    s.schedule("b", 50)
+    assert s.pop_due(now=20) == []
+    assert s.pop_due(now=50) == ["b"]
+
+
+def test_heap_stays_compact_under_churn():
+    s = DeadlineScheduler()
+    for i in range(10000):
+        s.schedule(i % 10, i)
+    assert len(s) == 10
+    assert len(s._heap) <= 2 * len(s) + 65
@@ -0,0 +1,276 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pytest
+import inventory
+
+
+@pytest.fixture
+def inv_db(sqlite_db, monkeypatch):
+    monkeypatch.setattr(inventory, "db", sqlite_db)
+    monkeypatch.setattr(inventory, "_grant_listeners", [])
+    inventory.setup_counters()
+    return sqlite_db
+
+
+def owned(db, uid):
+    conn = db.get_db()
+    rows = [r[0] for r in conn.execute("SELECT card_id FROM inventory WHERE user_id=?", (uid,))]
+    conn.close()
+    return rows
+
+
+def test_grant_random_cards_inserts_and_notifies(inv_db):
+    seen = []
+    inventory.add_grant_listener(lambda uid, cards: seen.append((uid, [c["id"] for c in cards])))
+    cards = inventory.grant_random_cards_sync(7, 3)
+    assert len({c["id"] for c in cards}) == 3
+    assert sorted(owned(inv_db, 7)) == sorted(c["id"] for c in cards)
+    assert seen == [(7, [c["id"] for c in cards])]
+
+
+def test_grant_cards_splits_large_batches(inv_db, monkeypatch):
+    monkeypatch.setattr(inventory, "INSERT_CHUNK", 4)
+    inventory.grant_cards_sync(8, list(range(1, 11)), now=5)
+    assert sorted(owned(inv_db, 8)) == list(range(1, 11))
+    assert inventory.grant_cards_sync(8, []) == []
+
+
+def test_claim_card_respects_cooldown(inv_db):
+    conn = inv_db.get_db()
+    conn.execute("INSERT INTO users (id, username, last_card_time) VALUES (9, 'u', 0)")
+    conn.commit()
+    conn.close()
+    card, total, wait = inventory.claim_card_sync(9, "rare", 3600, now=10000)
+    assert card["rarity"] == "rare" and total == 1 and wait == 0
+    card, total, wait = inventory.claim_card_sync(9, "rare", 3600, now=10600)
+    assert card is None and wait == 3000
+    assert inventory.claim_card_sync(9, "unknown", 3600, now=20000) == (None, 0, 0)
+    # a failed draw must not burn the cooldown
+    card, total, _ = inventory.claim_card_sync(9, "epic", 3600, now=20000)
+    assert card and total == 2
+
+
+def test_concurrent_claims_grant_once(inv_db):
+    import threading
+
+    conn = inv_db.get_db()
+    conn.execute("INSERT INTO users (id, username, last_card_time) VALUES (10, 'u', 0)")
+    conn.commit()
+    conn.close()
+    results = []
+
+    def tap():
+        results.append(inventory.claim_card_sync(10, "common", 3600, now=50000))
+
+    threads = [threading.Thread(target=tap) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(1 for card, _, _ in results if card) == 1
+    assert len(owned(inv_db, 10)) == 1
+
+
+def test_counters_follow_grants_and_removals(inv_db):
+    inventory.grant_cards_sync(11, [1, 1, 2, 4])
+    assert inventory.get_counts(11) == (3, 4)
+    # card 1 is mythic from Toronto, 2 epic from Dallas, 4 common from Toronto
+    assert inventory.get_group_counts(11, "rarity") == {"mythic": (1, 2), "epic": (1, 1), "common": (1, 1)}
+    assert inventory.get_group_counts(11, "club")["Toronto"] == (2, 3)
+    assert inventory.remove_card_sync(11, 1)
+    assert inventory.remove_card_sync(11, 1)
+    assert not inventory.remove_card_sync(11, 1)
+    assert inventory.get_counts(11) == (2, 2)
+    assert inventory.get_group_counts(11, "rarity") == {"epic": (1, 1), "common": (1, 1)}
+    assert inventory.check_counters_sync() == []
+
+
+def test_checker_rebuilds_drifted_users(inv_db):
+    inventory.grant_cards_sync(12, [3, 5])
+    conn = inv_db.get_db()
+    # a write that bypassed the inventory module
+    conn.execute("INSERT INTO inventory (user_id, card_id, time_got) VALUES (12, 3, 0)")
+    conn.execute("INSERT INTO inventory (user_id, card_id, time_got) VALUES (13, 6, 0)")
+    conn.commit()
+    conn.close()
+    assert sorted(inventory.check_counters_sync()) == [12, 13]
+    assert inventory.get_counts(12) == (2, 3)
+    assert inventory.get_counts(13) == (1, 1)
+    assert inventory.check_counters_sync() == []
+
+
+def test_collection_pages_follow_keyset_cursor(inv_db):
+    inventory.setup_collection_index()
+    inventory.grant_cards_sync(13, list(range(1, 31)) + [5, 5, 7], now=100)
+    expected = sorted(range(1, 31), key=lambda i: (i % 5, i))
+
+    first = inventory.page_user_cards(13, {}, limit=12)
+    second = inventory.page_user_cards(13, {}, after=first[-1][2], limit=12)
+    third = inventory.page_user_cards(13, {}, after=second[-1][2], limit=12)
+    assert [r[0] for r in first + second + third] == expected
+    assert inventory.page_user_cards(13, {}, before=second[0][2], limit=12) == first
+    assert inventory.page_user_cards(13, {}, offset=12, limit=12) == second
+
+    legendary = inventory.page_user_cards(13, {"rarity": "legendary"}, limit=50)
+    assert [(r[0], r[1]) for r in legendary] == [(5, 3), (10, 1), (15, 1), (20, 1), (25, 1), (30, 1)]
+    dupes = inventory.page_user_cards(13, {"duplicates": True}, limit=50)
+    assert [(r[0], r[1]) for r in dupes] == [(5, 3), (7, 2)]
+    assert inventory.count_user_cards(13, {"duplicates": True}) == (2, 5)
+    assert inventory.count_user_cards(13, {"club": "Toronto", "rarity": "mythic"}) == (2, 2)
+
+
+def test_collection_new_filter_uses_grant_time(inv_db):
+    import time
+
+    inventory.setup_collection_index()
+    inventory.grant_cards_sync(14, [1, 2, 3], now=100)
+    inventory.grant_cards_sync(14, [2, 4, 4], now=int(time.time()))
+    new = inventory.page_user_cards(14, {"new_only": True}, limit=10)
+    assert [(r[0], r[1]) for r in new] == [(2, 1), (4, 2)]
+    assert inventory.count_user_cards(14, {"new_only": True, "duplicates": True}) == (1, 2)
+
+
+def test_club_index_and_user_club_counts(inv_db, monkeypatch):
+    import cards
+
+    monkeypatch.setattr(cards, "db", inv_db)
+    cards.reset_club_index()
+    keys, totals = cards.club_index()
+    assert keys == ["Boston", "Dallas", "Toronto"]
+    assert totals == {"Boston": 10, "Dallas": 10, "Toronto": 10}
+    # built once: later catalog reads come from memory
+    monkeypatch.setattr(cards, "db", None)
+    assert cards.club_index()[0] == keys
+    cards.reset_club_index()
+
+    inventory.grant_cards_sync(15, [1, 4, 4, 2], now=1)
+    assert inventory.get_group_counts(15, "club") == {"Toronto": (2, 3), "Dallas": (1, 1)}
+    inventory.remove_card_sync(15, 1)
+    assert inventory.get_group_counts(15, "club") == {"Toronto": (1, 2), "Dallas": (1, 1)}
+
+
+def test_trade_pages_join_names_and_count_pages(inv_db):
+    inventory.grant_cards_sync(16, [3, 1, 1, 2, 5, 4, 30], now=1)
+    rows, pages = inventory.page_trade_cards(16, 0, 4)
+    assert pages == 2
+    assert rows == [(1, 2, "Player 01", "mythic"), (2, 1, "Player 02", "epic"), (3, 1, "Player 03", "rare"), (4, 1, "Player 04", "common")]
+    rows, _ = inventory.page_trade_cards(16, 1, 4)
+    assert [r[0] for r in rows] == [5, 30]
+    assert inventory.page_trade_cards(16, 5, 4) == ([], 2)
+    assert inventory.page_trade_cards(17, 0, 4) == ([], 0)
+
+
+def test_bulk_grant_fills_gaps_and_keeps_counters(inv_db):
+    conn = inv_db.get_db()
+    conn.executemany("INSERT INTO users (id, username) VALUES (?, 'u')", [(20,), (21,)])
+    conn.commit()
+    conn.close()
+    inventory.grant_cards_sync(20, [2, 2, 7])
+    seen = {}
+    inventory.add_grant_listener(lambda uid, cards: seen.setdefault(uid, sorted(c["id"] for c in cards)))
+
+    # epic cards are ids 2, 7, 12, 17, 22, 27; user 99 is not registered
+    added = inventory.bulk_grant_sync([20, 21, 99], rarity="epic", now=5)
+    assert added == {20: 4, 21: 6}
+    assert seen == {20: [12, 17, 22, 27], 21: [2, 7, 12, 17, 22, 27]}
+    assert inventory.get_counts(20) == (6, 7)
+    assert inventory.get_group_counts(21, "rarity") == {"epic": (6, 6)}
+    assert inventory.check_counters_sync() == []
+
+    # Boston cards are ids divisible by 3; its epic ones are already owned
+    assert inventory.bulk_grant_sync([21], club="Boston", rarity="epic") == {}
+    assert inventory.bulk_grant_sync([21], club="Boston") == {21: 8}
+    assert inventory.bulk_grant_sync([21], club="Boston") == {}
+    assert inventory.bulk_grant_sync([20]) == {20: 30 - 6}
+    assert inventory.get_counts(20) == (30, 31)
+    assert inventory.check_counters_sync() == []
+
+
+def test_bulk_grant_skips_cards_granted_concurrently(inv_db, monkeypatch):
+    conn = inv_db.get_db()
+    conn.execute("INSERT INTO users (id, username) VALUES (22, 'u')")
+    conn.commit()
+    conn.close()
+    get_db = inv_db.get_db
+
+    class Cursor:
+        def __init__(self, cur):
+            self._cur = cur
+
+        def __getattr__(self, name):
+            return getattr(self._cur, name)
+
+        def execute(self, sql, *args):
+            result = self._cur.execute(sql, *args)
+            if "CREATE TEMP TABLE" in sql:
+                # another worker's /card claim lands after the gaps were computed
+                inventory._grant(self._cur, 22, [2], 1)
+            return result
+
+    class Conn:
+        def __init__(self, conn):
+            self._conn = conn
+
+        def __getattr__(self, name):
+            return getattr(self._conn, name)
+
+        def cursor(self):
+            return Cursor(self._conn.cursor())
+
+    monkeypatch.setattr(inv_db, "get_db", lambda: Conn(get_db()))
+    assert inventory.bulk_grant_sync([22], rarity="epic") == {22: 5}
+    monkeypatch.setattr(inv_db, "get_db", get_db)
+    assert sorted(owned(inv_db, 22)) == [2, 7, 12, 17, 22, 27]
+    assert inventory.get_counts(22) == (6, 6)
+    assert inventory.check_counters_sync() == []
+
+
+def test_rebuild_keys_clubs_like_incremental_counters(inv_db):
+    conn = inv_db.get_db()
+    conn.execute("UPDATE cards SET team_en='', team_ru='Бостон' WHERE id=1")
+    conn.commit()
+    conn.close()
+    inventory.grant_cards_sync(17, [1, 4], now=1)
+    incremental = inventory.get_group_counts(17, "club")
+    inventory.rebuild_counters_sync([17])
+    assert inventory.get_group_counts(17, "club") == incremental == {"Бостон": (1, 1), "Toronto": (1, 1)}
+    assert inventory.count_user_cards(17, {"club": "Бостон"}) == (1, 1)
+
+
+def test_checker_detects_group_count_drift(inv_db):
+    inventory.grant_cards_sync(18, [1, 4, 4], now=1)
+    inventory.remove_card_sync(18, 1)
+    assert inventory.check_counters_sync() == []
+    conn = inv_db.get_db()
+    conn.execute("UPDATE user_group_counts SET total = total + 1 WHERE user_id=18 AND kind='club'")
+    conn.commit()
+    conn.close()
+    assert inventory.check_counters_sync() == [18]
+    assert inventory.get_group_counts(18, "club") == {"Toronto": (1, 2)}
+    assert inventory.check_counters_sync() == []
+
+
+def test_delete_card_recounts_holders(inv_db):
+    inventory.grant_cards_sync(19, [1, 1, 4], now=1)
+    inventory.grant_cards_sync(20, [4], now=1)
+    assert inventory.delete_card_sync(1) == [19]
+    assert inventory.get_counts(19) == (1, 1)
+    assert inventory.get_group_counts(19, "rarity") == {"common": (1, 1)}
+    assert inventory.get_counts(20) == (1, 1)
+    assert inventory.check_counters_sync(fix=False) == []
+
+
+def test_collection_pages_rank_new_and_rerated_cards(inv_db):
+    inventory.setup_collection_index()
+    conn = inv_db.get_db()
+    conn.execute(
+        "INSERT INTO cards (id, name, rarity, team_en, team_ru) VALUES (31, 'Player 00', 'legendary', 'Boston', 'Boston')"
+    )
+    conn.execute("UPDATE cards SET rarity='legendary' WHERE id=4")
+    conn.commit()
+    conn.close()
+    inventory.grant_cards_sync(21, [1, 4, 5, 31], now=1)
+    first = inventory.page_user_cards(21, {}, limit=2)
+    rest = inventory.page_user_cards(21, {}, after=first[-1][2], limit=2)
+    assert [r[0] for r in first + rest] == [31, 4, 5, 1]
+    assert first[1][2] == (0, "Player 04", 4)
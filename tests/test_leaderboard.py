@@ -0,0 +1,125 @@
+import os, sys
+import asyncio
+import types
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pytest
+from helpers.leaderboard import Board, render_top
+from helpers.usernames import UsernameDirectory
+
+
+def test_board_position_and_gap():
+    board = Board([(1, 50, 3), (2, 30, 2), (3, 30, 1)], "head")
+    assert board.position(1) == (1, (1, 50, 3), None)
+    assert board.position(2) == (2, (2, 30, 2), 20)
+    assert board.position(3)[2] == 0
+    assert board.position(9) == (3, None, None)
+    assert 2 in board and 9 not in board
+
+
+def test_render_top_limits_lines():
+    entries = [(i, 100 - i) for i in range(1, 13)]
+    text = render_top("T:", entries, {1: "alice"}, lambda e: f"= {e[1]}")
+    assert text.startswith("T:\n\n1. @alice\n= 99\n")
+    assert "10. ID:10" in text and "11." not in text
+
+
+def test_snapshot_builds_all_boards(sqlite_db, monkeypatch):
+    bot = pytest.importorskip("bot")
+    import inventory
+
+    monkeypatch.setattr(bot, "db", sqlite_db)
+    monkeypatch.setattr(inventory, "db", sqlite_db)
+    monkeypatch.setattr(inventory, "_grant_listeners", [])
+    inventory.setup_counters()
+    sqlite_db.setup_weekly_db()
+    conn = sqlite_db.get_db()
+    conn.executemany(
+        "INSERT INTO users (id, username, level, xp, referrals_count, last_week_score) VALUES (?, ?, ?, ?, ?, ?)",
+        [(1, "a", 2, 10, 5, 0), (2, "b", 3, 0, 1, 0), (3, None, 2, 90, 0, 0)],
+    )
+    conn.commit()
+    conn.close()
+    bot.setup_score_points()
+    inventory.grant_cards_sync(1, [1], now=1)
+    inventory.grant_cards_sync(2, [1, 2], now=1)
+    monkeypatch.setattr(bot, "BOARDS", bot.LeaderboardSnapshots())
+    monkeypatch.setattr(bot, "USERNAMES", UsernameDirectory(bot.get_db, sqlite_db.in_clause))
+
+    bot.build_leaderboards_sync()
+    assert [e[0] for e in bot.BOARDS.get("top").entries] == [2, 1, 3]
+    assert [e[0] for e in bot.BOARDS.get("xp").entries] == [2, 3, 1]
+    assert [e[0] for e in bot.BOARDS.get("ref").entries] == [1, 2, 3]
+    assert "1. @b" in bot.BOARDS.get("top").top_text
+
+    sent = []
+    update = types.SimpleNamespace(
+        effective_user=types.SimpleNamespace(id=1),
+        message=types.SimpleNamespace(reply_text=lambda text, **kw: asyncio.sleep(0, sent.append(text))),
+    )
+    monkeypatch.setattr(bot, "is_user_subscribed", lambda b, u: asyncio.sleep(0, True))
+    asyncio.run(bot.top(update, types.SimpleNamespace(bot=None)))
+    assert "👀 Ты — #2 из 3" in sent[0]
+    gap = int(bot.BOARDS.get("top").entries[0][1] - bot.BOARDS.get("top").entries[1][1])
+    assert f"До следующего места: {gap} очков" in sent[0]
+
+
+def test_weekly_rollover_snapshots_scores(sqlite_db, monkeypatch):
+    bot = pytest.importorskip("bot")
+    import inventory
+
+    monkeypatch.setattr(bot, "db", sqlite_db)
+    monkeypatch.setattr(inventory, "db", sqlite_db)
+    monkeypatch.setattr(inventory, "_grant_listeners", [])
+    inventory.setup_counters()
+    sqlite_db.setup_weekly_db()
+    bot.setup_score_points()
+    conn = sqlite_db.get_db()
+    conn.executemany("INSERT INTO users (id, username) VALUES (?, ?)", [(1, "a"), (2, "b")])
+    conn.commit()
+    conn.close()
+    inventory.grant_cards_sync(1, [5, 5], now=1)  # legendary, 15 pts x4 each
+    assert bot.get_weekly_progress(1) == 120
+    assert bot.get_weekly_progress(2) == 0
+
+    assert sqlite_db.rollover_weekly_scores("2026-W41") == 2
+    assert sqlite_db.rollover_weekly_scores("2026-W41") == 0
+    assert bot.get_weekly_progress(1) == 0
+    inventory.grant_cards_sync(1, [1], now=2)  # mythic, 3 pts x2.5
+    assert bot.get_weekly_progress(1) == 7.5
+    # a repeated run of a closed week leaves the baselines alone
+    assert sqlite_db.rollover_weekly_scores("2026-W41") == 0
+    assert bot.get_weekly_progress(1) == 7.5
+    assert sqlite_db.rollover_weekly_scores("2026-W42") == 2
+    assert sqlite_db.get_weekly_history(1) == [("2026-W42", 127.5, 7.5), ("2026-W41", 120, 120)]
+
+
+def test_closed_week_uses_the_utc_date():
+    import datetime
+
+    bot = pytest.importorskip("bot")
+    utc = datetime.timezone.utc
+    assert bot.closed_week(datetime.datetime(2026, 10, 19, 0, 0, 5, tzinfo=utc)) == "2026-W42"
+    # already Tuesday in UTC+8, still Monday in UTC
+    local = datetime.datetime(2026, 10, 20, 5, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=8)))
+    assert bot.closed_week(local) == "2026-W42"
+
+
+def test_grant_listeners_update_caches_on_the_loop(monkeypatch):
+    import threading
+
+    bot = pytest.importorskip("bot")
+    calls = []
+    monkeypatch.setattr(
+        bot, "_shift_cached_score", lambda uid, cards, sign: calls.append((uid, sign, threading.get_ident()))
+    )
+
+    async def run():
+        monkeypatch.setattr(bot, "_CACHE_LOOP", asyncio.get_running_loop())
+        # grants notify listeners from the to_thread worker
+        await asyncio.to_thread(bot._on_cards_granted, 7, [{"id": 1}])
+        await asyncio.to_thread(bot._on_cards_removed, 7, [{"id": 1}])
+        await asyncio.sleep(0)
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+    assert calls == [(7, 1, loop_thread), (7, -1, loop_thread)]
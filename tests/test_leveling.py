@@ -52,12 +52,13 @@ def test_level_up_triggers_reward(monkeypatch):
     assert called.get('lvl') is not None
 
 
-def test_grant_level_reward_adds_cards(monkeypatch):
-    import db, types, asyncio, random, pytest
+def test_grant_level_reward_adds_cards(monkeypatch, sqlite_db):
+    import types, asyncio, random, pytest
     try:
         import handlers
     except ModuleNotFoundError:
         pytest.skip("telegram not available")
+    db = sqlite_db
 
     conn = db.get_db()
     c = conn.cursor()
@@ -67,17 +68,18 @@ def test_grant_level_reward_adds_cards(monkeypatch):
     conn.close()
 
     monkeypatch.setattr(random, 'randint', lambda a, b: 2)
+    monkeypatch.setattr(handlers.inventory, 'db', db)
+    handlers.inventory.setup_counters()
 
-    async def fake_card():
-        return {'id': 999, 'name': 'X', 'rarity': 'common'}
+    async def send_message(*a, **kw):
+        pass
 
-    monkeypatch.setattr(handlers, 'get_random_card', fake_card)
-    ctx = types.SimpleNamespace(bot=types.SimpleNamespace(send_message=lambda *a, **kw: None))
+    ctx = types.SimpleNamespace(bot=types.SimpleNamespace(send_message=send_message))
     asyncio.run(handlers.grant_level_reward(2, 2, ctx))
 
     conn = db.get_db()
     c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM inventory WHERE user_id=2 AND card_id=999')
+    c.execute('SELECT COUNT(*) FROM inventory WHERE user_id=2')
     count = c.fetchone()[0]
     conn.close()
     assert count == 2
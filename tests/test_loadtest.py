@@ -0,0 +1,45 @@
+import db
+from helpers import metrics, query_profiler
+from loadtest import runner, seed, traffic
+from loadtest.fake_api import FakeBotAPI, FloodLimiter, parse_body
+
+
+def test_fake_api_flood_limit():
+    api = FakeBotAPI(limiter=FloodLimiter(per_chat=2, global_limit=100))
+    try:
+        codes = [api.handle("sendMessage", {"chat_id": "1", "text": "hi"})[0] for _ in range(3)]
+        assert codes == [200, 200, 429]
+        status, body = api.handle("sendMessage", {"chat_id": "2", "text": "hi"})
+        assert status == 200 and body["result"]["chat"]["id"] == 2
+        assert api.handle("getChatMember", {"chat_id": "@x", "user_id": "5"})[1]["result"]["status"] == "member"
+        assert api.throttled["sendMessage"] == 1
+    finally:
+        api.server.server_close()
+
+
+def test_parse_body_forms():
+    assert parse_body("application/x-www-form-urlencoded", b"chat_id=1&text=%D0%BF") == {"chat_id": "1", "text": "п"}
+    body = (
+        b"--b\r\nContent-Disposition: form-data; name=\"chat_id\"\r\n\r\n7\r\n"
+        b"--b\r\nContent-Disposition: form-data; name=\"photo\"; filename=\"a.png\"\r\n\r\nxx\r\n--b--\r\n"
+    )
+    assert parse_body("multipart/form-data; boundary=b", body) == {"chat_id": "7", "photo": "<file>"}
+
+
+def test_load_run_smoke(bot_sqlite, monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", False)
+    monkeypatch.setattr(metrics, "STATS", {})
+    monkeypatch.setattr(query_profiler, "ENABLED", False)
+    monkeypatch.setattr(query_profiler, "HANDLERS", {})
+    monkeypatch.setattr(query_profiler, "QUERIES", {})
+
+    owned = seed.seed(db, users=5, cards=40, per_user=10)
+    sessions = traffic.sessions(seed.user_ids(5), owned, traffic.MIXES["default"], 12)
+    report = runner.run(sessions, concurrency=5, flood=False)
+
+    assert report["updates"] == sum(len(steps) for _, _, steps in sessions)
+    assert report["errors"] == {}
+    assert report["api_calls"]["getMe"] == 1
+    assert {label for label, *_ in report["commands"]} <= {
+        traffic_label for _, _, steps in sessions for traffic_label in map(runner.step_label, steps)
+    }
@@ -0,0 +1,55 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from helpers.matchmaking import MatchmakingQueue
+
+
+def entry(rating, created=0.0):
+    return {"rating": rating, "created": created}
+
+
+def test_pairs_closest_within_tolerance():
+    q = MatchmakingQueue(base_tolerance=10, widen_per_sec=0)
+    q.add(1, entry(50))
+    q.add(2, entry(95))
+    q.add(3, entry(57))
+    q.add(4, entry(52))
+    opp, _, _ = q.match(1, now=0)
+    assert opp == 4
+    assert 1 not in q and 4 not in q
+    assert len(q) == 2
+
+
+def test_no_match_outside_window_until_it_widens():
+    q = MatchmakingQueue(base_tolerance=10, widen_per_sec=1)
+    q.add(1, entry(50, created=0))
+    q.add(2, entry(80, created=0))
+    assert q.match(1, now=5) is None
+    opp, _, _ = q.match(1, now=25)
+    assert opp == 2
+    stats = q.stats()
+    assert stats["matched"] == 1
+    assert stats["avg_wait"] == 25
+
+
+def test_long_waiter_accepts_newcomer():
+    q = MatchmakingQueue(base_tolerance=5, widen_per_sec=1)
+    q.add(1, entry(10, created=0))
+    q.add(2, entry(60, created=100))
+    assert q.find_match(2, now=100) == 1
+
+
+def test_expire_and_mapping_interface():
+    q = MatchmakingQueue()
+    q[1] = {"created": 0}
+    q[2] = {"created": 90}
+    assert q.expire(ttl=50, now=100) == [1]
+    assert list(q) == [2]
+    assert q.pop(5, None) is None
+    assert q.stats()["expired"] == 1
+
+
+def test_nearby_sorted_by_gap():
+    q = MatchmakingQueue()
+    for uid, rating in [(1, 50), (2, 300), (3, 40), (4, 55)]:
+        q.add(uid, entry(rating))
+    assert [uid for uid, _ in q.nearby(1, limit=2)] == [4, 3]
@@ -0,0 +1,66 @@
+import os, sys
+import asyncio
+import types
+import urllib.request
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pytest
+from helpers import metrics
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(metrics, "STATS", {})
+    monkeypatch.setattr(metrics, "ENABLED", True)
+
+
+def test_callback_prefix():
+    assert metrics.callback_prefix("trade_select_12") == "trade_select"
+    assert metrics.callback_prefix("coll_rarity_epic") == "coll_rarity"
+    assert metrics.callback_prefix("challenge_42") == "challenge"
+    assert metrics.callback_prefix("rename_select:7") == "rename_select"
+    assert metrics.callback_prefix(None) == ""
+
+
+def test_instrument_records_calls_errors_and_labels():
+    async def collection_callback(update, context):
+        if update.callback_query.data == "coll_boom":
+            raise ValueError
+        return "ok"
+
+    wrapped = metrics.instrument(collection_callback)
+    assert metrics.instrument(wrapped) is wrapped
+    query = lambda data: types.SimpleNamespace(callback_query=types.SimpleNamespace(data=data))
+    assert asyncio.run(wrapped(query("coll_next"), None)) == "ok"
+    asyncio.run(wrapped(query("coll_next"), None))
+    with pytest.raises(ValueError):
+        asyncio.run(wrapped(query("coll_boom"), None))
+
+    stats = metrics.STATS["collection_callback:coll_next"]
+    assert (stats.calls, stats.errors) == (2, 0)
+    assert metrics.STATS["collection_callback:coll_boom"].errors == 1
+    label, calls, errors, p50, p95, p99 = metrics.summary()[0]
+    assert p50 <= p95 <= p99 <= metrics.BUCKETS[0]
+
+
+def test_histogram_percentiles():
+    hist = metrics.Histogram((0.1, 1.0))
+    for value in [0.05] * 90 + [0.5] * 9 + [5.0]:
+        hist.observe(value)
+    assert hist.percentile(0.5) == 0.1
+    assert hist.percentile(0.95) == 1.0
+    assert hist.percentile(1.0) == float("inf")
+
+
+def test_prometheus_export_over_http():
+    metrics.observe('card', 0.02)
+    metrics.observe('card', 3.0, error=True)
+    server = metrics.start_http_server(0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        text = urllib.request.urlopen(url, timeout=5).read().decode()
+    finally:
+        server.shutdown()
+    assert 'bot_handler_calls_total{handler="card"} 2' in text
+    assert 'bot_handler_errors_total{handler="card"} 1' in text
+    assert 'bot_handler_seconds_bucket{handler="card",le="0.025"} 1' in text
+    assert 'bot_handler_seconds_bucket{handler="card",le="+Inf"} 2' in text
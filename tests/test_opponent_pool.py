@@ -0,0 +1,49 @@
+import os, sys, random
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from helpers.opponent_pool import OpponentPool, TEAM_SIZE
+
+
+def make_catalog(n=50):
+    return [{'id': i, 'name': f'P{i}', 'points': float(i)} for i in range(n)]
+
+
+def test_pick_before_load_returns_none():
+    pool = OpponentPool()
+    assert pool.pick(30) is None
+
+
+def test_refill_fills_every_tier():
+    pool = OpponentPool(tiers=5, per_tier=3)
+    pool.load_catalog(make_catalog())
+    assert pool.refill() == 15
+    assert pool.size() == 15
+    assert pool.refill() == 0
+
+
+def test_pick_matches_strength_tier():
+    random.seed(0)
+    pool = OpponentPool(tiers=5, per_tier=2)
+    pool.load_catalog(make_catalog())
+    pool.refill()
+    weak = pool.pick(1)
+    strong = pool.pick(45)
+    assert len(weak) == len(strong) == TEAM_SIZE
+    assert max(p['points'] for p in weak) < 10
+    assert min(p['points'] for p in strong) >= 40
+
+
+def test_pick_falls_back_to_neighbour_tier():
+    pool = OpponentPool(tiers=5, per_tier=1)
+    pool.load_catalog(make_catalog())
+    pool.refill()
+    pool.pick(45)
+    roster = pool.pick(45)
+    assert min(p['points'] for p in roster) >= 30
+    assert pool.size() == 3
+
+
+def test_small_catalog_pads_roster():
+    pool = OpponentPool(tiers=5, per_tier=1)
+    pool.load_catalog(make_catalog(3))
+    pool.refill()
+    assert len(pool.pick(0)) == TEAM_SIZE
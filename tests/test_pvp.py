@@ -47,3 +47,117 @@ def test_pvp_queue_cleanup(monkeypatch):
     handlers.PVP_QUEUE[1] = {"created": time.time() - handlers.PVP_TTL - 1}
     handlers.cleanup_pvp_queue()
     assert not handlers.PVP_QUEUE
+
+
+class FakeController:
+    def __init__(self):
+        self.phase = "p1"
+        self.steps = []
+
+    def step(self, t1, t2):
+        self.steps.append((t1, t2))
+        self.phase = "p2"
+
+
+def test_duel_deadline_plays_default_tactic(monkeypatch):
+    prompted = []
+
+    async def fake_prompt(state, context):
+        prompted.append(state["controller"].phase)
+
+    monkeypatch.setattr(handlers, '_prompt_pvp_phase', fake_prompt)
+    controller = FakeController()
+    key = (11, 12)
+    handlers.ACTIVE_DUELS[key] = {"controller": controller, "choices": {11: "aggressive"}, "users": (11, 12)}
+    handlers.DUEL_USERS[11] = key
+    handlers.DUEL_USERS[12] = key
+    handlers.DUEL_DEADLINES.schedule(key, time.time() - 1)
+    ctx = types.SimpleNamespace(bot=DummyBot())
+
+    asyncio.run(handlers.duel_deadline_tick(ctx))
+
+    assert controller.steps == [("aggressive", handlers.DUEL_DEFAULT_TACTIC)]
+    assert prompted == ["p2"]
+    assert handlers.ACTIVE_DUELS[key]["choices"] == {}
+    # the next phase got a fresh deadline
+    assert key in handlers.DUEL_DEADLINES
+    handlers.ACTIVE_DUELS.pop(key, None)
+    handlers.DUEL_DEADLINES.cancel(key)
+    handlers.DUEL_USERS.pop(11, None)
+    handlers.DUEL_USERS.pop(12, None)
+
+
+def test_stale_local_deadline_does_not_cut_phase_short(monkeypatch):
+    async def fake_prompt(state, context):
+        pass
+
+    monkeypatch.setattr(handlers, '_prompt_pvp_phase', fake_prompt)
+    controller = FakeController()
+    key = (13, 14)
+    # another worker already advanced the duel and set a new deadline
+    later = time.time() + 60
+    handlers.ACTIVE_DUELS[key] = {
+        "controller": controller, "choices": {13: "aggressive"}, "users": (13, 14),
+        "phase": 1, "deadline": later,
+    }
+    handlers.DUEL_DEADLINES.schedule(key, time.time() - 1)
+    ctx = types.SimpleNamespace(bot=DummyBot())
+
+    asyncio.run(handlers.duel_deadline_tick(ctx))
+    assert controller.steps == []
+    assert handlers.ACTIVE_DUELS[key]["choices"] == {13: "aggressive"}
+    # the local hint now follows the stored deadline
+    assert handlers.DUEL_DEADLINES.pop_due(later - 1) == []
+    assert handlers.DUEL_DEADLINES.pop_due(later) == [key]
+    # a claim for an older phase is refused even after the deadline
+    handlers.ACTIVE_DUELS[key] = {**handlers.ACTIVE_DUELS[key], "deadline": time.time() - 1}
+    assert handlers._claim_duel_step(key, {}, fill_missing=True, phase=0) is None
+    assert handlers._claim_duel_step(key, {}, fill_missing=True, phase=1)["choices"] == {13: "aggressive", 14: "balanced"}
+    handlers.ACTIVE_DUELS.pop(key, None)
+
+
+def test_saved_duel_deadline_survives_restart(monkeypatch):
+    async def fake_prompt(state, context):
+        pass
+
+    monkeypatch.setattr(handlers, '_prompt_pvp_phase', fake_prompt)
+    # a fresh process: the duel is stored but nothing is scheduled locally
+    monkeypatch.setattr(handlers, 'DUEL_DEADLINES', handlers.DeadlineScheduler())
+    monkeypatch.setattr(handlers, '_DUEL_SCANNED_AT', 0.0)
+    controller = FakeController()
+    key = (15, 16)
+    handlers.ACTIVE_DUELS[key] = {
+        "controller": controller, "choices": {}, "users": (15, 16),
+        "phase": 0, "deadline": time.time() - 1,
+    }
+    ctx = types.SimpleNamespace(bot=DummyBot())
+
+    asyncio.run(handlers.duel_deadline_tick(ctx))
+    assert controller.steps == [(handlers.DUEL_DEFAULT_TACTIC, handlers.DUEL_DEFAULT_TACTIC)]
+    assert handlers.ACTIVE_DUELS[key]["phase"] == 1
+    handlers.ACTIVE_DUELS.pop(key, None)
+
+
+def test_failed_step_releases_the_duel(monkeypatch):
+    class BrokenController(FakeController):
+        def step(self, t1, t2):
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(handlers, 'DUEL_DEADLINES', handlers.DeadlineScheduler())
+    key = (17, 18)
+    handlers.ACTIVE_DUELS[key] = {
+        "controller": BrokenController(), "choices": {17: "aggressive"}, "users": (17, 18),
+        "phase": 0, "deadline": time.time() - 1,
+    }
+    handlers.DUEL_DEADLINES.schedule(key, time.time() - 1)
+    ctx = types.SimpleNamespace(bot=DummyBot())
+
+    asyncio.run(handlers.duel_deadline_tick(ctx))
+    state = handlers.ACTIVE_DUELS[key]
+    assert state["stepping"] is None
+    assert state["deadline"] > time.time()
+    assert key in handlers.DUEL_DEADLINES
+    # once the retry delay passes the phase can be claimed again
+    handlers.ACTIVE_DUELS[key] = {**state, "deadline": time.time() - 1}
+    assert handlers._claim_duel_step(key, {}, fill_missing=True, phase=0)
+    handlers.ACTIVE_DUELS.pop(key, None)
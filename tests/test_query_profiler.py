@@ -0,0 +1,57 @@
+import os, sys
+import asyncio
+import time
+import types
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pytest
+from helpers import metrics, query_profiler
+
+
+@pytest.fixture(autouse=True)
+def profiler(monkeypatch):
+    monkeypatch.setattr(query_profiler, "ENABLED", True)
+    monkeypatch.setattr(query_profiler, "QUERIES", {})
+    monkeypatch.setattr(query_profiler, "HANDLERS", {})
+
+
+class FakeCursor:
+    def execute(self, query, params):
+        if "pg_sleep" in query:
+            time.sleep(0.02)
+
+    def executemany(self, query, seq):
+        pass
+
+
+def test_fingerprint_collapses_values():
+    a = query_profiler.fingerprint("SELECT  name FROM cards WHERE id=%s AND rarity='epic'")
+    b = query_profiler.fingerprint("SELECT name\n FROM cards WHERE id=17 AND rarity='it''s'")
+    assert a == b == "SELECT name FROM cards WHERE id=? AND rarity=?"
+    assert query_profiler.fingerprint("DELETE FROM t WHERE id IN (?, ?, ?)") == "DELETE FROM t WHERE id IN (...)"
+
+
+def test_queries_are_attributed_to_handler_across_threads(caplog, monkeypatch):
+    db_pg = pytest.importorskip("db_pg")
+    monkeypatch.setattr(query_profiler, "SLOW_QUERY_MS", 10)
+    cur = db_pg.PGCursor(FakeCursor())
+
+    def n_plus_one(ids):
+        cur.execute("SELECT id FROM inventory WHERE user_id=?", (1,))
+        for cid in ids:
+            cur.execute("SELECT name FROM cards WHERE id=?", (cid,))
+
+    async def whoonline(update, context):
+        await asyncio.to_thread(n_plus_one, update.ids)
+        cur.execute("SELECT pg_sleep(0.02)")
+
+    wrapped = metrics.instrument(whoonline)
+    asyncio.run(wrapped(types.SimpleNamespace(ids=[1, 2, 3]), None))
+    asyncio.run(wrapped(types.SimpleNamespace(ids=list(range(10))), None))
+    cur.execute("SELECT 1")  # outside any handler
+
+    (name, calls, avg_q, max_q, _), = query_profiler.handler_report()
+    assert (name, calls, max_q) == ("whoonline", 2, 12)
+    assert avg_q == (5 + 12) / 2
+    top = dict((fp, n) for fp, n, _, _ in query_profiler.query_report(10))
+    assert top["SELECT name FROM cards WHERE id=?"] == 13
+    assert any("Slow query" in r.message and "whoonline" in r.message for r in caplog.records)
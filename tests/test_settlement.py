@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import types
+import pytest
+
+try:
+    import handlers
+except ModuleNotFoundError:
+    pytest.skip("telegram not available", allow_module_level=True)
+
+from helpers.leveling import calc_battle_xp, level_from_xp
+
+WIN = {"winner": "team1", "score": {"team1": 3, "team2": 1}, "mvp": "X", "log": [], "str_gap": 0.0}
+LOSS = {**WIN, "winner": "team2"}
+
+
+@pytest.fixture
+def settle_db(sqlite_db, monkeypatch):
+    monkeypatch.setattr(handlers, "db", sqlite_db)
+    sqlite_db.setup_xp_ledger()
+    conn = sqlite_db.get_db()
+    conn.executemany(
+        "INSERT INTO users (id, username, xp, level, xp_daily, win_streak) VALUES (?, ?, 0, 1, 0, 0)",
+        [(uid, f"u{uid}") for uid in range(1, 5)],
+    )
+    conn.commit()
+    conn.close()
+    return sqlite_db
+
+
+def user_row(db, uid):
+    conn = db.get_db()
+    row = conn.execute("SELECT xp, level, xp_daily, win_streak FROM users WHERE id=?", (uid,)).fetchone()
+    conn.close()
+    return row
+
+
+def test_streak_gain_matches_calc_battle_xp(settle_db):
+    xp = 0
+    for streak in range(1, 13):
+        settle_db.settle_battle([(1, True, handlers._xp_table(WIN, True))])
+        xp += calc_battle_xp(WIN, is_pve=True, streak=streak, strength_gap=0.0)
+        assert user_row(settle_db, 1)[0] == xp
+    (_, gain, _, _, _), = settle_db.settle_battle([(1, False, handlers._xp_table(LOSS, True))])
+    assert gain == calc_battle_xp(LOSS, is_pve=True, streak=0, strength_gap=0.0)
+    assert user_row(settle_db, 1)[3] == 0
+
+
+def test_pvp_settlement_writes_battle_and_both_players(settle_db):
+    sent = []
+
+    async def send_message(uid, text, **kw):
+        sent.append(uid)
+
+    ctx = types.SimpleNamespace(bot=types.SimpleNamespace(send_message=send_message))
+    (xp1, _, _), (xp2, _, _) = asyncio.run(
+        handlers.settle_match([(1, WIN, False), (2, LOSS, False)], ctx, battle=(1, "2", WIN))
+    )
+    assert user_row(settle_db, 1) == (xp1, level_from_xp(xp1), xp1, 1)
+    assert user_row(settle_db, 2)[0] == xp2
+    conn = settle_db.get_db()
+    assert conn.execute("SELECT COUNT(*) FROM battles").fetchone()[0] == 1
+    conn.close()
+    assert sent == [1, 2]
+
+
+def test_concurrent_settlements_lose_no_xp(settle_db):
+    rounds = 15
+    gains = handlers._xp_table(LOSS, False)
+
+    def play(a, b):
+        for _ in range(rounds):
+            settle_db.settle_battle([(a, False, gains), (b, False, gains)], (a, str(b), LOSS))
+
+    threads = [threading.Thread(target=play, args=pair) for pair in [(1, 2), (2, 3), (3, 1), (4, 1)]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    per_match = gains[0]
+    expected = {1: 3 * rounds, 2: 2 * rounds, 3: 2 * rounds, 4: rounds}
+    for uid, matches in expected.items():
+        xp, level, daily, _ = user_row(settle_db, uid)
+        assert xp == matches * per_match
+        assert daily == xp
+        assert level == level_from_xp(xp)
+
+
+def test_daily_xp_resets_lazily_and_ledger_sums(settle_db):
+    import datetime
+
+    conn = settle_db.get_db()
+    conn.execute("UPDATE users SET xp_daily=500, last_xp_reset='2000-01-01' WHERE id=3")
+    conn.commit()
+    conn.close()
+    assert settle_db.get_daily_xp(3) == 0
+
+    gains = handlers._xp_table(LOSS, True)
+    settle_db.settle_battle([(3, False, gains)], source="pve")
+    settle_db.settle_battle([(3, False, gains)], source="pve")
+    settle_db.update_xp(3, 100, 1, 7)
+    assert settle_db.get_daily_xp(3) == 2 * gains[0] + 7
+    today = datetime.date.today()
+    assert settle_db.get_xp_earned(3, today) == (2 * gains[0], 2)
+    assert settle_db.get_xp_earned(3, today, source="pvp") == (0, 0)
+    assert settle_db.get_xp_earned(3, today + datetime.timedelta(days=1)) == (0, 0)
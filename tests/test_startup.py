@@ -0,0 +1,111 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import db
+from helpers import migrations
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# loaded on first use, not by ``import bot``
+DEFERRED = {"handlers", "battle", "psycopg2", "http.server"}
+
+
+def _importtime(code: str):
+    """Return ``{module: cumulative microseconds}`` from ``python -X importtime``."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_import_time_report(capsys):
+    times = _importtime("import bot")
+    assert not DEFERRED & set(times)
+    interpreter = _importtime("pass")
+    top = sorted(
+        ((us, name) for name, us in times.items() if "." not in name and name not in interpreter),
+        reverse=True,
+    )[:6]
+    with capsys.disabled():
+        print(f"\n[startup] import bot: {times['bot'] / 1000:.0f} ms; "
+              + ", ".join(f"{name} {us / 1000:.0f} ms" for us, name in top if name != "bot"))
+
+
+def test_migrations_run_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "m.sqlite"))
+    calls = []
+    steps = [("0001_a", lambda: calls.append("a")), ("0002_b", lambda: calls.append("b"))]
+    assert migrations.migrate(db.get_db, steps) == ["0001_a", "0002_b"]
+    assert migrations.migrate(db.get_db, steps) == []
+    steps.append(("0003_c", lambda: calls.append("c")))
+    assert migrations.migrate(db.get_db, steps) == ["0003_c"]
+    assert calls == ["a", "b", "c"]
+
+
+def test_migration_failure_is_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "m.sqlite"))
+
+    def broken():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        migrations.migrate(db.get_db, [("0001_ok", lambda: None), ("0002_broken", broken)])
+    assert migrations.applied(db.get_db) == {"0001_ok"}
+
+
+def test_time_to_first_update(bot_sqlite, capsys):
+    from loadtest import seed, traffic
+    from loadtest.fake_api import FakeBotAPI
+    from telegram import Update
+
+    bot = bot_sqlite
+    seed.seed(db, users=50, cards=200, per_user=20)
+    uid = seed.user_ids(1)[0]
+    api = FakeBotAPI().start()
+
+    async def first_update():
+        app = bot.build_application(token="1:start", base_url=api.base_url)
+        await app.initialize()
+        await app.post_init(app)
+        await app.start()
+        ready = time.perf_counter()
+        update = Update.de_json(traffic.UpdateFactory().message(uid, "/card"), app.bot)
+        await app.process_update(update)
+        handled = time.perf_counter()
+        await app.stop()
+        await app.shutdown()
+        return ready, handled
+
+    try:
+        start = time.perf_counter()
+        bot.setup_storage()
+        migrated = time.perf_counter()
+        ready, handled = asyncio.run(first_update())
+        again = time.perf_counter()
+        bot.setup_storage()
+        rerun = time.perf_counter() - again
+    finally:
+        api.stop()
+
+    assert api.calls["setMyCommands"] == 1
+    assert api.calls["sendPhoto"] == 1
+    # boards were built by post_init
+    assert bot.BOARDS.get("top") is not None
+    with capsys.disabled():
+        print(f"\n[startup] migrations {1000 * (migrated - start):.0f} ms, "
+              f"build+init+warm-up {1000 * (ready - migrated):.0f} ms, "
+              f"first update {1000 * (handled - ready):.0f} ms, "
+              f"total {1000 * (handled - start):.0f} ms; up-to-date schema check {1000 * rerun:.0f} ms")
+    assert handled - start < 30
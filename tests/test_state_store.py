@@ -0,0 +1,151 @@
+import os, sys
+import threading
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from helpers.state_store import MemoryStateStore, SQLStateStore
+
+
+@pytest.fixture(params=["memory", "sql"])
+def store(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        return MemoryStateStore()
+    import db
+
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "state.sqlite"))
+    st = SQLStateStore(db.get_db)
+    st.setup()
+    return st
+
+
+def test_mapping_roundtrip(store):
+    duels = store.namespace("duels")
+    duels[(1, 2)] = {"choices": {1: "aggressive"}, "users": (1, 2)}
+    assert (1, 2) in duels
+    assert duels[(1, 2)]["choices"] == {1: "aggressive"}
+    assert duels.keys() == [(1, 2)]
+    assert duels.pop((1, 2))["users"] == (1, 2)
+    assert duels.pop((1, 2), None) is None
+    with pytest.raises(KeyError):
+        duels[(1, 2)]
+
+
+def test_compare_and_set_rejects_stale_version(store):
+    assert store.compare_and_set("t", 1, 0, "a")
+    assert not store.compare_and_set("t", 1, 0, "b")
+    value, version = store.get_versioned("t", 1)
+    assert value == "a"
+    assert store.compare_and_set("t", 1, version, "c")
+    assert not store.compare_and_set("t", 1, version, "d")
+    assert store.get("t", 1) == "c"
+
+
+def test_ttl_expiry(store, monkeypatch):
+    import helpers.state_store as st
+
+    now = [1000.0]
+    monkeypatch.setattr(st.time, "time", lambda: now[0])
+    online = store.namespace("online", ttl=600)
+    online[5] = 1000.0
+    store.set("other", 1, "keep")
+    assert 5 in online
+    now[0] += 601
+    assert 5 not in online
+    assert online.items() == []
+    # an expired key can be claimed again
+    assert store.compare_and_set("online", 5, 0, 1601.0, ttl=600)
+    now[0] += 601
+    assert store.purge_expired() == 1
+    assert store.get("other", 1) == "keep"
+
+
+def test_concurrent_updates_are_not_lost(store):
+    store.set("n", "counter", 0)
+
+    def bump():
+        for _ in range(20):
+            store.update("n", "counter", lambda v: v + 1, retries=1000)
+
+    threads = [threading.Thread(target=bump) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert store.get("n", "counter") == 80
+
+
+def test_async_accessors_keep_sql_queries_off_the_loop(store):
+    import asyncio
+
+    mapping = store.namespace("trades")
+    threads = []
+    get_versioned = store.get_versioned
+
+    def tracked(ns, key):
+        threads.append(threading.get_ident())
+        return get_versioned(ns, key)
+
+    store.get_versioned = tracked
+
+    async def run():
+        await mapping.aset(1, {"stage": "accept_offer"})
+        found = await mapping.aget(1), await mapping.acontains(2)
+        await mapping.aupdate(1, lambda v: {**v, "selected": {5}})
+        return found, await mapping.apop(1), await mapping.apop(1)
+
+    loop_thread = threading.get_ident()
+    (found, popped, again) = asyncio.run(run())
+    assert found == ({"stage": "accept_offer"}, False)
+    assert popped == {"stage": "accept_offer", "selected": {5}} and again is None
+    assert all((t != loop_thread) == store.blocking for t in threads)
+
+
+def test_values_are_stored_as_json(store):
+    value = {"selected": {3, 4}, "pair": (1, 2), "choices": {7: "aggressive"}, "__x": [None, 1.5]}
+    store.set("t", (1, 2), value)
+    assert store.get("t", (1, 2)) == value
+    if isinstance(store, SQLStateStore):
+        with pytest.raises(TypeError):
+            store.set("t", 1, object())
+
+
+def test_duel_controller_survives_roundtrip(store):
+    import random
+    from battle import BattleController, BattleSession
+
+    team = [{"id": i, "name": f"P{i}", "pos": "F", "points": 50, "born": "1990", "weight": "90"} for i in range(6)]
+    random.seed(3)
+    controller = BattleController(BattleSession(team, [dict(p) for p in team]))
+    controller.step("aggressive", "defensive")
+    store.set("duels", (1, 2), {"controller": controller, "choices": {}})
+
+    loaded = store.get("duels", (1, 2))["controller"]
+    assert loaded.phase == "p2" and loaded.session.score == controller.session.score
+    loaded.step("balanced", "balanced")
+    assert loaded.auto_play()["winner"]
+
+
+def test_online_heartbeat_writes_are_coalesced(monkeypatch):
+    import asyncio
+    import types
+
+    bot = pytest.importorskip("bot")
+    writes = []
+
+    class Online(dict):
+        def __setitem__(self, key, value):
+            writes.append(key)
+            super().__setitem__(key, value)
+
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "time", lambda: now[0])
+    monkeypatch.setattr(bot, "online_users", Online())
+    monkeypatch.setattr(bot, "_online_written", {})
+    monkeypatch.setattr(bot, "USERNAMES", types.SimpleNamespace(observe=lambda uid, name: None))
+    update = types.SimpleNamespace(effective_user=types.SimpleNamespace(id=5, username="u"))
+
+    for step in (0, 10, 30, 61):
+        now[0] = 1000.0 + step
+        asyncio.run(bot.track_user_activity(update, None))
+    assert writes == [5, 5]
+    assert bot.online_users[5] == 1061.0
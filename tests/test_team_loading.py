@@ -0,0 +1,55 @@
+import asyncio
+import pytest
+
+try:
+    import handlers
+except ModuleNotFoundError:
+    pytest.skip("telegram not available", allow_module_level=True)
+
+
+@pytest.fixture
+def team_db(sqlite_db, monkeypatch):
+    monkeypatch.setattr(handlers, "db", sqlite_db)
+    conn = sqlite_db.get_db()
+    conn.execute("INSERT INTO users (id, username, level) VALUES (5, 'u', 7)")
+    conn.executemany(
+        "INSERT INTO inventory (user_id, card_id, time_got) VALUES (5, ?, 0)",
+        [(cid,) for cid in range(1, 13)],
+    )
+    conn.commit()
+    conn.close()
+    return sqlite_db
+
+
+def test_load_team_returns_only_owned_lineup(team_db):
+    chosen, extras, level = handlers._load_team_sync(5, [1, 2, 25])
+    assert set(chosen) == {1, 2}
+    assert extras == []
+    assert level == 7
+
+
+def test_load_team_fill_excludes_lineup(team_db):
+    chosen, extras, _ = handlers._load_team_sync(5, [1, 2], fill=4)
+    assert set(chosen) == {1, 2}
+    assert len(extras) >= 4
+    assert not {c["id"] for c in extras} & {1, 2}
+
+
+def test_build_team_keeps_lineup_order(team_db):
+    team = asyncio.run(handlers._build_team(5, [3, 1]))
+    assert [p["id"] for p in team[:2]] == [3, 1]
+    assert len(team) == 6
+    assert len({p["id"] for p in team}) == 6
+    assert all(p["owner_level"] == 7 for p in team)
+
+
+def test_build_team_fills_lost_lineup_cards_from_collection(team_db, monkeypatch):
+    async def no_random():
+        raise AssertionError("random catalog card used")
+
+    monkeypatch.setattr(handlers, "get_random_card", no_random)
+    # 25-30 are not owned any more
+    team = asyncio.run(handlers._build_team(5, [1, 25, 26, 27, 28, 29]))
+    ids = [p["id"] for p in team]
+    assert ids[0] == 1 and len(ids) == 6
+    assert set(ids) <= set(range(1, 13))
@@ -0,0 +1,78 @@
+import os, sys
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pytest
+import inventory
+
+
+@pytest.fixture
+def inv_db(sqlite_db, monkeypatch):
+    monkeypatch.setattr(inventory, "db", sqlite_db)
+    monkeypatch.setattr(inventory, "_grant_listeners", [])
+    monkeypatch.setattr(inventory, "_remove_listeners", [])
+    inventory.setup_counters()
+    return sqlite_db
+
+
+def owned(db, uid):
+    conn = db.get_db()
+    rows = sorted(r[0] for r in conn.execute("SELECT card_id FROM inventory WHERE user_id=?", (uid,)))
+    conn.close()
+    return rows
+
+
+def test_trade_moves_all_cards_and_counters(inv_db):
+    inventory.grant_cards_sync(1, [1, 2, 2, 3], now=1)
+    inventory.grant_cards_sync(2, [4, 5], now=1)
+    events = []
+    inventory.add_grant_listener(lambda uid, cards: events.append(("+", uid, sorted(c["id"] for c in cards))))
+    inventory.add_remove_listener(lambda uid, cards: events.append(("-", uid, sorted(c["id"] for c in cards))))
+
+    receipt = inventory.trade_cards_sync(1, [2, 2, 3], 2, [5], now=50)
+    assert [c["id"] for c in receipt["gave"][1]] == [2, 2, 3]
+    assert [c["id"] for c in receipt["gave"][2]] == [5]
+    assert receipt["counts"] == {1: (2, 2), 2: (3, 4)}
+    assert owned(inv_db, 1) == [1, 5]
+    assert owned(inv_db, 2) == [2, 2, 3, 4]
+    assert inventory.get_counts(1) == (2, 2)
+    assert inventory.get_counts(2) == (3, 4)
+    assert inventory.check_counters_sync(fix=False) == []
+    assert ("-", 1, [2, 2, 3]) in events and ("+", 2, [2, 2, 3]) in events
+    assert ("-", 2, [5]) in events and ("+", 1, [5]) in events
+
+
+def test_trade_is_rejected_without_ownership(inv_db):
+    inventory.grant_cards_sync(1, [1], now=1)
+    inventory.grant_cards_sync(2, [4], now=1)
+    assert inventory.trade_cards_sync(1, [1, 1], 2, [4]) is None
+    assert inventory.trade_cards_sync(1, [1], 2, [6]) is None
+    assert owned(inv_db, 1) == [1]
+    assert owned(inv_db, 2) == [4]
+    assert inventory.get_counts(1) == (1, 1)
+
+
+def test_concurrent_trades_of_one_card_only_one_wins(inv_db):
+    inventory.grant_cards_sync(1, [1], now=1)
+    for uid in range(2, 8):
+        inventory.grant_cards_sync(uid, [uid + 10], now=1)
+    results = {}
+    start = threading.Barrier(6)
+
+    def trade(uid):
+        start.wait()
+        results[uid] = inventory.trade_cards_sync(1, [1], uid, [uid + 10])
+
+    threads = [threading.Thread(target=trade, args=(uid,)) for uid in range(2, 8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    winners = [uid for uid, r in results.items() if r is not None]
+    assert len(winners) == 1
+    winner = winners[0]
+    assert owned(inv_db, 1) == [winner + 10]
+    assert owned(inv_db, winner) == [1]
+    holders = [uid for uid in range(1, 8) if 1 in owned(inv_db, uid)]
+    assert holders == [winner]
+    assert inventory.check_counters_sync(fix=False) == []
@@ -0,0 +1,92 @@
+import os, sys
+import asyncio
+import types
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pytest
+from helpers.state_store import MemoryStateStore
+from helpers.usernames import UsernameDirectory
+
+
+def _counting(db_module, queries):
+    def get_db():
+        conn = db_module.get_db()
+        conn.set_trace_callback(queries.append)
+        return conn
+    return get_db
+
+
+def _users(db_module, rows):
+    conn = db_module.get_db()
+    conn.executemany("INSERT INTO users (id, username) VALUES (?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def test_resolve_batches_misses_and_caches(sqlite_db):
+    _users(sqlite_db, [(1, "a"), (2, ""), (3, "c")])
+    queries = []
+    names = UsernameDirectory(_counting(sqlite_db, queries), sqlite_db.in_clause)
+
+    assert names.resolve([1, 2, 3, 4, 1]) == {1: "a", 2: None, 3: "c", 4: None}
+    assert len(queries) == 1
+    assert names.resolve([3, 4]) == {3: "c", 4: None}
+    assert names.get(1) == "a"
+    assert len(queries) == 1
+
+
+def test_cache_is_bounded_lru(sqlite_db):
+    _users(sqlite_db, [(i, f"u{i}") for i in range(1, 6)])
+    names = UsernameDirectory(sqlite_db.get_db, sqlite_db.in_clause, max_size=3)
+    names.resolve([1, 2, 3])
+    names.resolve([1])
+    names.resolve([4])
+    assert len(names) == 3
+    queries = []
+    names._get_db = _counting(sqlite_db, queries)
+    names.resolve([1, 3, 4])
+    assert queries == []
+    names.resolve([2])
+    assert len(queries) == 1
+
+
+def test_observed_names_are_flushed_in_one_batch(sqlite_db):
+    _users(sqlite_db, [(1, "old"), (2, "b")])
+    names = UsernameDirectory(sqlite_db.get_db, sqlite_db.in_clause)
+    assert names.observe(1, "new")
+    assert names.observe(2, "b")
+    assert not names.observe(1, "new")
+    assert names.get(1) == "new"
+    assert names.flush() == 2
+    assert names.flush() == 0
+
+    conn = sqlite_db.get_db()
+    rows = dict(conn.execute("SELECT id, username FROM users"))
+    conn.close()
+    assert rows == {1: "new", 2: "b"}
+
+
+def test_whoonline_resolves_names_with_one_query(sqlite_db, monkeypatch):
+    bot = pytest.importorskip("bot")
+
+    _users(sqlite_db, [(i, f"u{i}") for i in range(1, 6)])
+    queries = []
+    monkeypatch.setattr(bot, "db", sqlite_db)
+    monkeypatch.setattr(bot, "USERNAMES", UsernameDirectory(_counting(sqlite_db, queries), sqlite_db.in_clause))
+    monkeypatch.setattr(bot, "online_users", MemoryStateStore().namespace("online"))
+    monkeypatch.setattr(bot, "_online_written", {})
+    monkeypatch.setattr(bot, "record_admin_usage", lambda uid, cmd: None)
+
+    def update(uid, username):
+        return types.SimpleNamespace(
+            effective_user=types.SimpleNamespace(id=uid, username=username),
+            message=types.SimpleNamespace(reply_text=lambda text, **kw: asyncio.sleep(0, sent.append(text))),
+        )
+
+    sent = []
+    # the fresh name from the update wins over the stored one
+    asyncio.run(bot.track_user_activity(update(2, "renamed"), None))
+    for uid in (1, 3, 4, 5):
+        bot.online_users[uid] = bot.time.time()
+    asyncio.run(bot.whoonline(update(bot.ADMINS[0], None), None))
+    assert sent[0].splitlines()[1:] == ["@renamed", "@u1", "@u3", "@u4", "@u5"]
+    assert len(queries) == 1